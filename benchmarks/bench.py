@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""Load testing benchmarks for YaHS
+
+Starts a Server in a child process then drives each scenario with a load generator of
+raw socket connections spread over a few processes, reporting requests per second and
+p50/p99/p999 latency as JSON so results can be compared between releases.
+
+    python benchmarks/bench.py --duration 5 --output results.json
+    python benchmarks/bench.py --scenarios tiny_get,late_route_1000 --pool-size 16
+    python benchmarks/bench.py --compare results.json
+    python benchmarks/bench.py --in-process --scenarios tiny_get,late_route_1000
+
+--in-process calls the handlers through a TestClient in this process instead, timing
+routing and handler logic without any socket overhead (https and new connection
+scenarios are skipped as they only measure the sockets).
+Each scenario first runs for --warmup seconds whose requests are thrown away, so server
+start up, lazily built route indexes and cold caches don't count against the first one.
+--compare runs the benchmarks again and exits non zero if any scenario lost more than
+--tolerance of its throughput or gained that much p99 latency against the saved results.
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import yahs
+from yahs import Server, TestClient
+
+tests_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+keyfile = os.path.join(tests_directory, 'test-key.pem')
+certfile = os.path.join(tests_directory, 'test-cert.crt')
+
+# route tables whose target is registered after this many - 1 patterns with the same prefix
+route_tables = (10, 100, 1000)
+
+scenarios = [
+    {'name': 'tiny_get', 'path': '/bench/tiny'},
+    {'name': 'tiny_get_new_connections', 'path': '/bench/tiny', 'keep_alive': False},
+    {'name': 'late_route_10', 'path': '/late10/42/target'},
+    {'name': 'late_route_100', 'path': '/late100/42/target'},
+    {'name': 'late_route_1000', 'path': '/late1000/42/target'},
+    {'name': 'post_4k', 'method': 'POST', 'path': '/bench/media/small', 'body_size': 4 * 1024},
+    {'name': 'post_1m', 'method': 'POST', 'path': '/bench/media/medium', 'body_size': 1024 * 1024},
+    {'name': 'post_100m', 'method': 'POST', 'path': '/bench/media/large', 'body_size': 100 * 1024 * 1024,
+     'connections': 2},
+    {'name': 'https_get', 'path': '/bench/tiny', 'secure': True},
+    {'name': 'https_get_new_connections', 'path': '/bench/tiny', 'secure': True, 'keep_alive': False},
+]
+
+
+def register_routes():
+    """Handlers the scenarios hit, registered in the server process.
+    """
+    @Server.handle('GET', r'^/bench/tiny$')
+    def tiny(request):
+        return "ok"
+
+    @Server.handle('POST', r'^/bench/media/(?P<name>[a-z]+)$')
+    def add_media(request, name):
+        # like the add_media test handler, the whole body is read in before the handler runs
+        return str(len(request.body))
+
+    def late(request, id):
+        return "ok"
+
+    for size in route_tables:
+        for number in range(size - 1):
+            Server.handle('GET', r'^/late{}/(?P<id>[0-9]+)/decoy{}$'.format(size, number))(late)
+        Server.handle('GET', r'^/late{}/(?P<id>[0-9]+)/target$'.format(size))(late)
+
+
+def serve(args):
+    """Run the server being benchmarked until it gets SIGTERM.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    register_routes()
+    server = Server(hostname=args.host, port=args.port, secure=True, keyfile=keyfile, certfile=certfile,
+                    pool_size=args.pool_size, engine=args.engine, workers=args.workers,
+                    max_keep_alive_requests=1000000, keep_alive_timeout=30.0)
+    server.start().wait()
+
+
+def start_server(args):
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--host', args.host, '--port', str(args.port),
+               '--engine', args.engine]
+    if args.pool_size:
+        command += ['--pool-size', str(args.pool_size)]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    process = subprocess.Popen(command)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port + 1), timeout=1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server didn't start listening")
+
+
+def build_request(scenario, host):
+    method = scenario.get('method', 'GET')
+    keep_alive = scenario.get('keep_alive', True)
+    body_size = scenario.get('body_size', 0)
+    head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: {}\r\n".format(
+        method, scenario['path'], host, 'keep-alive' if keep_alive else 'close')
+    if body_size:
+        head += "Content-Length: {}\r\n".format(body_size)
+    return head.encode('ascii') + b'\r\n', b'x' * body_size
+
+
+def read_response(reader):
+    """Read one response off the connection, returns its status code.
+    """
+    status_line = reader.readline()
+    if not status_line:
+        raise socket.error("Connection closed before the response")
+    length = 0
+    while True:
+        line = reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    remaining = length
+    while remaining:
+        data = reader.read(min(remaining, 1048576))
+        if not data:
+            raise socket.error("Connection closed part way through the response")
+        remaining -= len(data)
+    return int(status_line.split()[1])
+
+
+def drive(job):
+    """Load generator process: hammer the server from some connections until the deadline.
+
+    returns (latencies in seconds, error count)
+    """
+    scenario, host, port, connections, deadline = job
+    head, body = build_request(scenario, host)
+    keep_alive = scenario.get('keep_alive', True)
+    secure = scenario.get('secure', False)
+    context = None
+    if secure:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    latencies = []
+    errors = [0]
+
+    def connection():
+        client = reader = None
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                if client is None:
+                    client = socket.create_connection((host, port + 1 if secure else port))
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    if context is not None:
+                        client = context.wrap_socket(client, server_hostname=host)
+                    reader = client.makefile('rb')
+                client.sendall(head)
+                if body:
+                    client.sendall(body)
+                status = read_response(reader)
+            except (socket.error, ValueError, IndexError):
+                errors[0] += 1
+                if client is not None:
+                    client.close()
+                client = None
+                continue
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors[0] += 1
+            if not keep_alive:
+                reader.close()
+                client.close()
+                client = None
+        if client is not None:
+            client.close()
+
+    threads = [threading.Thread(target=connection) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of sorted values."""
+    if not ordered:
+        return None
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def run_scenario(scenario, args):
+    connections = scenario.get('connections', args.connections)
+    processes = max(1, min(args.processes, connections))
+    # share the connections out between the load generator processes
+    shares = [connections // processes + (1 if number < connections % processes else 0)
+              for number in range(processes)]
+
+    with multiprocessing.Pool(processes) as pool:
+        if args.warmup:
+            deadline = time.time() + args.warmup
+            pool.map(drive, [(scenario, args.host, args.port, share, deadline) for share in shares])
+        started = time.time()
+        deadline = started + args.duration
+        results = pool.map(drive, [(scenario, args.host, args.port, share, deadline) for share in shares])
+    elapsed = time.time() - started
+    return summarize(scenario, connections, [latency for result in results for latency in result[0]],
+                     sum(result[1] for result in results), elapsed)
+
+
+def run_in_process(scenario, args):
+    """Drive the scenario through a TestClient, one request after another.
+    """
+    client = TestClient()
+    method = scenario.get('method', 'GET')
+    body = b'x' * scenario['body_size'] if scenario.get('body_size') else None
+    latencies = []
+    errors = 0
+
+    deadline = time.time() + args.warmup
+    while time.time() < deadline:
+        client.request(method, scenario['path'], body)
+
+    started = time.time()
+    deadline = started + args.duration
+    while time.time() < deadline:
+        request_started = time.perf_counter()
+        response = client.request(method, scenario['path'], body)
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code >= 400:
+            errors += 1
+    return summarize(scenario, 1, latencies, errors, time.time() - started)
+
+
+def summarize(scenario, connections, latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    milliseconds = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return {
+        'scenario': scenario['name'],
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': milliseconds(percentile(latencies, 0.5)),
+            'p99': milliseconds(percentile(latencies, 0.99)),
+            'p999': milliseconds(percentile(latencies, 0.999)),
+            'max': milliseconds(latencies[-1] if latencies else None),
+            'mean': milliseconds(sum(latencies) / len(latencies) if latencies else None)
+        }
+    }
+
+
+def compare(baseline, report, tolerance):
+    """Print how each scenario moved against the baseline, returns the regressed scenario names.
+    """
+    previous = dict((result['scenario'], result) for result in baseline['results'])
+    regressions = []
+    for result in report['results']:
+        before = previous.get(result['scenario'])
+        if before is None or not before['requests_per_second'] or not before['latency_ms']['p99']:
+            continue
+        throughput = result['requests_per_second'] / before['requests_per_second'] - 1
+        p99 = (result['latency_ms']['p99'] or 0) / before['latency_ms']['p99'] - 1
+        regressed = throughput < -tolerance or p99 > tolerance
+        sys.stderr.write("{:<28} req/s {:+7.1%}  p99 {:+7.1%}{}\n".format(
+            result['scenario'], throughput, p99, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(result['scenario'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4400, help='http port, https listens on the next one')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds each scenario runs for')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='seconds each scenario runs for before measuring, those requests are discarded')
+    parser.add_argument('--connections', type=int, default=16, help='concurrent client connections')
+    parser.add_argument('--processes', type=int, default=min(4, multiprocessing.cpu_count()),
+                        help='load generator processes the connections are spread over')
+    parser.add_argument('--scenarios', help='comma separated scenario names, all of them by default')
+    parser.add_argument('--engine', default='threads', choices=('threads', 'asyncio'))
+    parser.add_argument('--pool-size', type=int, help='Server pool_size, a thread per connection by default')
+    parser.add_argument('--workers', type=int, help='Server workers, pre-forked worker processes')
+    parser.add_argument('--in-process', action='store_true',
+                        help='call the handlers through a TestClient rather than over sockets')
+    parser.add_argument('--output', help='write the JSON results here as well as to stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction throughput may drop or p99 latency grow before --compare fails')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    selected = scenarios
+    if args.scenarios:
+        names = args.scenarios.split(',')
+        unknown = set(names) - set(scenario['name'] for scenario in scenarios)
+        if unknown:
+            parser.error("unknown scenarios {}".format(', '.join(sorted(unknown))))
+        selected = [scenario for scenario in scenarios if scenario['name'] in names]
+
+    if args.in_process:
+        register_routes()
+        selected = [scenario for scenario in selected
+                    if not scenario.get('secure') and scenario.get('keep_alive', True)]
+        server = None
+    else:
+        server = start_server(args)
+    try:
+        results = []
+        for scenario in selected:
+            result = run_in_process(scenario, args) if args.in_process else run_scenario(scenario, args)
+            sys.stderr.write("{scenario:<28} {requests_per_second:>10} req/s  p50 {p50} ms  p99 {p99} ms  "
+                             "p999 {p999} ms  errors {errors}\n".format(**dict(result, **result['latency_ms'])))
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'yahs_version': yahs.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'connections': args.connections,
+            'processes': args.processes,
+            'engine': 'in-process' if args.in_process else args.engine,
+            'pool_size': args.pool_size,
+            'workers': args.workers
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(json.load(baseline_file), report, args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
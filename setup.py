@@ -5,7 +5,7 @@ setup(
     version='1.1',
     # packages=[''],
     package_dir={'': 'src'},
-    py_modules=['yahs'],
+    py_modules=['yahs', 'yahs_asyncio'],
     keywords = ["http", "rest", "json", "decorator"],
     url='https://github.com/timatooth/yahs',
     license='MIT',
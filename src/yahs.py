@@ -10,7 +10,9 @@ __license__ = 'MIT'
 
 import sys
 import os
+import stat
 import signal
+import select
 import socket
 import threading
 import ssl
@@ -18,26 +20,224 @@ import logging
 import re
 import collections
 import inspect
+import functools
+import io
+import tempfile
+import hashlib
+import math
+import base64
+import zlib
+import time
+import bisect
+import json
+import random
+import cProfile
+import pstats
+import mimetypes
+import email.utils
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 if sys.version_info >= (3,0):
-    from urllib.parse import parse_qs
+    from urllib.parse import parse_qs, unquote, quote
+    from io import StringIO
+    from importlib import reload as reload_module
+    import queue
 else:
     from urlparse import parse_qs
+    from urllib import unquote, quote
+    from StringIO import StringIO
+    import Queue as queue
+    reload_module = reload
 
 
-class Request:
+class Headers(dict):
+    """dict of HTTP headers where lookups ignore the case of the header name.
+
+    Iterating gives the names as they were set, ready for writing them out.
+    """
+    __slots__ = ('names',)
+
+    def __init__(self, *args, **kwargs):
+        super(Headers, self).__init__()
+        self.names = {}  # lower case name to the name as it was set
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, name, value):
+        lower = name.lower()
+        current = self.names.get(lower)
+        if current is not None and current != name:
+            dict.__delitem__(self, current)
+        self.names[lower] = name
+        dict.__setitem__(self, name, value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, self.names.get(name.lower(), name))
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, self.names.pop(name.lower(), name))
+
+    def __contains__(self, name):
+        return name.lower() in self.names
+
+    def get(self, name, default=None):
+        current = self.names.get(name.lower())
+        return default if current is None else dict.__getitem__(self, current)
+
+    def pop(self, name, *default):
+        current = self.names.pop(name.lower(), None)
+        if current is None:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        return dict.pop(self, current)
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.names.clear()
+
+    def copy(self):
+        copied = Headers.__new__(Headers)
+        dict.update(copied, self)
+        copied.names = self.names.copy()
+        return copied
+
+
+class Request(object):
     """Structure of an incoming HTTP request.
 
     Requests are created by the running HttpWorker threads and have
     a uri. 'handlers' register for request url patterns they're interested in.
+    The headers and query string are kept raw until a handler first uses them.
     """
+    __slots__ = ('method', 'uri', 'version', 'body', 'remote_address', 'header_block', 'lowered_block',
+                 'parsed_headers', 'query_string', 'parsed_query', 'rate_limiter')
 
-    def __init__(self, method, uri, headers, get_query, address="127.0.0.1"):
+    def __init__(self, method, uri, headers=None, get_query=None, address="127.0.0.1", version="HTTP/1.1",
+                 header_block=b'', query_string=''):
         self.method = method  # e.g GET, PUT, HEAD
         self.uri = uri  # e.g /index.html
-        self.headers = headers
-        self.get_query = get_query  # eg /couches/?orderby=lowestprice should be: {'orderby': 'lowestprice'}
         self.body = None  # if a PUT/POST request this will contain the raw data
         self.remote_address = address
+        self.version = version  # e.g HTTP/1.0 or HTTP/1.1
+        self.header_block = header_block  # raw header lines starting with a CRLF, decoded on first use
+        self.lowered_block = None
+        self.parsed_headers = None if headers is None else Headers(headers)
+        self.query_string = query_string  # e.g orderby=lowestprice, parsed on first use
+        self.parsed_query = get_query
+        self.rate_limiter = None  # the server's RateLimiter, which a batch charges its sub-requests to
+
+    @property
+    def headers(self):
+        """Headers dict of the request, decoded from the raw header lines the first time it's used.
+        """
+        if self.parsed_headers is None:
+            headers = Headers()
+            for header in self.header_block.split(b'\r\n'):
+                (var, colon, val) = header.partition(b':')  # split header key/value pairs into 2 components
+                if colon:
+                    headers[var.strip().decode('latin-1')] = val.strip().decode('latin-1')
+            self.parsed_headers = headers
+        return self.parsed_headers
+
+    @headers.setter
+    def headers(self, headers):
+        self.parsed_headers = Headers(headers)
+
+    @property
+    def get_query(self):
+        """eg /couches/?orderby=lowestprice gives {'orderby': ['lowestprice']}, parsed the first time it's used.
+        """
+        if self.parsed_query is None:
+            # true keeps any blank values e.g /?egg
+            self.parsed_query = parse_qs(self.query_string, True)
+        return self.parsed_query
+
+    @get_query.setter
+    def get_query(self, get_query):
+        self.parsed_query = get_query
+
+    def header(self, name, default=None):
+        """Case insensitive lookup of a request header value.
+
+        Until the headers dict gets decoded the raw header lines are searched for just this one.
+        """
+        if self.parsed_headers is not None:
+            return self.parsed_headers.get(name, default)
+
+        if self.lowered_block is None:
+            self.lowered_block = self.header_block.lower()
+        key = b'\r\n' + name.lower().encode('latin-1') + b':'
+        start = self.lowered_block.rfind(key)  # the last one wins, as it does in the dict
+        if start < 0:
+            return default
+        start += len(key)
+        end = self.lowered_block.find(b'\r\n', start)
+        return self.header_block[start:end if end >= 0 else len(self.header_block)].strip().decode('latin-1')
+
+    def if_none_match(self, etag):
+        """True if the client's If-None-Match header lists the ETag of its cached copy.
+        """
+        if_none_match = self.header('If-None-Match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    def normalized_query(self):
+        """Hashable form of get_query with the parameters in a consistent order.
+        """
+        return tuple(sorted((name, tuple(values)) for name, values in self.get_query.items()))
+
+    def form(self, max_part_size=None, max_field_size=65536, max_parts=1000, spool_threshold=None):
+        """Parse a multipart/form-data or application/x-www-form-urlencoded body into a FormData.
+
+        On a stream_body route the body is parsed as it arrives, with each file spooled to a
+        temporary file that only touches the disk once it is bigger than spool_threshold.
+        The limits are those of FormParser.
+        """
+        return self.form_parser(max_part_size, max_field_size, max_parts, spool_threshold).form()
+
+    def parts(self, max_part_size=None, max_field_size=65536, max_parts=1000):
+        """Generate the FormParts of a multipart/form-data body to stream each one's content as it arrives.
+        """
+        return self.form_parser(max_part_size, max_field_size, max_parts).parts()
+
+    def form_parser(self, max_part_size=None, max_field_size=65536, max_parts=1000, spool_threshold=None):
+        """FormParser over the body, a RequestBody or the bytes read in before the handler was called.
+        """
+        body = self.body
+        if isinstance(body, RequestBody):
+            read = body.read
+            if spool_threshold is None:
+                spool_threshold = body.spool_threshold
+        else:
+            read = io.BytesIO(body or b'').read
+        return FormParser(read, self.header('Content-Type'), max_part_size=max_part_size,
+                          max_field_size=max_field_size, max_parts=max_parts,
+                          spool_threshold=1048576 if spool_threshold is None else spool_threshold)
+
+    def wants_keep_alive(self):
+        """True if the client is happy for the connection to persist after the response.
+
+        HTTP/1.1 connections persist unless 'Connection: close' is sent,
+        HTTP/1.0 connections only persist when 'Connection: keep-alive' is asked for.
+        """
+        connection = self.header('Connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
 
     def __str__(self):
         """
@@ -50,43 +250,1942 @@ class Request:
             self.get_query)
 
 
-class Response:
+class RequestBody:
+    """File-like stream over a request body as it arrives from the client.
+
+    Routes registered with stream_body=True get one of these as Request.body instead
+    of the whole body in memory. Read it in pieces with read(size)/readinto() or by
+    iterating over it, or call spool() for the full body in a temporary file that
+    only touches the disk once it is bigger than spool_threshold.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, readinto, length, spool_threshold=1048576):
+        """readinto callable filling a writable buffer with the next body bytes, returns the count
+        length Content-Length of the body
+        """
+        self.source = readinto
+        self.length = length
+        self.remaining = length
+        self.spool_threshold = spool_threshold
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) bytes of body into buffer, returns the number read, 0 at the end.
+        """
+        count = min(len(buffer), self.remaining)
+        if count == 0:
+            return 0
+        received = self.source(memoryview(buffer)[:count])
+        if received == 0:
+            raise socket.error("Connection closed part way through the request body")
+        self.remaining -= received
+        return received
+
+    def read(self, size=-1):
+        """Read up to size bytes of body, or all of the rest when size is omitted.
+        """
+        if size is None or size < 0:
+            return b''.join(self)
+
+        data = bytearray(min(size, self.remaining))
+        return bytes(data[:self.readinto(data)])
+
+    def __iter__(self):
+        while self.remaining:
+            yield self.read(self.chunk_size)
+
+    def spool(self):
+        """Read the rest of the body into a SpooledTemporaryFile and return it rewound.
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        for chunk in self:
+            spooled.write(chunk)
+        spooled.seek(0)
+        return spooled
+
+    def discard(self):
+        """Throw away whatever body is left unread.
+        """
+        scratch = bytearray(min(self.chunk_size, self.remaining))
+        while self.remaining:
+            self.readinto(scratch)
+
+
+class FormPart:
+    """One part of a multipart/form-data body.
+
+    name of the form field, filename of an uploaded file (None for a plain field),
+    content_type and headers of the part. While it is the part being parsed its content
+    can be read as it arrives with read(size)/readinto() or by iterating over it.
+    spool() copies it into a temporary file which is then kept as part.file.
+    """
+
+    def __init__(self, parser, name, filename, content_type, headers, limit):
+        self.parser = parser
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.limit = limit  # most content bytes allowed, None for no limit
+        self.size = 0  # content bytes read so far
+        self.done = False
+        self.file = None
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) bytes of content into buffer, returns the number read, 0 at the end.
+        """
+        return self.parser.readinto_part(self, buffer)
+
+    def read(self, size=-1):
+        """Read up to size bytes of content, or all of the rest when size is omitted.
+        """
+        if size is None or size < 0:
+            return b''.join(self)
+        data = bytearray(size)
+        return bytes(data[:self.readinto(data)])
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.parser.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def text(self):
+        """The rest of the content decoded with the charset of its Content-Type, UTF-8 by default.
+        """
+        charset = FormParser.parse_header(self.content_type)[1].get('charset', 'utf-8')
+        try:
+            return self.read().decode(charset, 'replace')
+        except LookupError:
+            raise HttpError(400, 'Bad Request')
+
+    def spool(self, spool_threshold=1048576):
+        """Read the rest of the content into a SpooledTemporaryFile, kept as file and returned rewound.
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        for chunk in self:
+            spooled.write(chunk)
+        spooled.seek(0)
+        self.file = spooled
+        return spooled
+
+    def discard(self):
+        """Throw away whatever content is left unread.
+        """
+        for _ in self:
+            pass
+
+
+class FormData:
+    """Fields and files of a submitted form, see Request.form().
+
+    fields dict of name to the list of its str values, like Request.get_query
+    files dict of name to the list of FormParts uploaded under it, each one's content in part.file
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def get(self, name, default=None):
+        """First value of a field."""
+        values = self.fields.get(name)
+        return values[0] if values else default
+
+    def file(self, name):
+        """First FormPart uploaded under a name, None if there wasn't one."""
+        parts = self.files.get(name)
+        return parts[0] if parts else None
+
+    def close(self):
+        """Close the temporary files of the uploads."""
+        for parts in self.files.values():
+            for part in parts:
+                if part.file is not None:
+                    part.file.close()
+
+
+class FormParser:
+    """Incremental parser for multipart/form-data and application/x-www-form-urlencoded bodies.
+
+    Works through the body a chunk at a time from a read(size) callable such as
+    RequestBody.read so memory use stays flat however large the upload is.
+    A part or field over its limit raises HttpError 413, a malformed body 400
+    and any other Content-Type 415.
+    """
+
+    chunk_size = 65536
+    max_part_header_size = 16384
+
+    def __init__(self, read, content_type, max_part_size=None, max_field_size=65536, max_parts=1000,
+                 spool_threshold=1048576):
+        """
+        read callable returning up to the given number of the next body bytes, b'' at the end
+        content_type Content-Type header of the request
+        max_part_size largest file part, None for no limit
+        max_field_size largest plain field, these are kept in memory
+        max_parts most parts or fields in the body
+        spool_threshold bytes of a file part form() keeps in memory before using disk
+        """
+        self.source = read
+        self.max_part_size = max_part_size
+        self.max_field_size = max_field_size
+        self.max_parts = max_parts
+        self.spool_threshold = spool_threshold
+        self.eof = False
+
+        media_type, params = self.parse_header(content_type or '')
+        if media_type == 'multipart/form-data':
+            boundary = params.get('boundary')
+            if not boundary or len(boundary) > 70:
+                raise HttpError(400, 'Bad Request')
+            self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+            # the first delimiter has no line break in front of it, pretend it does
+            self.buffer = bytearray(b'\r\n')
+        elif media_type == 'application/x-www-form-urlencoded':
+            self.delimiter = None
+            self.buffer = bytearray()
+        else:
+            raise HttpError(415, 'Unsupported Media Type')
+
+    @staticmethod
+    def parse_header(value):
+        """Split a header like Content-Type into its lower cased value and a dict of its parameters.
+        """
+        value, _, rest = value.partition(';')
+        params = {}
+        for match in re.finditer(r'([^=;\s]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)', rest):
+            param = match.group(2).strip()
+            if param.startswith('"'):
+                param = re.sub(r'\\(.)', r'\1', param[1:-1])
+            params[match.group(1).lower()] = param
+        return value.strip().lower(), params
+
+    def fill(self):
+        """Add the next chunk of body to the buffer, False at the end of the body.
+        """
+        if self.eof:
+            return False
+        data = self.source(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def form(self):
+        """Parse the whole body into a FormData, spooling file parts to temporary files as they arrive.
+        """
+        form = FormData()
+        if self.delimiter is None:
+            for name, value in self.fields():
+                form.fields.setdefault(name, []).append(value)
+            return form
+
+        for part in self.parts():
+            if part.filename is None:
+                form.fields.setdefault(part.name, []).append(part.text())
+            else:
+                part.spool(self.spool_threshold)
+                form.files.setdefault(part.name, []).append(part)
+        return form
+
+    def fields(self):
+        """Generate the (name, value) pairs of an application/x-www-form-urlencoded body.
+        """
+        count = 0
+        while True:
+            end = self.buffer.find(b'&')
+            if end < 0:
+                if len(self.buffer) <= self.max_field_size and self.fill():
+                    continue
+                end = len(self.buffer)  # the last field
+                if not end:
+                    return
+            if end > self.max_field_size:
+                raise HttpError(413, 'Payload Too Large')
+            field = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            count += 1
+            if count > self.max_parts:
+                raise HttpError(413, 'Payload Too Large')
+            for name, values in parse_qs(field.decode('latin-1'), True).items():
+                for value in values:
+                    yield name, value
+
+    def parts(self):
+        """Generate the FormParts of a multipart/form-data body in order.
+
+        Read each part before moving on to the next one, whatever is left of it gets skipped.
+        """
+        if self.delimiter is None:
+            raise HttpError(415, 'Unsupported Media Type')
+
+        # skip any preamble before the first delimiter
+        while True:
+            start = self.buffer.find(self.delimiter)
+            if start >= 0:
+                del self.buffer[:start + len(self.delimiter)]
+                break
+            del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+            if not self.fill():
+                raise HttpError(400, 'Bad Request')
+
+        count = 0
+        while True:
+            # a delimiter is followed by -- after the last part, otherwise a line break then the part headers
+            while len(self.buffer) < 2:
+                if not self.fill():
+                    raise HttpError(400, 'Bad Request')
+            if self.buffer[:2] == b'--':
+                while self.fill():
+                    del self.buffer[:]  # ignore the epilogue
+                return
+
+            count += 1
+            if count > self.max_parts:
+                raise HttpError(413, 'Payload Too Large')
+            part = self.read_part_head()
+            yield part
+            part.discard()
+            part.done = True
+            del self.buffer[:len(self.delimiter)]
+
+    def read_part_head(self):
+        """Parse the headers of the part starting in the buffer into a FormPart.
+        """
+        while True:
+            line_end = self.buffer.find(b'\r\n')
+            head_end = self.buffer.find(b'\r\n\r\n', max(line_end, 0))
+            if line_end >= 0 and head_end >= 0:
+                break
+            if len(self.buffer) > self.max_part_header_size or not self.fill():
+                raise HttpError(400, 'Bad Request')
+
+        headers = Headers()
+        for line in bytes(self.buffer[line_end + 2:head_end]).split(b'\r\n'):
+            name, colon, value = line.partition(b':')
+            if colon:
+                headers[name.strip().decode('latin-1')] = value.strip().decode('utf-8', 'replace')
+        del self.buffer[:head_end + 4]
+
+        disposition, params = self.parse_header(headers.get('Content-Disposition', ''))
+        if disposition != 'form-data' or 'name' not in params:
+            raise HttpError(400, 'Bad Request')
+        filename = params.get('filename')
+        limit = self.max_field_size if filename is None else self.max_part_size
+        content_type = headers.get('Content-Type', 'text/plain' if filename is None else 'application/octet-stream')
+        return FormPart(self, params['name'], filename, content_type, headers, limit)
+
+    def readinto_part(self, part, buffer):
+        """Fill buffer with the next content bytes of part, returns the count, 0 at the end of the part.
+        """
+        if part.done:
+            return 0
+        while True:
+            end = self.buffer.find(self.delimiter)
+            if end >= 0:
+                available = end
+                break
+            # the end of the buffer could be the start of a delimiter
+            available = len(self.buffer) - len(self.delimiter) + 1
+            if available > 0:
+                break
+            if not self.fill():
+                raise HttpError(400, 'Bad Request')
+
+        count = min(available, len(buffer))
+        if not count:
+            part.done = end >= 0
+            return 0
+        buffer[:count] = self.buffer[:count]
+        del self.buffer[:count]
+        part.size += count
+        if part.limit is not None and part.size > part.limit:
+            raise HttpError(413, 'Payload Too Large')
+        return count
+
+
+class Response(object):
     """Structure of a HTTP Response destined for the client.
 
     Handlers are responsible for returning a Request to the HttpWorker
     which gets sent to the client.
+    The body can be a str/bytes or, to send it as it is produced, an iterator/generator of
+    str/bytes chunks or a file object. Streamed bodies go out with Transfer-Encoding: chunked
+    unless the handler sets a Content-Length header.
     """
 
+    chunk_size = 65536  # bytes read at a time from file object bodies
+    coalesce_size = 65536  # bodies up to this size are copied onto the head for a single send
+
+    # headers with few distinct values, their encoded lines get cached
+    static_headers = frozenset(['Server', 'Content-Type', 'Access-Control-Allow-Origin', 'Connection',
+                                'Transfer-Encoding'])
+    encoded_status_lines = {}  # (status code, message) to encoded status line
+    encoded_header_lines = {}  # (header, value) to encoded header line
+    max_encoded_lines = 256
+
+    default_headers = Headers({
+        'Server': 'YaHS (Yet another HTTP Server) v1.0',
+        'Content-Type': "text/html",
+        'Access-Control-Allow-Origin': '*'  # ruthless
+    })
+
+    __slots__ = ('status_code', 'status_message', 'headers', 'body', 'bytes_sent', 'trailers')
+
     def __init__(self):
         self.status_code = 200
         self.status_message = "OK"
-        self.headers = {
-            'Server': 'YaHS (Yet another HTTP Server) v1.0',
-            'Content-Type': "text/html",
-            'Access-Control-Allow-Origin': '*'  # ruthless
-        }
+        # a straight copy of the prebuilt defaults rather than building the dict up again
+        self.headers = self.default_headers.copy()
         self.body = b''
+        self.bytes_sent = 0  # counted by send()
+        # headers sent after a chunked body, a value can be a function called once the body is done
+        self.trailers = None
+
+    def copy(self):
+        """Another Response with the same status, headers and (str/bytes) body.
+        """
+        response = Response.__new__(Response)
+        response.status_code = self.status_code
+        response.status_message = self.status_message
+        response.headers = self.headers.copy()
+        response.body = self.body
+        response.bytes_sent = 0
+        response.trailers = None if self.trailers is None else dict(self.trailers)
+        return response
 
-    def send(self, client_socket):
+    def streaming(self):
+        """True when the body is an iterator or file object rather than str/bytes.
+        """
+        return not isinstance(self.body, (str, bytes, bytearray, memoryview))
+
+    def send(self, client_socket, chunked=True):
         """Send the Response to the client socket provided.
 
+        The status line and headers are serialized into one buffer which goes out with
+        the body in a single scatter-gather sendmsg where the socket supports it, else
+        small bodies are copied onto the head so a typical response is one sendall.
+        chunked False when the client can't take Transfer-Encoding: chunked (HTTP/1.0),
+        a streamed body without a Content-Length is then ended by closing the connection.
         This method is called *Internally* and should not be used directly.
         """
-        client_socket.send("HTTP/1.1 {0} {1}\r\n".format(self.status_code, self.status_message).encode('utf-8'))
-        self.headers['Content-Length'] = str(len(self.body))
-        for header in self.headers:
-            client_socket.send((header + ": " + self.headers[header] + "\r\n").encode('utf-8'))
-        client_socket.send(b'\r\n')
-        if type(self.body) is str:
-            self.body = self.body.encode('utf-8')
-        client_socket.send(self.body)
+        if self.streaming():
+            if self.can_sendfile(client_socket):
+                self.prepare(chunked)
+                head = self.encode_head()
+                client_socket.sendall(head)
+                self.bytes_sent += len(head)
+                try:
+                    # zero copy from the file straight to the socket
+                    self.bytes_sent += client_socket.sendfile(self.body, self.body.tell(),
+                                                              int(self.headers['Content-Length']))
+                finally:
+                    self.body.close()
+                return
+
+            for data in self.output(chunked):
+                client_socket.sendall(data)
+                self.bytes_sent += len(data)
+            return
+
+        buffers = self.buffers(chunked)
+        if len(buffers) == 1:
+            client_socket.sendall(buffers[0])
+        elif hasattr(client_socket, 'sendmsg') and not isinstance(client_socket, ssl.SSLSocket):
+            self.sendmsg_all(client_socket, buffers)
+        elif len(self.body) <= self.coalesce_size:
+            client_socket.sendall(buffers[0] + self.body)
+        else:
+            client_socket.sendall(buffers[0])
+            client_socket.sendall(self.body)
+
+    def buffers(self, chunked=True):
+        """The encoded head and body of a str/bytes Response ready to write, counted as sent.
+        """
+        self.prepare(chunked)
+        head = self.encode_head()
+        self.bytes_sent = len(head) + len(self.body)
+        if not self.body:
+            return [head]
+        return [head, self.body]
+
+    def can_sendfile(self, client_socket):
+        """True if the body is a real file of known length going out on a plain socket.
+
+        TLS sockets have to encrypt in user space so they get the body read in chunks instead.
+        """
+        return (hasattr(os, 'sendfile') and hasattr(self.body, 'fileno') and 'Content-Length' in self.headers
+                and isinstance(client_socket, socket.socket) and not isinstance(client_socket, ssl.SSLSocket))
+
+    @staticmethod
+    def sendmsg_all(client_socket, buffers):
+        """Like sendall for a list of buffers, carrying on after partial sends.
+        """
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            sent = client_socket.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent:
+                views[0] = views[0][sent:]
+
+    def prepare(self, chunked=True):
+        """Encode the body and set the framing headers before sending.
+
+        :return: True if a streamed body is to be sent with chunked encoding
+        """
+        if not self.streaming():
+            if type(self.body) is str:
+                self.body = self.body.encode('utf-8')
+            self.headers['Content-Length'] = str(len(self.body))
+            return False
+        elif chunked and 'Content-Length' not in self.headers:
+            self.headers['Transfer-Encoding'] = 'chunked'
+            return True
+        return False
+
+    def encode_head(self):
+        """Serialize the status line and headers into one bytes buffer.
+        """
+        key = (self.status_code, self.status_message)
+        status_line = self.encoded_status_lines.get(key)
+        if status_line is None:
+            status_line = "HTTP/1.1 {0} {1}\r\n".format(self.status_code, self.status_message).encode('utf-8')
+            if len(self.encoded_status_lines) < self.max_encoded_lines:
+                self.encoded_status_lines[key] = status_line
+
+        lines = [status_line]
+        for header in self.headers:
+            lines.append(self.encoded_header(header, self.headers[header]))
+        lines.append(b'\r\n')
+        return b''.join(lines)
+
+    @classmethod
+    def encoded_header(cls, header, value):
+        """Encode a header line, the lines of static_headers are encoded once and cached.
+        """
+        key = (header, value)
+        line = cls.encoded_header_lines.get(key)
+        if line is None:
+            line = (header + ": " + value + "\r\n").encode('utf-8')
+            if header in cls.static_headers and len(cls.encoded_header_lines) < cls.max_encoded_lines:
+                cls.encoded_header_lines[key] = line
+        return line
+
+    def output(self, chunked=True):
+        """Generate the encoded head then the body pieces to write to the client.
+        """
+        chunked = self.prepare(chunked)
+        yield self.encode_head()
+
+        if not self.streaming():
+            yield self.body
+            return
+
+        try:
+            for chunk in self.iter_body():
+                if type(chunk) is str:
+                    chunk = chunk.encode('utf-8')
+                if not chunk:
+                    continue  # an empty chunk would end a chunked body early
+                if chunked:
+                    yield "{:x}\r\n".format(len(chunk)).encode('ascii') + chunk + b'\r\n'
+                else:
+                    yield chunk
+            if chunked:
+                yield b'0\r\n' + self.encode_trailers() + b'\r\n'
+        finally:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+
+    def encode_trailers(self):
+        """Serialize the trailer lines ending a chunked body.
+        """
+        lines = []
+        for name, value in (self.trailers or {}).items():
+            if callable(value):
+                value = value()
+            lines.append((name + ": " + value + "\r\n").encode('utf-8'))
+        return b''.join(lines)
+
+    def collect(self):
+        """Read a streamed body to the end, replacing it with the bytes it produced.
+
+        :return: the body as bytes
+        """
+        if self.streaming():
+            chunks = []
+            try:
+                for chunk in self.iter_body():
+                    chunks.append(chunk.encode('utf-8') if type(chunk) is str else chunk)
+            finally:
+                if hasattr(self.body, 'close'):
+                    self.body.close()
+            self.body = b''.join(chunks)
+        elif type(self.body) is str:
+            self.body = self.body.encode('utf-8')
+        return self.body
+
+    def iter_body(self):
+        """Iterate over the pieces of a streamed body.
+
+        File objects are read up to the Content-Length when there is one, e.g. for a Range.
+        """
+        if hasattr(self.body, 'read'):
+            remaining = int(self.headers.get('Content-Length', -1))
+            while remaining:
+                size = self.chunk_size if remaining < 0 else min(self.chunk_size, remaining)
+                chunk = self.body.read(size)
+                if not chunk:
+                    break
+                remaining -= len(chunk) if remaining > 0 else 0
+                yield chunk
+        else:
+            for chunk in self.body:
+                yield chunk
+
+
+class StaticFiles:
+    """Serves the files under a directory, see Server.static() for registering one.
+
+    Plain HTTP responses go out with os.sendfile, TLS ones are read in chunks.
+    File metadata and ETags are cached for stat_cache_ttl seconds, conditional
+    requests with If-None-Match/If-Modified-Since get 304 and a single byte Range
+    gets a 206 partial response.
+    """
+
+    def __init__(self, directory, max_age=None, stat_cache_ttl=1.0):
+        """directory to serve files from
+        max_age seconds for a Cache-Control max-age header, None to leave it off
+        stat_cache_ttl seconds file metadata is trusted before it is looked up again
+        """
+        self.directory = os.path.realpath(directory)
+        self.max_age = max_age
+        self.stat_cache_ttl = stat_cache_ttl
+        self.metadata_cache = {}  # file path to (expiry time, size, ETag, Last-Modified, mtime)
+
+    def metadata(self, path):
+        """Cached (size, ETag, Last-Modified, mtime) for a regular file or None if there isn't one.
+        """
+        now = time.time()
+        cached = self.metadata_cache.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1:]
+
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):  # ValueError for a path with a NUL byte in it
+            self.metadata_cache.pop(path, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        mtime = int(st.st_mtime)
+        etag = '"{:x}-{:x}"'.format(int(st.st_mtime * 1000000), st.st_size)
+        last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self.metadata_cache[path] = (now + self.stat_cache_ttl, st.st_size, etag, last_modified, mtime)
+        return st.st_size, etag, last_modified, mtime
+
+    def serve(self, request, path):
+        """Static file from the directory. Supports ETag/If-Modified-Since revalidation and byte Ranges.
+        """
+        try:
+            full_path = os.path.realpath(os.path.join(self.directory, unquote(path)))
+        except ValueError:
+            return self.not_found()  # a NUL byte in the path
+        if not full_path.startswith(self.directory + os.sep):
+            return self.not_found()  # no wandering out of the directory with ../
+
+        metadata = self.metadata(full_path)
+        if metadata is None:
+            return self.not_found()
+        size, etag, last_modified, mtime = metadata
+
+        response = Response()
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        if self.max_age is not None:
+            response.headers['Cache-Control'] = 'max-age={}'.format(self.max_age)
+
+        if self.not_modified(request, etag, mtime):
+            response.status_code = 304
+            response.status_message = 'Not Modified'
+            return response
+
+        content_type, encoding = mimetypes.guess_type(full_path)
+        response.headers['Content-Type'] = content_type or 'application/octet-stream'
+
+        start, length = 0, size
+        byte_range = request.header('Range')
+        if byte_range is not None and request.header('If-Range', etag) == etag:
+            parsed = self.parse_range(byte_range, size)
+            if parsed is False:
+                response.status_code = 416
+                response.status_message = 'Range Not Satisfiable'
+                response.headers['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+            if parsed is not None:
+                start, length = parsed
+                response.status_code = 206
+                response.status_message = 'Partial Content'
+                response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, start + length - 1, size)
+
+        try:
+            response.body = open(full_path, 'rb')
+        except IOError:
+            return self.not_found()
+        response.body.seek(start)
+        response.headers['Content-Length'] = str(length)
+        return response
+
+    @staticmethod
+    def not_modified(request, etag, mtime):
+        """True if the client's cached copy is still good.
+        """
+        if request.header('If-None-Match') is not None:
+            return request.if_none_match(etag)
+
+        if_modified_since = request.header('If-Modified-Since')
+        if if_modified_since is not None:
+            parsed = email.utils.parsedate_tz(if_modified_since)
+            if parsed is not None:
+                return mtime <= email.utils.mktime_tz(parsed)
+        return False
+
+    @staticmethod
+    def parse_range(byte_range, size):
+        """Parse a single 'bytes=' Range header.
+
+        :return: (start, length), None to ignore the header and send everything,
+            or False when the range is unsatisfiable
+        """
+        unit, equals, spec = byte_range.partition('=')
+        if unit.strip() != 'bytes' or not equals or ',' in spec:
+            return None  # multiple ranges aren't supported, the whole file is a valid answer
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if not first:
+                # suffix range e.g bytes=-500 for the last 500 bytes
+                length = min(int(last), size)
+                if length <= 0:
+                    return False
+                return size - length, length
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return False
+        end = min(end, size - 1)
+        return start, end - start + 1
+
+    @staticmethod
+    def not_found():
+        response = Response()
+        response.status_code = 404
+        response.status_message = 'Not Found'
+        response.body = "<h1>404 Not Found</h1><p>The server could not find a resource matching your request :(</p>"
+        return response
+
+
+class Compressor:
+    """Compresses response bodies with gzip or deflate for clients sending Accept-Encoding.
+
+    Only bodies of at least min_size bytes with a Content-Type in content_types are
+    compressed. Compressed bodies are kept in a bounded LRU cache keyed by a hash of
+    the body, so hot identical responses are only compressed once whichever routes
+    send them.
+    """
+
+    default_content_types = frozenset(['text/html', 'text/plain', 'text/css', 'text/xml', 'text/javascript',
+                                       'application/json', 'application/javascript', 'application/xml',
+                                       'image/svg+xml'])
+    # zlib window bits giving each content coding's wrapper
+    encodings = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+    def __init__(self, min_size=1024, content_types=None, level=6, cache_entries=256, cache_bytes=16777216):
+        """min_size smallest body worth compressing
+        content_types allowed Content-Type values, defaults to text, json, javascript, xml and svg
+        level zlib compression level 1 (fastest) to 9 (smallest)
+        cache_entries/cache_bytes bounds of the compressed body cache
+        """
+        self.min_size = min_size
+        self.content_types = frozenset(content_types) if content_types else self.default_content_types
+        self.level = level
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+    def compress(self, request, response):
+        """Compress the body of a Response in place if the client accepts it.
+        """
+        if response.status_code != 200 or response.streaming() or 'Content-Encoding' in response.headers:
+            return
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in self.content_types:
+            return
+        if type(response.body) is str:
+            response.body = response.body.encode('utf-8')
+        if len(response.body) < self.min_size:
+            return
+
+        # the response depends on Accept-Encoding whether or not this client gets it compressed
+        response.headers['Vary'] = 'Accept-Encoding'
+        encoding = self.negotiate(request.header('Accept-Encoding'))
+        if encoding is None:
+            return
+
+        etag = response.headers.get('ETag')
+        # an ETag is only unique to one resource, the body itself is what gets compressed
+        key = (encoding, hashlib.sha1(response.body).digest())
+        with self.lock:
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                self.cache[key] = self.cache.pop(key)  # most recently used goes to the end
+
+        if compressed is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.encodings[encoding])
+            compressed = compressor.compress(response.body) + compressor.flush()
+            self.store(key, compressed)
+
+        response.body = compressed
+        response.headers['Content-Encoding'] = encoding
+        if etag and etag.endswith('"'):
+            # a different representation needs its own validator
+            response.headers['ETag'] = etag[:-1] + '-' + encoding + '"'
+
+    def store(self, key, compressed):
+        """Add a compressed body to the cache evicting the least recently used past the bounds.
+        """
+        if len(compressed) > self.cache_bytes:
+            return
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = compressed
+            self.cached_bytes += len(compressed)
+            while len(self.cache) > self.cache_entries or self.cached_bytes > self.cache_bytes:
+                self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+
+    def negotiate(self, accept_encoding):
+        """Pick gzip or deflate from an Accept-Encoding header, None for no compression.
+        """
+        if not accept_encoding:
+            return None
+        preferences = {}
+        for item in accept_encoding.split(','):
+            coding, semicolon, params = item.strip().partition(';')
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            preferences[coding.strip().lower()] = quality
+
+        best = None
+        for coding in ('gzip', 'deflate'):
+            quality = preferences.get(coding, preferences.get('*', 0.0))
+            if quality > 0 and (best is None or quality > best[1]):
+                best = (coding, quality)
+        return best[0] if best else None
+
+
+class ResponseCache:
+    """LRU cache of rendered responses for routes registered with a cache_ttl.
+
+    Entries are keyed by method, uri and the normalized get_query and evicted
+    least recently used first once there are more than max_entries or their
+    bodies add up to more than max_bytes. Cached responses get an ETag so
+    clients revalidating with If-None-Match get a 304.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=67108864):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key to (expiry time, status code, message, headers, body, pattern)
+        self.patterns = {}  # route pattern to the set of keys cached for it
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(request):
+        return request.method, request.uri, request.normalized_query()
+
+    def fetch(self, request):
+        """Get a fresh copy of the cached Response for a Request, None if there isn't a live one.
+        """
+        key = self.key(request)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self.remove(key)
+                return None
+            self.entries[key] = self.entries.pop(key)  # most recently used goes to the end
+
+        expires, status_code, status_message, headers, body, pattern = entry
+        response = Response()
+        response.status_code = status_code
+        response.status_message = status_message
+        response.headers = headers.copy()
+        response.body = body
+        return response
+
+    def store(self, request, response, ttl, pattern):
+        """Cache a successful Response for ttl seconds, giving it an ETag if the handler didn't.
+        """
+        if response.status_code != 200 or response.streaming():
+            return
+        if type(response.body) is str:
+            response.body = response.body.encode('utf-8')
+        body = bytes(response.body)
+        if 'ETag' not in response.headers:
+            response.headers['ETag'] = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if len(body) > self.max_bytes:
+            return
+
+        key = self.key(request)
+        entry = (time.time() + ttl, response.status_code, response.status_message, Headers(response.headers), body,
+                 pattern)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.patterns.setdefault(pattern, set()).add(key)
+            self.size += len(body)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Drop an entry, the lock must be held.
+        """
+        entry = self.entries.pop(key)
+        self.size -= len(entry[4])
+        keys = self.patterns.get(entry[5])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.patterns[entry[5]]
+
+    def invalidate(self, pattern=None, uri=None, method='GET'):
+        """Drop cached responses.
+
+        pattern drops everything cached for the route registered with that url pattern
+        uri drops the responses for that uri whatever the query string
+        with neither the whole cache is cleared
+        returns the number of entries dropped
+        """
+        with self.lock:
+            if pattern is None and uri is None:
+                keys = list(self.entries)
+            elif pattern is not None:
+                keys = list(self.patterns.get(pattern, ()))
+            else:
+                keys = [key for key in self.entries if key[0] == method and key[1] == uri]
+            for key in keys:
+                self.remove(key)
+        return len(keys)
+
+    @staticmethod
+    def not_modified(request, response):
+        """Turn a Response into a 304 Not Modified if the client already has it.
+
+        A client may hold a compressed copy, whose ETag the Compressor gave an -gzip/-deflate suffix.
+        """
+        etag = response.headers.get('ETag')
+        if etag is None:
+            return response
+        variants = [etag]
+        if etag.endswith('"'):
+            variants.extend(etag[:-1] + '-' + encoding + '"' for encoding in Compressor.encodings)
+        for variant in variants:
+            if request.if_none_match(variant):
+                not_modified = Response()
+                not_modified.status_code = 304
+                not_modified.status_message = 'Not Modified'
+                not_modified.headers = Headers(response.headers)
+                not_modified.headers.pop('Content-Length', None)
+                not_modified.headers['ETag'] = variant  # the validator of the copy the client has
+                return not_modified
+        return response
+
+
+class Coalescer:
+    """Single flight calls for routes registered with coalesce=True.
+
+    Concurrent requests with the same method, uri and query string wait for the
+    first one's handler call rather than making their own, then each gets a copy
+    of its Response. An error raised by the handler is logged once and every
+    waiter gets a 500 Internal Server Error.
+    """
+
+    class Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.response = None
+
+    def __init__(self):
+        self.flights = {}  # request key to the Flight of the handler call in progress
+        self.lock = threading.Lock()
+
+    def call(self, request, respond, timeout=None):
+        """Get the Response for a request from respond(), unless an identical request is already calling it.
+
+        timeout seconds to wait for another request's call before giving up with a 504
+        """
+        key = ResponseCache.key(request)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = self.Flight()
+
+        if leader:
+            try:
+                try:
+                    response = respond()
+                except Exception:
+                    logging.exception("Error in the coalesced call to %s %s", request.method, request.uri)
+                    response = HttpError(500, 'Internal Server Error').response()
+                if not response.streaming():
+                    # a copy nobody sends, the leader's own one gets compressed and encoded in place
+                    flight.response = response.copy()
+                return response
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+
+        if not flight.done.wait(timeout):
+            logging.warning("Gave up waiting %s seconds for the coalesced call to %s", timeout, request.uri)
+            return HttpError(504, 'Gateway Timeout').response()
+        if flight.response is None:
+            return respond()  # a streamed body can only be sent once
+        return flight.response.copy()
+
+
+class TlsContext:
+    """Shared ssl.SSLContext for secure listeners, reloaded when the certificate or key file changes.
+
+    Accepted connections are wrapped without handshaking so the worker does the handshake
+    rather than the accept loop. Session tickets stay enabled so returning clients can
+    resume their session instead of doing a full handshake.
+    """
+
+    def __init__(self, certfile, keyfile=None, reload_interval=5.0):
+        """
+        certfile PEM certificate chain, may also hold the private key
+        keyfile PEM private key, None when it's in the certfile
+        reload_interval seconds between checking the files for changes, None to never reload
+        """
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.stamp = self.file_stamp()
+        self.checked = time.time()
+        self.current = self.create()
+
+    def file_stamp(self):
+        return tuple(os.stat(path).st_mtime for path in (self.certfile, self.keyfile) if path)
+
+    def create(self):
+        """Make a server side SSLContext from the certificate and key files.
+        """
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(self.certfile, self.keyfile)
+        context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+        if hasattr(context, 'sni_callback'):
+            context.sni_callback = self.switch_context
+        return context
+
+    def context(self):
+        """The SSLContext for new connections, every reload_interval checks if the files have changed.
+        """
+        if self.reload_interval is not None and time.time() - self.checked >= self.reload_interval:
+            with self.lock:
+                self.checked = time.time()
+                try:
+                    stamp = self.file_stamp()
+                except OSError:
+                    stamp = self.stamp  # part way through being replaced, try again next time
+                if stamp != self.stamp and self.reload():
+                    self.stamp = stamp
+        return self.current
+
+    def reload(self):
+        """Load the certificate and key files again, new connections get the new context.
+
+        :return: False if they couldn't be loaded, the previous context is kept
+        """
+        try:
+            context = self.create()
+        except (IOError, ssl.SSLError) as err:
+            logging.warning("Could not reload SSL certificate, keeping the previous one: %s", err)
+            return False
+        logging.info("Reloaded SSL certificate %s", self.certfile)
+        self.current = context
+        return True
+
+    def wrap(self, client_socket):
+        """Wrap an accepted socket leaving the handshake for whoever reads from it.
+        """
+        return self.context().wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+
+    def switch_context(self, ssl_socket, server_name, context):
+        """sni_callback moving a handshake begun with an outdated context over to the current one.
+
+        Lets the asyncio engine, which holds on to the context it started with, pick up reloads.
+        """
+        current = self.context()
+        if current is not context:
+            ssl_socket.context = current
+
+
+class ConnectionLimit:
+    """Counts open connections so the listener can shed those beyond max_connections.
+
+    Rejected connections get a canned 503 with a Retry-After header written without
+    blocking, so an overloaded server answers straight away rather than queueing them.
+    """
+
+    def __init__(self, max_connections=None, retry_after=1):
+        """
+        max_connections most connections open at once, None for no limit
+        retry_after seconds clients are told to wait before trying again
+        """
+        self.max_connections = max_connections
+        self.retry_after = retry_after
+        self.active = 0
+        self.lock = threading.Lock()
+
+        response = Response()
+        response.status_code = 503
+        response.status_message = 'Service Unavailable'
+        response.headers['Retry-After'] = str(retry_after)
+        response.headers['Connection'] = 'close'
+        response.body = "<h1>503 Service Unavailable</h1><p>The server is overloaded, try again shortly</p>"
+        self.rejection = b''.join(response.output(False))
+
+    def acquire(self):
+        """Count a new connection.
+
+        :return: False if it's over the limit and should be rejected
+        """
+        with self.lock:
+            if self.max_connections is not None and self.active >= self.max_connections:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def reject(self, client_socket, secure=False):
+        """Send the 503 if it fits in the socket buffer and hang up, never blocking the caller.
+
+        secure True for a connection still waiting on its TLS handshake, which is just closed
+            since the client would take a plain text 503 for a broken handshake
+        """
+        Server.metrics.connection_rejected()
+        try:
+            if not secure and not isinstance(client_socket, ssl.SSLSocket):
+                client_socket.setblocking(False)
+                client_socket.send(self.rejection)
+                client_socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        finally:
+            client_socket.close()
+
+
+class RateLimiter:
+    """Token bucket rate limits and concurrency caps per client, checked before the handler runs.
+
+    Each client gets a bucket of burst tokens refilled at rate per second, a request
+    takes one and is rejected with a 429 and a Retry-After header when the bucket is
+    empty or max_concurrent of the client's requests are already being handled.
+    Buckets are spread over shards, each with its own lock, so threads rarely wait on each other.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrent=None, key=None, per_route=False, shards=16,
+                 max_clients=100000):
+        """
+        rate requests per second a client may make on average, None for no rate limit
+        burst requests a client may make at once after being idle, defaults to rate
+        max_concurrent requests of a client being handled at once, None for no cap
+        key what identifies a client: None for its address, a header name such as 'X-Api-Key'
+            (falling back to the address when it's missing) or a function of the Request
+        per_route True for a client to get separate buckets for each route pattern
+        shards number of independently locked parts of the bucket store
+        max_clients buckets kept, past that the least recently seen client's is dropped
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.max_concurrent = max_concurrent
+        self.key = key
+        self.per_route = per_route
+        self.max_bucket_count = max(1, max_clients // shards)
+        self.shards = [(threading.Lock(), collections.OrderedDict()) for _ in range(shards)]
+
+    @staticmethod
+    def admit(limiters, request, route):
+        """Acquire the request from each of the limiters that aren't None.
+
+        :return: the (limiter, key) pairs to release() once the handler is done
+        :raises HttpError: 429 when a limit is hit, nothing is left acquired
+        """
+        admitted = []
+        try:
+            for limiter in limiters:
+                if limiter is not None:
+                    admitted.append((limiter, limiter.acquire(request, route)))
+        except HttpError:
+            RateLimiter.release_all(admitted)
+            raise
+        return admitted
+
+    @staticmethod
+    def release_all(admitted):
+        for limiter, key in admitted:
+            limiter.release(key)
+
+    def client_key(self, request):
+        """The client a request is counted against.
+        """
+        key = None
+        if callable(self.key):
+            key = self.key(request)
+        elif self.key is not None:
+            key = request.header(self.key)
+        if key is None:
+            address = request.remote_address
+            key = address[0] if isinstance(address, tuple) else address
+        return key
+
+    def acquire(self, request, route=None):
+        """Take a token and a concurrency slot from the client's bucket.
+
+        :return: the bucket key to release() when the request is done
+        :raises HttpError: 429 Too Many Requests with a Retry-After header
+        """
+        key = self.client_key(request)
+        if self.per_route:
+            key = (key, route)
+        lock, buckets = self.shards[hash(key) % len(self.shards)]
+        now = time.time()
+        with lock:
+            bucket = buckets.pop(key, None)
+            if bucket is None:
+                if len(buckets) >= self.max_bucket_count:
+                    buckets.popitem(last=False)
+                bucket = [self.burst, now, 0]  # tokens, when they were counted, requests active
+            elif self.rate:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            buckets[key] = bucket  # most recently seen goes to the end
+
+            if self.max_concurrent is not None and bucket[2] >= self.max_concurrent:
+                retry_after = 1
+            elif self.rate and bucket[0] < 1:
+                retry_after = int(math.ceil((1 - bucket[0]) / self.rate))
+            else:
+                if self.rate:
+                    bucket[0] -= 1
+                bucket[2] += 1
+                return key
+
+        logging.info("Rate limiting %s", key)
+        raise HttpError(429, 'Too Many Requests', {'Retry-After': str(retry_after)})
+
+    def release(self, key):
+        """Give back the concurrency slot of a request acquire() let through.
+        """
+        lock, buckets = self.shards[hash(key) % len(self.shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket[2] -= 1
+                if not self.rate and not bucket[2]:
+                    del buckets[key]  # nothing left worth remembering
+
+
+class Metrics:
+    """Request counters, in flight gauges, byte counts and latency histograms by route.
+
+    Requests are labelled with their method and the url pattern of the route they
+    matched. All a request records is added in one go when it finishes so the lock
+    is taken once per request. render() gives the Prometheus text format.
+    """
+
+    # histogram bucket upper bounds in seconds
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # phases of the request lifecycle which get timed
+    phases = ('accept', 'parse', 'dispatch', 'handler', 'send')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (method, route, status) to requests handled
+        self.in_flight = {}  # (method, route) to requests being handled
+        self.received = {}  # (method, route) to request bytes received
+        self.sent = {}  # (method, route) to response bytes sent
+        self.histograms = {}  # (phase, method, route) to bucket counts, the last one past all buckets
+        self.sums = {}  # (phase, method, route) to total seconds
+        self.connections = 0
+        self.rejected = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def connection_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def begin(self, method, route):
+        """Count a request as in flight once its route is known.
+        """
+        key = (method, route)
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def end(self, method, route, status, received, sent, timings):
+        """Record a finished request.
+
+        timings list of (phase, seconds) pairs
+        """
+        key = (method, route)
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 1) - 1
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            self.received[key] = self.received.get(key, 0) + received
+            self.sent[key] = self.sent.get(key, 0) + sent
+            for phase, seconds in timings:
+                self.observe((phase,) + key, seconds)
+
+    def observe(self, key, seconds):
+        counts = self.histograms.get(key)
+        if counts is None:
+            counts = self.histograms[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sums[key] = self.sums.get(key, 0.0) + seconds
+
+    @staticmethod
+    def labels(**labels):
+        return '{' + ','.join('{}="{}"'.format(name, str(labels[name]).replace('\\', '\\\\')
+                                               .replace('"', '\\"').replace('\n', '\\n'))
+                              for name in sorted(labels)) + '}'
+
+    def render(self):
+        """The metrics in Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# HELP yahs_connections_open Client connections currently open.',
+                     '# TYPE yahs_connections_open gauge',
+                     'yahs_connections_open {}'.format(self.connections),
+                     '# HELP yahs_connections_rejected_total Connections shed with a 503 for being over max_connections.',
+                     '# TYPE yahs_connections_rejected_total counter',
+                     'yahs_connections_rejected_total {}'.format(self.rejected),
+                     '# HELP yahs_requests_total Requests handled by route and status.',
+                     '# TYPE yahs_requests_total counter']
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append('yahs_requests_total{} {}'.format(self.labels(method=method, route=route, status=status),
+                                                               count))
+
+            for name, description, kind, values in (
+                    ('yahs_requests_in_flight', 'Requests being handled by route.', 'gauge', self.in_flight),
+                    ('yahs_request_bytes_total', 'Request bytes received by route.', 'counter', self.received),
+                    ('yahs_response_bytes_total', 'Response bytes sent by route.', 'counter', self.sent)):
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for (method, route), value in sorted(values.items()):
+                    lines.append('{}{} {}'.format(name, self.labels(method=method, route=route), value))
+
+            lines.append('# HELP yahs_phase_seconds Time spent in each phase of the request lifecycle by route.')
+            lines.append('# TYPE yahs_phase_seconds histogram')
+            for (phase, method, route), counts in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('yahs_phase_seconds_bucket{} {}'.format(
+                        self.labels(phase=phase, method=method, route=route, le=bound), cumulative))
+                labels = self.labels(phase=phase, method=method, route=route)
+                lines.append('yahs_phase_seconds_sum{} {}'.format(labels, self.sums[(phase, method, route)]))
+                lines.append('yahs_phase_seconds_count{} {}'.format(labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class AccessLog:
+    """Access log written by a background thread so request threads never wait on log I/O.
+
+    Each request queues a tuple of the fields to log and the writer thread formats
+    whatever has queued up in one batch, as Common Log Format, Combined Log Format or
+    JSON lines with the bytes sent and duration. Without a stream nothing gets queued
+    or formatted unless the yahs.access logger is enabled for INFO.
+    """
+
+    formats = ('common', 'combined', 'json')
+
+    def __init__(self, log_format='common', stream=None, sample_rate=1.0, batch_size=256, queue_size=65536):
+        """
+        log_format 'common', 'combined' or 'json'. The duration in milliseconds goes on the end of
+            common and combined lines.
+        stream file object batches of lines get written to, by default each line is logged to yahs.access
+        sample_rate fraction of the successful (< 400) requests to log, errors are always logged
+        batch_size most lines formatted and written at a time
+        queue_size most requests waiting to be logged, past that they're dropped rather than wait
+        """
+        if log_format not in self.formats:
+            raise ValueError("Unknown access log format {}".format(log_format))
+        self.log_format = log_format
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.logger = logging.getLogger('yahs.access')
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def log(self, request, response, duration):
+        """Queue a finished request for the writer thread.
+
+        duration seconds from the request arriving to the response being sent
+        """
+        if self.stream is None and not self.logger.isEnabledFor(logging.INFO):
+            return
+        status = response.status_code
+        if self.sample_rate < 1 and int(status) < 400 and random.random() >= self.sample_rate:
+            return
+
+        if request is None:
+            entry = (time.time(), None, '-', '-', '', '-', status, response.bytes_sent, duration, None, None)
+        else:
+            referer = agent = None
+            if self.log_format != 'common':
+                referer, agent = request.header('Referer'), request.header('User-Agent')
+            entry = (time.time(), request.remote_address, request.method, request.uri, request.query_string,
+                     request.version, status, response.bytes_sent, duration, referer, agent)
+
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write, name="yahs-access-log")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def write(self):
+        """Writer thread loop, takes everything queued up to batch_size at a time.
+        """
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception:
+                logging.exception("Could not write the access log")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write_batch(self, batch):
+        lines = [self.format(entry) for entry in batch]
+        if self.stream is None:
+            for line in lines:
+                self.logger.info(line)
+        else:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+    def format(self, entry):
+        """Format a queued entry as a line of the log.
+        """
+        (logged, address, method, uri, query, version, status, sent, duration, referer, agent) = entry
+        host = address[0] if isinstance(address, tuple) else (address or '-')
+        target = uri + '?' + query if query else uri
+        if self.log_format == 'json':
+            return json.dumps({
+                'time': logged,
+                'remote_addr': host,
+                'method': method,
+                'uri': target,
+                'version': version,
+                'status': status,
+                'bytes_sent': sent,
+                'duration_ms': round(duration * 1000, 3),
+                'referer': referer,
+                'user_agent': agent
+            })
+
+        line = '{} - - [{}] "{} {} {}" {} {}'.format(
+            host, time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(logged)), method,
+            target.replace('"', '\\"'), version, status, sent or '-')
+        if self.log_format == 'combined':
+            line += ' "{}" "{}"'.format((referer or '-').replace('"', '\\"'), (agent or '-').replace('"', '\\"'))
+        return line + ' {:.3f}'.format(duration * 1000)
+
+    def flush(self, timeout=5.0):
+        """Wait up to timeout seconds for the queued requests to be written.
+        """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class Profiler:
+    """Samples handler calls with cProfile for a while, aggregating their pstats.
+
+    Switched on by the /yahs/profile route for a percentage of requests, or just
+    those to one route pattern, so a slow handler can be looked at in a running server.
+    One call is profiled at a time, from Python 3.12 a process can only have one cProfile
+    running, so a sampled request arriving while another is profiled just runs as usual.
+    """
+
+    # longest a profile may run, it holds a worker thread the whole time
+    max_seconds = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampling = threading.Lock()  # held by the call being profiled
+        self.until = 0  # time profiling stops
+        self.percent = 100
+        self.pattern = None
+        self.stats = None
+        self.profiled = 0
+
+    def start(self, seconds, percent=100, pattern=None):
+        """Profile percent of the requests, to routes with the url pattern if given, for seconds.
+
+        :return: False if already profiling
+        """
+        with self.lock:
+            if self.active():
+                return False
+            self.stats = None
+            self.profiled = 0
+            self.percent = percent
+            self.pattern = pattern
+            self.until = time.time() + seconds
+            return True
+
+    def stop(self):
+        self.until = 0
+
+    def active(self):
+        return time.time() < self.until
+
+    def sample(self, pattern):
+        """True if a request to the route with the url pattern should be profiled.
+        """
+        if not self.active() or (self.pattern is not None and pattern != self.pattern):
+            return False
+        return self.percent >= 100 or random.random() * 100 < self.percent
+
+    def runcall(self, func, *args, **kwargs):
+        """Call func under cProfile and add its stats to the aggregate.
+
+        func is called unprofiled when another call is being profiled or cProfile can't start.
+        """
+        if not self.sampling.acquire(False):
+            return func(*args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return func(*args, **kwargs)  # some other profiler is running in the process
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    self.profiled += 1
+        finally:
+            self.sampling.release()
+
+    def report(self, sort='cumulative', limit=50):
+        """The aggregated pstats output as text.
+        """
+        with self.lock:
+            if self.stats is None:
+                return "No requests were profiled\n"
+            stream = StringIO()
+            self.stats.stream = stream
+            stream.write("{} requests profiled\n".format(self.profiled))
+            self.stats.sort_stats(sort).print_stats(limit)
+            return stream.getvalue()
+
+
+class Batch:
+    """Runs the sub-requests POSTed to /yahs/batch through the registered handlers in process.
+
+    Clients making many small calls send them as one JSON array of
+    {"method", "uri", "headers", "body"} objects and get back one JSON array of
+    {"status", "headers", "body"} results in the same order, paying for the round
+    trip, connection and handshake once. Runs of GET, HEAD and OPTIONS sub-requests
+    are handled in parallel, anything else waits for those before it to finish.
+    """
+
+    # request headers sub-requests don't inherit from the batch request
+    framing_headers = frozenset(['content-length', 'content-type', 'transfer-encoding', 'connection', 'expect'])
+
+    def __init__(self, max_requests=50, max_parallel=8):
+        """
+        max_requests most sub-requests in one batch, more gets a 413
+        max_parallel most sub-requests of one batch handled at once
+        """
+        self.max_requests = max_requests
+        self.max_parallel = max_parallel
+
+    def handle(self, request):
+        """Parse the batch out of the request body, handle it and make the combined Response.
+        """
+        try:
+            batch = json.loads(bytes(request.body or b'').decode('utf-8'))
+        except ValueError:
+            raise HttpError(400, 'Bad Request')
+        if not isinstance(batch, list) or not all(isinstance(item, dict) for item in batch):
+            raise HttpError(400, 'Bad Request')
+        if len(batch) > self.max_requests:
+            raise HttpError(413, 'Payload Too Large')
+
+        results = self.run([self.sub_request(request, item) for item in batch])
+        response = Response()
+        response.headers['Content-Type'] = 'application/json'
+        response.body = json.dumps(results)
+        return response
+
+    def sub_request(self, request, item):
+        """Make the Request for one item of the batch, None if it isn't valid.
+
+        It inherits the batch request's headers, e.g Authorization, apart from those framing the body.
+        """
+        method = item.get('method', 'GET')
+        uri = item.get('uri')
+        headers = item.get('headers') or {}
+        if not isinstance(method, str) or not isinstance(uri, str) or not isinstance(headers, dict):
+            return None
+
+        merged = Headers((name, value) for name, value in request.headers.items()
+                         if name.lower() not in self.framing_headers)
+        merged.update(headers)
+        body = item.get('body')
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)  # a JSON value rather than text
+            merged.setdefault('Content-Type', 'application/json')
+        if body is not None:
+            body = bytearray(body.encode('utf-8'))
+            merged['Content-Length'] = str(len(body))
+
+        path, question, query = uri.partition('?')
+        sub = Request(method.upper(), path, headers=merged, address=request.remote_address,
+                      version=request.version, query_string=query)
+        sub.body = body
+        sub.rate_limiter = request.rate_limiter
+        return sub
+
+    def run(self, requests):
+        """Handle the sub-requests, returning their results in order.
+        """
+        results = [None] * len(requests)
+        running = []  # (index, PipelinedCall) of the safe run in progress
+        max_parallel = self.max_parallel
+        limiter = next((sub.rate_limiter for sub in requests if sub is not None), None)
+        if limiter is not None and limiter.max_concurrent is not None:
+            max_parallel = min(max_parallel, limiter.max_concurrent)  # don't go over the client's own cap
+        for index, sub in enumerate(requests):
+            if sub is None:
+                results[index] = self.result(HttpError(400, 'Bad Request').response())
+                continue
+            if sub.method in HttpWorker.safe_methods and len(running) < max_parallel:
+                running.append((index, HttpWorker.PipelinedCall(functools.partial(self.respond, sub))))
+                continue
+            self.collect(running, results)
+            results[index] = self.respond(sub)
+        self.collect(running, results)
+        return results
+
+    @staticmethod
+    def collect(running, results):
+        """Wait for the parallel calls in progress and put their results in place.
+        """
+        for index, call in running:
+            results[index] = call.result()
+        del running[:]
+
+    def respond(self, sub):
+        """Route a sub-request to its handler and turn its Response into a result.
+        """
+        found = HttpWorker.find_handler(sub)
+        if not isinstance(found, Response):
+            if found[0] is batch_requests:
+                return self.result(HttpError(400, 'Bad Request').response())  # no batches of batches
+            if found[2]['stream_body']:
+                body = sub.body or b''
+                sub.body = RequestBody(io.BytesIO(body).readinto, len(body))
+        try:
+            return self.result(HttpWorker.handle_request(sub, found, sub.rate_limiter))
+        except Exception:
+            logging.exception("Error handling batched %s %s", sub.method, sub.uri)
+            return self.result(HttpError(500, 'Internal Server Error').response())
+
+    @staticmethod
+    def result(response):
+        """JSON result of a sub-request's Response, a body that isn't UTF-8 text gets base64 encoded.
+        """
+        body = response.collect()
+        result = {'status': response.status_code, 'headers': dict(response.headers)}
+        try:
+            result['body'] = bytes(body).decode('utf-8')
+        except UnicodeDecodeError:
+            result['body'] = base64.b64encode(body).decode('ascii')
+            result['encoding'] = 'base64'
+        return result
+
+
+class WsgiApp:
+    """WSGI application serving the handlers registered with Server.handle.
+
+    Runs them under wsgiref or any other WSGI server instead of ListenerThread/HttpWorker, e.g
+        from wsgiref.simple_server import make_server
+        make_server('', 8000, WsgiApp()).serve_forever()
+    The WSGI server takes care of the connections, access log and the like.
+    """
+
+    # hop by hop headers a WSGI application mustn't set
+    hop_by_hop_headers = frozenset(['connection', 'keep-alive', 'transfer-encoding', 'trailer', 'upgrade'])
+
+    def __init__(self, max_body_size=None, rate_limit=None):
+        """
+        max_body_size largest request body accepted, larger gets 413. None for no limit.
+        rate_limit a RateLimiter applied to every route, as for Server
+        """
+        self.max_body_size = max_body_size
+        self.rate_limiter = rate_limit
+
+    def __call__(self, environ, start_response):
+        try:
+            response = self.respond(environ)
+        except HttpError as err:
+            response = err.response()
+
+        response.prepare(False)  # the WSGI server frames the body
+        status = "{0} {1}".format(response.status_code, response.status_message)
+        start_response(status, [(name, response.headers[name]) for name in response.headers
+                                if name.lower() not in self.hop_by_hop_headers])
+        if not response.streaming():
+            return [response.body]
+        return self.iter_body(response)
+
+    def respond(self, environ):
+        """Make the Request from the WSGI environ and get its Response.
+        """
+        headers = Headers()
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                headers[key[5:].replace('_', '-').title()] = value
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                headers[key.replace('_', '-').title()] = value
+        address = (environ.get('REMOTE_ADDR', ''), int(environ.get('REMOTE_PORT') or 0))
+        request = Request(environ['REQUEST_METHOD'], self.path(environ), headers=headers, address=address,
+                          version=environ.get('SERVER_PROTOCOL', 'HTTP/1.1'),
+                          query_string=environ.get('QUERY_STRING', ''))
+
+        found = HttpWorker.find_handler(request)
+        if isinstance(found, Response):
+            return found
+        max_body_size = found[2]['max_body_size']
+        if max_body_size is None:
+            max_body_size = self.max_body_size
+        content_length = HttpWorker.content_length(request, max_body_size)
+        stream = environ['wsgi.input']
+        if found[2]['stream_body']:
+            def readinto(view):
+                data = stream.read(len(view))
+                view[:len(data)] = data
+                return len(data)
+            request.body = RequestBody(readinto, content_length)
+        elif content_length:
+            request.body = bytearray(stream.read(content_length))
+        return HttpWorker.handle_request(request, found, self.rate_limiter)
+
+    @staticmethod
+    def path(environ):
+        """The path as the client sent it, which routes match rather than the decoded PATH_INFO.
+
+        Servers such as gunicorn and uWSGI pass on the raw request target as RAW_URI or REQUEST_URI,
+        otherwise PATH_INFO is quoted again from the bytes it was decoded from.
+        """
+        script_name = environ.get('SCRIPT_NAME', '')
+        raw = (environ.get('RAW_URI') or environ.get('REQUEST_URI') or '').partition('?')[0]
+        if raw.startswith(script_name + '/'):
+            return raw[len(script_name):]
+        path = environ.get('PATH_INFO', '') or '/'
+        if not isinstance(path, bytes):
+            path = path.encode('latin-1')  # a WSGI native string holds the bytes as latin-1
+        return quote(path, safe="/;=,@:!$&'()*+~")
+
+    @staticmethod
+    def iter_body(response):
+        """Encoded pieces of a streamed body, the WSGI server closing the iterator closes the body.
+        """
+        try:
+            for chunk in response.iter_body():
+                yield chunk.encode('utf-8') if type(chunk) is str else chunk
+        finally:
+            if hasattr(response.body, 'close'):
+                response.body.close()
+
+
+class TestClient:
+    """Calls the handlers registered with Server.handle in process, no sockets involved.
+
+    For tests and microbenchmarks of handler logic, e.g
+        client = TestClient()
+        response = client.get('/products/?orderby=price')
+        response.status_code, response.headers['Content-Type'], response.body
+    The Response body is always bytes, streamed ones having been read to the end.
+    """
+    __test__ = False  # not a test case itself
+
+    def __init__(self, headers=None, address=('127.0.0.1', 0), rate_limit=None):
+        """
+        headers dict of headers sent with every request
+        address the client address requests come from
+        rate_limit a RateLimiter applied to every route, as for Server
+        """
+        self.headers = Headers(headers or {})
+        self.address = address
+        self.rate_limiter = rate_limit
+
+    def request(self, method, uri, body=None, headers=None):
+        """Make a request, uri may have a query string. body str or bytes.
+
+        returns the Response
+        """
+        merged = self.headers.copy()
+        merged.update(headers or {})
+        if type(body) is str:
+            body = body.encode('utf-8')
+        if body is not None:
+            merged['Content-Length'] = str(len(body))
+        path, question, query = uri.partition('?')
+        request = Request(method, path, headers=merged, address=self.address, query_string=query)
+        response = HttpWorker.dispatch(request, body, self.rate_limiter)
+        response.collect()
+        return response
+
+    def get(self, uri, headers=None):
+        return self.request('GET', uri, headers=headers)
+
+    def post(self, uri, body=None, headers=None):
+        return self.request('POST', uri, body, headers)
+
+    def put(self, uri, body=None, headers=None):
+        return self.request('PUT', uri, body, headers)
+
+    def delete(self, uri, headers=None):
+        return self.request('DELETE', uri, headers=headers)
+
+
+class HttpError(Exception):
+    """Raised while processing a request to send an error status back to the client.
+
+    headers optional dict of extra headers for the error response, e.g Retry-After
+    """
+
+    def __init__(self, status_code, status_message, headers=None):
+        super(HttpError, self).__init__(status_code, status_message)
+        self.status_code = status_code
+        self.status_message = status_message
+        self.headers = headers
+
+    def response(self):
+        """Make the error Response destined for the client.
+        """
+        response = Response()
+        response.status_code = self.status_code
+        response.status_message = self.status_message
+        if self.headers:
+            response.headers.update(self.headers)
+        response.body = "<h1>{} {}</h1>".format(self.status_code, self.status_message)
+        return response
 
 
 class HttpWorker(threading.Thread):
     """Process all the HTTP protocol work here in a Thread.
-    :param: args expects (client_socket, client_address) from socket.accept() call
+    :param: args expects (client_socket, client_address) from socket.accept() call, optionally
+        followed by the time it was accepted
+    :param: kwargs optional connection settings keep_alive_timeout, max_keep_alive_requests,
+        max_header_size, max_body_size, spool_threshold, compressor, handshake_timeout,
+        header_timeout, body_timeout, write_timeout, connection_limit, server_timing, access_log,
+        pipeline_depth and rate_limiter
     """
 
+    # most unread streamed body left by a handler that gets discarded to keep the connection open
+    max_discard_size = 65536
+    # methods of pipelined requests that can be handled ahead of their turn, they don't change anything
+    safe_methods = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    # most buffers of pipelined responses held back to go out in one send
+    max_pending_writes = 64
+
+    class PipelinedCall(threading.Thread):
+        """Calls the handler of a pipelined request while the requests ahead of it are answered.
+        """
+
+        def __init__(self, respond):
+            super(HttpWorker.PipelinedCall, self).__init__(name="yahs-pipelined")
+            self.daemon = True
+            self.respond = respond
+            self.response = None
+            self.error = None
+            self.start()
+
+        def run(self):
+            try:
+                self.response = self.respond()
+            except Exception as err:
+                self.error = err
+
+        def result(self):
+            """Wait for the Response, raising whatever the handler raised.
+            """
+            self.join()
+            if self.error is not None:
+                raise self.error
+            return self.response
+
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
         # call 'super' constructor to init thread
         super(HttpWorker, self).__init__(group=group, target=target, name=name, args=args, kwargs=kwargs)
@@ -95,107 +2194,581 @@ class HttpWorker(threading.Thread):
         self.keep_running = True
         self.client_socket = args[0]
         self.client_address = args[1]
+        self.accepted = args[2] if len(args) > 2 else time.time()
+
+        if kwargs is None:
+            kwargs = {}
+        # seconds an idle persistent connection waits for its next request
+        self.keep_alive_timeout = kwargs.get('keep_alive_timeout', 5.0)
+        # requests served on one connection before it gets closed
+        self.max_keep_alive_requests = kwargs.get('max_keep_alive_requests', 100)
+        # largest request line plus headers, also the size of the receive buffer
+        self.max_header_size = kwargs.get('max_header_size', 65536)
+        # largest request body accepted, None for no limit
+        self.max_body_size = kwargs.get('max_body_size')
+        # streamed bodies spooled by RequestBody.spool() go to disk past this size
+        self.spool_threshold = kwargs.get('spool_threshold', 1048576)
+        # Compressor for responses, None to send them as they are
+        self.compressor = kwargs.get('compressor')
+        # seconds a secure connection gets to complete the TLS handshake
+        self.handshake_timeout = kwargs.get('handshake_timeout', 10.0)
+        # seconds a client gets to send the request line and headers once it starts a request
+        self.header_timeout = kwargs.get('header_timeout', 10.0)
+        # seconds a client gets to send a whole request body, however it trickles in
+        self.body_timeout = kwargs.get('body_timeout', 30.0)
+        # time the body of the current request has to have arrived by, see readinto()
+        self.body_deadline = None
+        # seconds sending a response may block for
+        self.write_timeout = kwargs.get('write_timeout', 30.0)
+        # ConnectionLimit the listener counted this connection against, released on close
+        self.connection_limit = kwargs.get('connection_limit')
+        # True to tell clients how long each phase of their request took in a Server-Timing header
+        self.server_timing = kwargs.get('server_timing', False)
+        # AccessLog requests get written to
+        self.access_log = kwargs.get('access_log') or Server.access_log
+        # pipelined safe requests handled in parallel ahead of their turn, 0 handles each in turn
+        self.pipeline_depth = kwargs.get('pipeline_depth', 0)
+        # RateLimiter every request is checked against, None for no limits
+        self.rate_limiter = kwargs.get('rate_limiter')
+
+        # pipelined requests already being handled, in order, see prefetch()
+        self.prefetched = collections.deque()
+        # encoded responses held back by write() to go out together
+        self.pending_writes = []
+
+        # when the request being processed finished arriving, and bytes received for it
+        self.request_started = None
+        self.received_bytes = 0
+
+        # receive buffer, bytes between buffer_start and buffer_end are yet to be parsed
+        self.buffer = bytearray(self.max_header_size)
+        self.buffer_start = 0
+        self.buffer_end = 0
 
     def run(self):
         """Process each client connection.
 
         Parses the request to create a Request object,
         gets a Response by finding a request handler that matches a regex.
-        The response is then sent and the connection closed.
-        This is run in a new thread for each request
-        """
-        # parse http. Result is a new Request object
-        request = self.parse_request()
-        # generate a response by calling the handler which does the magic
-        response = self.handle_request(request)
-        # log the request and the response status to console
-        self.audit_log(request, response)
-        # send the response back to the client
-        response.send(self.client_socket)
-
-        # we're done...
-        self.client_socket.shutdown(socket.SHUT_RDWR)
+        The response is then sent and while the client wants a persistent connection
+        the next request is read from the same socket until it goes idle for longer
+        than keep_alive_timeout or max_keep_alive_requests have been served.
+        This is run in a new thread for each connection
+        """
+        Server.metrics.connection_opened()
+        try:
+            if isinstance(self.client_socket, ssl.SSLSocket) and not self.handshake():
+                return
+            self.serve()
+        finally:
+            # we're done...
+            self.close()
+            Server.metrics.connection_closed()
+            if self.connection_limit is not None:
+                self.connection_limit.release()
+
+    def serve(self):
+        """Request loop of the connection, timing each phase for Server.metrics.
+        """
+        handled = 0
+        # time spent queued after accept() only counts towards the first request
+        timings = [('accept', time.time() - self.accepted)]
+        while self.keep_running:
+            # new connections get header_timeout and idle persistent ones keep_alive_timeout to start a request
+            self.client_socket.settimeout(self.keep_alive_timeout if handled else self.header_timeout)
+            self.request_started = None
+            self.body_deadline = None
+            self.received_bytes = 0
+            call = None
+            try:
+                if self.prefetched:
+                    # a pipelined request whose handler is already running
+                    request, found, self.request_started, self.received_bytes, call = self.prefetched.popleft()
+                    parsed = dispatched = time.time()
+                else:
+                    # parse http. Result is a new Request object
+                    request = self.parse_request()
+                    if request is None:
+                        break  # client closed the connection, there's nobody to answer
+                    parsed = time.time()
+                    # the route decides how the body gets read
+                    found = self.find_handler(request)
+                    dispatched = time.time()
+                    if self.body_timeout is not None:
+                        self.body_deadline = dispatched + self.body_timeout
+                    self.read_body(request, found)
+            except HttpError as err:
+                # can't trust where the next request would start so give up on the connection
+                logging.info("Rejecting request from %s: %s %s", self.client_address, err.status_code,
+                             err.status_message)
+                response = err.response()
+                response.headers['Connection'] = 'close'
+                try:
+                    self.client_socket.settimeout(self.write_timeout)
+                    self.write(response, True, False)
+                except (socket.timeout, socket.error):
+                    pass
+                break
+            except (socket.timeout, socket.error) as err:
+                logging.debug("Closing connection from %s: %s", self.client_address, err)
+                break
+
+            method = request.method
+            route = '' if isinstance(found, Response) else found[2]['pattern']
+            read = time.time()
+            timings.append(('parse', (parsed - (self.request_started or parsed)) + (read - dispatched)))
+            timings.append(('dispatch', dispatched - parsed))
+            Server.metrics.begin(method, route)
+
+            response = None
+            try:
+                # what follows a streamed body the handler hasn't read yet is still body, not the next request
+                if (self.pipeline_depth and request.method in self.safe_methods and request.wants_keep_alive()
+                        and not (isinstance(request.body, RequestBody) and request.body.remaining)):
+                    self.prefetch()
+                # generate a response by calling the handler which does the magic
+                if call is None:
+                    response = self.handle_request(request, found, self.rate_limiter)
+                else:
+                    response = call.result()
+                handled += 1
+                handler_done = time.time()
+                timings.append(('handler', handler_done - read))
+                if self.compressor is not None:
+                    self.compressor.compress(request, response)
+
+                # HTTP/1.0 clients can't take chunked bodies
+                chunked = request.version == 'HTTP/1.1'
+
+                keep_alive = (request.wants_keep_alive() and handled < self.max_keep_alive_requests
+                              and self.finish_body(request))
+                if response.streaming() and not chunked and 'Content-Length' not in response.headers:
+                    keep_alive = False  # closing the connection marks the end of the body
+                response.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                if self.server_timing:
+                    self.add_server_timing(response, timings, chunked)
+
+                # send the response back to the client, held back while more pipelined requests are waiting
+                try:
+                    self.client_socket.settimeout(self.write_timeout)
+                    self.write(response, chunked, keep_alive and self.pipelined())
+                except (socket.timeout, socket.error) as err:
+                    logging.debug("Could not send response to %s: %s", self.client_address, err)
+                    break
+                except Exception:
+                    # a streamed body blew up part way, the headers are gone so all we can do is hang up
+                    logging.exception("Error streaming response body to %s", self.client_address)
+                    break
+                finally:
+                    timings.append(('send', time.time() - handler_done))
+            finally:
+                if response is None:
+                    Server.metrics.end(method, route, 500, self.received_bytes, 0, timings)  # handler raised
+                else:
+                    Server.metrics.end(method, route, response.status_code, self.received_bytes,
+                                       response.bytes_sent, timings)
+                    self.access_log.log(request, response, time.time() - (self.request_started or read))
+                timings = []
+
+            if not keep_alive:
+                break
+
+    def handshake(self):
+        """Do the TLS handshake the listener left for us on a secure connection.
+
+        :return: False if it failed or took longer than handshake_timeout
+        """
+        self.client_socket.settimeout(self.handshake_timeout)
+        try:
+            self.client_socket.do_handshake()
+        except ssl.SSLEOFError:
+            # find this happening when browser issues warning and ends tcp stream
+            logging.debug("Reached EOF during TLS handshake with %s", self.client_address)
+            return False
+        except (socket.timeout, socket.error) as err:
+            logging.debug("TLS handshake with %s failed: %s", self.client_address, err)
+            return False
+        self.client_socket.settimeout(None)
+        return True
+
+    def pipelined(self):
+        """True when more of the client's requests have already arrived behind the current one.
+        """
+        return bool(self.prefetched) or self.buffer_end > self.buffer_start
+
+    def prefetch(self):
+        """Start handling the safe requests pipelined behind the current one in parallel.
+
+        Only requests completely in the receive buffer without a body are taken, up to
+        pipeline_depth of them, stopping at the first one that could change something.
+        Their responses still get written in the order the requests came in.
+        """
+        while len(self.prefetched) < self.pipeline_depth:
+            head_end = self.buffer.find(b'\r\n\r\n', self.buffer_start, self.buffer_end)
+            if head_end < 0:
+                return
+            head = bytes(self.buffer[self.buffer_start:head_end + 4])
+            try:
+                request = self.build_request(head, self.client_address)
+                if request.method not in self.safe_methods or self.content_length(request):
+                    return
+                found = self.find_handler(request)
+                self.read_body(request, found)
+            except HttpError:
+                return  # left for the request loop to reject when it gets there
+            self.consume(len(head))
+            call = self.PipelinedCall(functools.partial(self.handle_request, request, found, self.rate_limiter))
+            self.prefetched.append((request, found, time.time(), len(head), call))
+            if not request.wants_keep_alive():
+                return
+
+    def write(self, response, chunked, more):
+        """Send a response, or while more pipelined requests are waiting hold it back to go out with theirs.
+
+        Held back responses get written together in one scatter-gather send rather than one each,
+        at the latest before waiting on the client for anything.
+        """
+        if not response.streaming():
+            if more and len(self.pending_writes) < self.max_pending_writes:
+                self.pending_writes.extend(response.buffers(chunked))
+                return
+            if self.pending_writes:
+                self.pending_writes.extend(response.buffers(chunked))
+                self.flush_writes()
+                return
+        self.flush_writes()
+        response.send(self.client_socket, chunked)
+
+    def flush_writes(self):
+        """Send the responses held back by write().
+        """
+        if not self.pending_writes:
+            return
+        buffers = self.pending_writes
+        self.pending_writes = []
+        timeout = self.client_socket.gettimeout()
+        self.client_socket.settimeout(self.write_timeout)
+        if hasattr(self.client_socket, 'sendmsg') and not isinstance(self.client_socket, ssl.SSLSocket):
+            Response.sendmsg_all(self.client_socket, buffers)
+        else:
+            self.client_socket.sendall(b''.join(buffers))
+        self.client_socket.settimeout(timeout)
+
+    def close(self):
+        """Shutdown and close the client connection.
+        """
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except (socket.error, ValueError):
+            pass  # client already hung up
         self.client_socket.close()
 
     def parse_request(self):
-        """Reads the tcp client socket to make a Request.
+        """Reads the tcp client socket to make a Request from the request line and headers.
 
-        :return: a Request object
+        Data is received into a reusable bytearray where the end of the headers is
+        searched for once, only over newly received bytes. The body is left for
+        read_body() once the route it is destined for is known.
+        :return: a Request object or None if the client closed the connection
+        :raises HttpError: for malformed, oversized or unsupported requests
         """
-        request = b''
-        data = b''  # if we had PUT or POST data build it here
-        post_flag = False
-        http_request = None
+        head_end = self.receive_head()
+        if head_end < 0:
+            return None
+        self.request_started = time.time()
+        self.received_bytes = head_end - self.buffer_start
+
+        head = bytes(self.buffer[self.buffer_start:head_end])
+        self.consume(head_end - self.buffer_start)
 
+        # create an instance of a Request object
+        return self.build_request(head, self.client_address)
+
+    def read_body(self, request, found):
+        """Attach the request body according to the options of the route it matched.
+
+        A body is read straight into a bytearray preallocated from the Content-Length,
+        or for stream_body routes handed over as a RequestBody to read as it arrives.
+        Anything read past the end of the request stays buffered for the next request.
+        :raises HttpError: for missing, bad or too large Content-Length
+        """
+        options = Server.default_route_options if isinstance(found, Response) else found[2]
+        max_body_size = options['max_body_size']
+        if max_body_size is None:
+            max_body_size = self.max_body_size
+
+        content_length = self.content_length(request, max_body_size)
+        self.received_bytes += content_length
+        if options['stream_body']:
+            request.body = RequestBody(self.readinto, content_length, self.spool_threshold)
+        elif content_length:
+            request.body = self.receive_body(content_length)
+            logging.debug("Finished reading %d byte request body", content_length)
+
+    def finish_body(self, request):
+        """Make sure a streamed body has been read off the connection once the handler is done.
+
+        :return: False if too much was left unread and the connection should be closed instead
+        """
+        body = request.body
+        if isinstance(body, RequestBody) and body.remaining:
+            if body.remaining > self.max_discard_size:
+                return False
+            try:
+                body.discard()
+            except (socket.timeout, socket.error):
+                return False
+        return True
+
+    def receive_head(self):
+        """Receive until the buffer holds a complete request line and headers.
+
+        Waiting for a request to start is up to the socket timeout, once some of it
+        has arrived the rest has to follow within header_timeout.
+        :return: buffer index just past the blank line ending the headers, -1 on EOF
+        :raises HttpError: 408 when the client is too slow sending the headers
+        """
+        search_from = self.buffer_start
+        deadline = None
         while True:
-            got_bytes = 0
-            new_data = self.client_socket.recv(8192)
-            if len(new_data) == 0:
-                break  # got EOF meh
-
-            # if the request has just started
-            if not post_flag:
-                for line in new_data.split(b'\n'):
-                    request += line + b'\n'  # add linebreak back helps
-                    got_bytes += len(line) + 1
-
-                    if len(line) <= 1:  # assumed to reach /r/n/r/n
-                        request_lines = request.split(b'\r\n')
-                        request_speci = request_lines[0].decode().split()  # eg ['GET', '/', 'HTTP/1.1']
-
-                        request_headers = {}
-                        for header in request_lines[1:]:
-                            try:
-                                (var, val) = header.split(b': ')  # split header key/value pairs into 2 components
-                                request_headers[var.decode()] = val.decode()
-                            except ValueError:
-                                pass
-
-                        # process querystring in request if any eg GET /?status=new&cake=lie
-                        # resulting uri variable should then have the querystring chopped off.
-                        # true keeps any blank values e.g /?egg
-                        get_query = parse_qs(request_speci[1].replace('/?', ''), True)
-                        # chop off querystring, e.g: /?status=new&cake=lie becomes /
-                        uri = request_speci[1].split('?')[0]
-
-                        # create an instance of a Request object
-                        http_request = Request(request_speci[0], uri, request_headers, get_query,
-                                               address=self.client_address)
-
-                        if request_speci[0] == 'POST' or request_speci[0] == 'PUT':
-                            post_flag = True
-                            data += new_data[got_bytes:]
-
-                            if len(data) == int(http_request.headers['Content-Length']):
-                                logging.debug("Finished reading POST request")
-                                http_request.body = data
-                                return http_request
-                            else:
-                                # exit for, post flag is set, will continue reading post later on
-                                break
-
-                        else:
-                            return http_request
-            else:
-                # we have more POST/PUT data to process
-                data += new_data
-                if len(data) == int(http_request.headers['Content-Length']):
-                    http_request.body = data
-                    logging.debug("Finished reading large file")
-                    break
-                elif len(data) >= int(http_request.headers['Content-Length']):
-                    logging.warning("Got more data from client than specified in Content-Length")
-                    # should return a bad request
+            end = self.buffer.find(b'\r\n\r\n', search_from, self.buffer_end)
+            if end >= 0:
+                return end + 4
+
+            if self.buffer_end - self.buffer_start >= self.max_header_size:
+                raise HttpError(431, 'Request Header Fields Too Large')
+
+            # a terminator could straddle the old and new data
+            search_from = max(self.buffer_start, self.buffer_end - 3)
+            if self.buffer_end == len(self.buffer):
+                # out of room at the end, move the partial head to the front
+                pending = self.buffer_end - self.buffer_start
+                self.buffer[:pending] = self.buffer[self.buffer_start:self.buffer_end]
+                search_from -= self.buffer_start
+                self.buffer_start, self.buffer_end = 0, pending
+
+            if self.buffer_end > self.buffer_start and self.header_timeout is not None:
+                # part way through a request, don't let a slow client drip feed it forever
+                if deadline is None:
+                    deadline = time.time() + self.header_timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise HttpError(408, 'Request Timeout')
+                self.client_socket.settimeout(remaining)
+
+            self.flush_writes()  # the client may be waiting on them before it sends more
+            try:
+                received = self.client_socket.recv_into(memoryview(self.buffer)[self.buffer_end:])
+            except socket.timeout:
+                if deadline is not None:
+                    raise HttpError(408, 'Request Timeout')
+                raise
+            if received == 0:
+                if self.buffer_end > self.buffer_start:
+                    logging.debug("Got EOF part way through a request from %s", self.client_address)
+                return -1  # got EOF meh
+            self.buffer_end += received
+
+    def receive_body(self, content_length):
+        """Read a request body of content_length bytes into a bytearray.
+
+        Only RequestBody.chunk_size is allocated up front, the buffer doubles as the bytes
+        arrive so a client can't make us hold memory for a body it never sends.
+        """
+        body = bytearray(min(content_length, RequestBody.chunk_size))
+        position = 0
+        while True:
+            view = memoryview(body)
+            while position < len(body):
+                received = self.readinto(view[position:])
+                if received == 0:
+                    raise socket.error("Connection closed part way through the request body")
+                position += received
+            del view  # a bytearray with a view on it can't grow
+            if position == content_length:
+                return body
+            body.extend(bytearray(min(len(body), content_length - len(body))))
+
+    def readinto(self, view):
+        """Fill view with the next bytes from the connection, buffered bytes first.
+
+        :return: number of bytes read, 0 on EOF
+        :raises socket.timeout: once the body is past its body_timeout deadline
+        """
+        buffered = self.buffer_end - self.buffer_start
+        if buffered:
+            count = min(buffered, len(view))
+            view[:count] = memoryview(self.buffer)[self.buffer_start:self.buffer_start + count]
+            self.consume(count)
+            return count
+        self.flush_writes()
+        if self.body_deadline is not None:
+            # an overall deadline, a client drip feeding the body can't hold the connection forever
+            remaining = self.body_deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Request body not received within body_timeout")
+            self.client_socket.settimeout(remaining)
+        return self.client_socket.recv_into(view, len(view))
+
+    def consume(self, count):
+        """Mark count buffered bytes as used, rewinding the buffer once it is empty.
+        """
+        self.buffer_start += count
+        if self.buffer_start == self.buffer_end:
+            self.buffer_start = self.buffer_end = 0
+
+    @staticmethod
+    def content_length(request, max_body_size=None):
+        """Work out how many body bytes follow the headers of a Request.
+
+        :raises HttpError: 400 for a bad Content-Length, 411 for bodies without one
+            and 413 when it is larger than max_body_size
+        """
+        length = request.header('Content-Length')
+        if length is None:
+            if request.header('Transfer-Encoding') is not None:
+                raise HttpError(411, 'Length Required')
+            return 0
+
+        try:
+            length = int(length)
+        except ValueError:
+            raise HttpError(400, 'Bad Request')
+        if length < 0:
+            raise HttpError(400, 'Bad Request')
+        if max_body_size is not None and length > max_body_size:
+            raise HttpError(413, 'Payload Too Large')
+        return length
+
+    @staticmethod
+    def build_request(head, address):
+        """Make a Request from the raw request line and headers.
+
+        head bytes up to and including the blank line ending the headers
+        address the client address the request came from
+        """
+        line_end = head.find(b'\r\n')
+        try:
+            request_speci = head[:line_end].decode().split()  # eg ['GET', '/', 'HTTP/1.1']
+        except UnicodeDecodeError:
+            raise HttpError(400, 'Bad Request')
+        if len(request_speci) != 3 or not request_speci[2].startswith('HTTP/'):
+            raise HttpError(400, 'Bad Request')
+
+        # process querystring in request if any eg GET /?status=new&cake=lie
+        # resulting uri variable should then have the querystring chopped off.
+        # chop off querystring, e.g: /?status=new&cake=lie becomes /
+        # the header lines and the querystring only get parsed if they're used
+        uri, question, query = request_speci[1].partition('?')
+        return Request(request_speci[0], uri, address=address, version=request_speci[2],
+                       header_block=head[line_end:], query_string=query)
 
-        return http_request
+    @staticmethod
+    def dispatch(request, body=None, rate_limiter=None):
+        """Get the Response for a Request whose body is already at hand, no connection needed.
+
+        body bytes of the request body, stream_body routes get them as a RequestBody
+        """
+        found = HttpWorker.find_handler(request)
+        if not isinstance(found, Response) and found[2]['stream_body']:
+            body = body or b''
+            body = RequestBody(io.BytesIO(body).readinto, len(body))
+        request.body = body
+        return HttpWorker.handle_request(request, found, rate_limiter)
 
-    def handle_request(self, request):
+    @staticmethod
+    def handle_request(request, found=None, rate_limiter=None):
         """Search the list of registered Request handlers which match an expression.
 
         Calls handler if found otherwise should send 404
         request incoming Request object
+        found result of find_handler when the lookup has already been done
+        rate_limiter the server's RateLimiter, checked along with the route's own one
         returns a Response destined for the client
         """
+        if found is None:
+            found = HttpWorker.find_handler(request)
+        if isinstance(found, Response):
+            return found
+
+        # call our registered handler for that url with unpacked args
+        func, args, options = found
+        try:
+            admitted = HttpWorker.admit(request, func, options, rate_limiter)
+        except HttpError as err:
+            return err.response()
+        try:
+            cache_ttl = options['cache_ttl']
+            if not cache_ttl:
+                return HttpWorker.run_handler(func, request, args, options)
+
+            response = Server.response_cache.fetch(request)
+            if response is None:
+                response = HttpWorker.run_handler(func, request, args, options)
+                Server.response_cache.store(request, response, cache_ttl, options['pattern'])
+            return ResponseCache.not_modified(request, response)
+        finally:
+            RateLimiter.release_all(admitted)
+
+    @staticmethod
+    def admit(request, func, options, rate_limiter=None):
+        """Acquire the request from the server's and its route's rate limiters, for every engine.
+
+        A /yahs/batch request gets the server's RateLimiter to charge each of its sub-requests to instead.
+        :return: the (limiter, key) pairs to RateLimiter.release_all() once the handler is done
+        :raises HttpError: 429 when a limit is hit
+        """
+        limiters = (rate_limiter, options['rate_limit'])
+        if func is batch_requests:
+            request.rate_limiter = rate_limiter
+            limiters = (options['rate_limit'],)
+        return RateLimiter.admit(limiters, request, options['pattern'])
+
+    @staticmethod
+    def run_handler(func, request, args, options):
+        """Get the Response from a handler, sharing the call with identical requests on coalesce routes.
+        """
+        if options['coalesce']:
+            return Server.coalescer.call(
+                request, lambda: HttpWorker.make_response(HttpWorker.call_handler(func, request, args, options)),
+                options['coalesce_timeout'])
+        return HttpWorker.make_response(HttpWorker.call_handler(func, request, args, options))
+
+    @staticmethod
+    def call_handler(func, request, args, options):
+        """Call a handler, under cProfile when Server.profiler picks the request as a sample.
+
+        A HttpError raised by the handler, e.g from Request.form(), becomes its error Response.
+        """
+        try:
+            if Server.profiler.sample(options['pattern']):
+                return Server.profiler.runcall(func, request, **args)
+            return func(request, **args)
+        except HttpError as err:
+            return err.response()
+
+    @staticmethod
+    def add_server_timing(response, timings, chunked):
+        """Put the (phase, seconds) timings in a Server-Timing header.
+
+        The send time isn't known until the headers are gone so chunked bodies get it in a trailer.
+        """
+        response.headers['Server-Timing'] = ', '.join('{};dur={:.3f}'.format(phase, seconds * 1000)
+                                                      for phase, seconds in timings)
+        if chunked and response.streaming() and 'Content-Length' not in response.headers:
+            send_started = time.time()
+            response.headers['Trailer'] = 'Server-Timing'
+            if response.trailers is None:
+                response.trailers = {}
+            response.trailers['Server-Timing'] = lambda: 'send;dur={:.3f}'.format((time.time() - send_started) * 1000)
+
+    @staticmethod
+    def find_handler(request):
+        """Find the registered handler for a Request.
+
+        returns (handler function, named regex back-reference args, route options) when a url
+        pattern matches otherwise the 400/404 error Response to send
+        """
         if request is None:
             logging.warning("Tried to handle a None Request")
             response = Response()
@@ -203,37 +2776,22 @@ class HttpWorker(threading.Thread):
             response.status_message = "Bad Request None Got It"
             return response
 
-        logging.debug(request)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(request)  # don't format the whole request unless it's going to be seen
 
+        routes = Server.routes  # this snapshot even if the routes get replaced while we're at it
         # first check if we support that request method type i.e any registered handlers for it
-        if request.method not in Server.handlers:
+        if request.method not in routes.handlers:
             response = Response()
             response.status_code = 400
             response.status_message = 'Bad Request'
             response.body = "<h1>400 Bad Request</h1><p>The server could support your request</p>"
             return response
 
-        # spin over the registered get handlers and call a match. O(n) where n is number of registered method handlers
-        for urlpattern in Server.handlers[request.method]:
-            match = urlpattern.match(request.uri)
-            if match is not None:
-                # found matching urlpatten. Get named regex back-reference values as args
-                args = match.groupdict()
-                # call our registered handler for that url with unpacked args
-                func = Server.handlers[request.method][urlpattern]  # awesomeness
-                res = func(request, **args)
-                if type(res) is str:
-                    response = Response()
-                    response.body = res
-                    return response
-                elif res is None:
-                    response = Response()
-                    response.status_code = 204
-                    response.status_message = 'No Content'
-                    logging.debug("Got a None response back from handler check return response exists?")
-                    return response
-
-                return res
+        # look up the compiled index of url patterns rather than trying every regex in turn
+        found = routes.find(request.method, request.uri)
+        if found is not None:
+            return found  # awesomeness
 
         # If we reached here then it's time for a 404
         response = Response()
@@ -243,12 +2801,315 @@ class HttpWorker(threading.Thread):
         return response
 
     @staticmethod
-    def audit_log(request, response):
-        """Logs request and Response http status code destined for the client
-        request The original Request they made
-        response The actual Response destined for the client
+    def make_response(res):
+        """Turn whatever a handler returned into a Response.
+
+        Strings become the body of a 200 response, None becomes 204 No Content.
+        """
+        if type(res) is str:
+            response = Response()
+            response.body = res
+            return response
+        elif res is None:
+            response = Response()
+            response.status_code = 204
+            response.status_message = 'No Content'
+            logging.debug("Got a None response back from handler check return response exists?")
+            return response
+
+        return res
+
+
+class RouteIndex:
+    """Compiled lookup structure for the url patterns registered for one HTTP method.
+
+    Fully literal patterns such as ^/yahs/api$ go into an exact match dict, every other
+    pattern is filed in a character trie under the literal text it has to start with,
+    so only patterns whose literal prefix matches the uri are tried. The patterns filed
+    together are joined into alternation regexes like (?P<_r0>first)|(?P<_r1>second) so
+    one match() call finds the first of them matching, then only that pattern is run again
+    for its groups. Patterns which can't share an alternation, e.g with backreferences or
+    their own flags, are tried alone in their place in the order.
+    Candidates are tried in registration order so the first registered pattern still wins.
+    """
+
+    ROUTES = ''  # trie node key holding the segments of the patterns filed at that node
+    # groups one combined regex may hold, Python 2's re allows no more than 100
+    max_groups = 100
+    default_flags = re.compile('').flags
+    # named groups in a pattern's source, made plain groups so the names don't clash
+    named_group = re.compile(r'(?<!\\)\(\?P<\w+>')
+    backreference = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, handlers):
+        """handlers OrderedDict of compiled url pattern to handler function
+        """
+        self.size = len(handlers)
+        self.exact = {}
+        self.trie = {}
+
+        for order, urlpattern in enumerate(handlers):
+            prefix, exact = self.literal_prefix(urlpattern)
+            if exact:
+                # keep the earliest registration for a literal uri
+                self.exact.setdefault(prefix, (order, urlpattern))
+                continue
+
+            node = self.trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(self.ROUTES, []).append((order, urlpattern))
+
+        nodes = [self.trie]
+        while nodes:
+            node = nodes.pop()
+            for key, child in node.items():
+                if key == self.ROUTES:
+                    node[key] = self.segments(child)
+                else:
+                    nodes.append(child)
+
+    @classmethod
+    def segments(cls, routes):
+        """Join runs of (order, url pattern) into alternation regexes.
+
+        returns [(combined regex or None for a lone pattern, [(order, url pattern)])] in order
+        """
+        segments = []
+        pending = []
+        groups = 0
+        for order, urlpattern in routes:
+            source = cls.combinable_source(urlpattern)
+            if pending and (source is None or groups + 1 + urlpattern.groups > cls.max_groups):
+                segments.append(cls.combine(pending))
+                pending = []
+                groups = 0
+            if source is None:
+                segments.append((None, [(order, urlpattern)]))
+                continue
+            pending.append((order, urlpattern, source))
+            groups += 1 + urlpattern.groups
+        if pending:
+            segments.append(cls.combine(pending))
+        return segments
+
+    @staticmethod
+    def combine(pending):
+        combined = re.compile('|'.join('(?P<_r{}>{})'.format(number, source)
+                                       for number, (order, urlpattern, source) in enumerate(pending)))
+        return combined, [(order, urlpattern) for order, urlpattern, source in pending]
+
+    @classmethod
+    def combinable_source(cls, urlpattern):
+        """The pattern's source with its named groups made plain ones, None if it can't go in an alternation.
+        """
+        if urlpattern.flags != cls.default_flags or cls.backreference.search(urlpattern.pattern):
+            return None
+        source = cls.named_group.sub('(', urlpattern.pattern)
+        try:
+            plain = re.compile(source)
+        except re.error:
+            return None
+        if plain.groups != urlpattern.groups or plain.groupindex:
+            return None  # the rewrite changed more than the group names
+        return source
+
+    @staticmethod
+    def literal_prefix(urlpattern):
+        """Find the literal text every uri matching a compiled pattern must start with.
+
+        returns (prefix, exact) where exact is True when the pattern matches only that literal uri
+        """
+        if urlpattern.flags & re.IGNORECASE:
+            return '', False
+        try:
+            parsed = list(sre_parse.parse(urlpattern.pattern, urlpattern.flags))
+        except Exception:
+            return '', False
+
+        position = 0
+        if parsed and parsed[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+            position = 1  # match() anchors at the start anyway
+
+        prefix = []
+        while position < len(parsed) and parsed[position][0] == sre_constants.LITERAL:
+            prefix.append(chr(parsed[position][1]))
+            position += 1
+
+        exact = (position == len(parsed) - 1 and
+                 parsed[position] in ((sre_constants.AT, sre_constants.AT_END),
+                                      (sre_constants.AT, sre_constants.AT_END_STRING)))
+        return ''.join(prefix), exact
+
+    def match(self, uri):
+        """Find the first registered pattern matching the uri.
+
+        returns (url pattern, match object) or None
+        """
+        best = self.exact.get(uri)  # (order, url pattern) of the earliest registered match so far
+
+        # try the patterns filed under every prefix of the uri
+        node = self.trie
+        if self.ROUTES in node:
+            best = self.first_match(node[self.ROUTES], uri, best)
+        for char in uri:
+            node = node.get(char)
+            if node is None:
+                break
+            if self.ROUTES in node:
+                best = self.first_match(node[self.ROUTES], uri, best)
+
+        if best is None:
+            return None
+        return best[1], best[1].match(uri)
+
+    def first_match(self, segments, uri, best):
+        """The earliest registered of best and the patterns of a trie node matching the uri.
+        """
+        limit = self.size if best is None else best[0]
+        for combined, routes in segments:
+            if routes[0][0] > limit:
+                break  # nothing here was registered before best
+            if combined is None:
+                if routes[0][1].match(uri) is not None:
+                    return routes[0]
+                continue
+            found = combined.match(uri)
+            if found is not None:
+                route = routes[int(found.lastgroup[2:])]
+                return route if route[0] < limit else best
+        return best
+
+
+class RouteTable:
+    """Immutable, versioned snapshot of the registered routes.
+
+    Registering a route makes a new RouteTable with it added which then replaces
+    Server.routes in one assignment, so request threads read the current snapshot
+    without a lock and a request already dispatched finishes on the one it started with.
+    handlers per method OrderedDict of compiled url pattern to handler function, in registration order
+    options per method dict of compiled url pattern to the options it was registered with
+    """
+
+    def __init__(self, handlers=None, options=None, version=0, indexes=None):
+        self.handlers = handlers or {}
+        self.options = options or {}
+        self.version = version
+        self.indexes = indexes or {}  # RouteIndex per method, built on first use
+
+    def with_route(self, method, uri_expression, func, options):
+        """A new RouteTable with a route added or replaced, this one is left as it was.
+        """
+        handlers = dict(self.handlers)
+        handlers[method] = collections.OrderedDict(self.handlers.get(method, ()))
+        handlers[method][uri_expression] = func
+        route_options = dict(self.options)
+        route_options[method] = dict(self.options.get(method, ()))
+        route_options[method][uri_expression] = options
+        # the other methods' indexes still fit, copied in one go as index() may be adding to them
+        indexes = dict(self.indexes)
+        indexes.pop(method, None)
+        return RouteTable(handlers, route_options, self.version + 1, indexes)
+
+    def index(self, method):
+        """The RouteIndex of a method's url patterns.
+
+        Two threads might both build it the first time, either one will do.
+        """
+        index = self.indexes.get(method)
+        if index is None:
+            index = self.indexes[method] = RouteIndex(self.handlers[method])
+        return index
+
+    def find(self, method, uri):
+        """Find the handler of the first url pattern matching the uri.
+
+        returns (handler function, named regex back-reference args, route options) or None
         """
-        logging.info("{} {} Response: {}".format(request.method, request.uri, response.status_code))
+        found = self.index(method).match(uri)
+        if found is None:
+            return None
+        urlpattern, match = found
+        return self.handlers[method][urlpattern], match.groupdict(), self.options[method][urlpattern]
+
+
+class WorkerPool:
+    """Fixed number of warm worker threads fed from a bounded connection queue.
+
+    ListenerThreads submit accepted (client_socket, client_address) pairs which
+    get picked up by the next idle worker and processed by a HttpWorker.
+    When the queue is full submit() blocks, pushing back onto the listen backlog.
+    """
+
+    def __init__(self, size=16, queue_size=128, worker_options=None):
+        self.size = size
+        self.queue_size = queue_size
+        self.worker_options = worker_options or {}
+        self.connections = queue.Queue(queue_size)
+        self.threads = []
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Spin up the worker threads so they are ready before connections arrive.
+        """
+        for number in range(self.size):
+            worker = threading.Thread(target=self.work, name="yahs-worker-{}".format(number))
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+        return self
+
+    def submit(self, client_socket, client_address, accepted=None):
+        """Queue an accepted connection for the next free worker.
+
+        accepted time the connection was accepted, for timing how long it waited
+        """
+        self.connections.put((client_socket, client_address, accepted or time.time()))
+
+    def work(self):
+        """Worker thread loop. A None item tells the worker to finish up.
+        """
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+
+            with self.lock:
+                self.busy += 1
+            try:
+                # run the protocol handling in this warm thread instead of starting a new one
+                HttpWorker(args=item, kwargs=self.worker_options).run()
+            except Exception:
+                logging.exception("Unhandled error processing connection from %s", item[1])
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+    def shutdown(self):
+        """Ask every worker to exit once the queued connections are processed.
+        """
+        for _ in self.threads:
+            self.connections.put(None)
+
+    @property
+    def queue_depth(self):
+        """Number of accepted connections waiting for a worker."""
+        return self.connections.qsize()
+
+    @property
+    def busy_workers(self):
+        """Number of workers currently processing a connection."""
+        return self.busy
+
+    def stats(self):
+        """Snapshot of the pool sizing figures."""
+        return {
+            'workers': self.size,
+            'busy_workers': self.busy,
+            'queue_depth': self.queue_depth,
+            'queue_size': self.queue_size
+        }
 
 
 class ListenerThread(threading.Thread):
@@ -256,6 +3117,9 @@ class ListenerThread(threading.Thread):
         """
         Create the server socket listener thread.
         args is required with (hostname, port, https_enabled)
+        kwargs optional keyfile, certfile or a shared TlsContext as tls, pool, worker_options, reuse_port,
+        backlog, unix_socket path to listen on instead of the hostname and port, fd of an already
+        listening socket to take over and dual_stack
         """
         # call 'super' constructor to init thread
         super(ListenerThread, self).__init__(group=group, target=target, name=name, args=args, kwargs=kwargs)
@@ -264,8 +3128,32 @@ class ListenerThread(threading.Thread):
         self.port = args[1]
         self.secure = args[2]
         self.socket = None
+        self.pool = None
+        self.worker_options = {}
+        self.reuse_port = False
+        self.running = True
+        self.tls = None
+        self.backlog = 128
+        self.connection_limit = None
+        self.unix_socket = None
+        self.fd = None
+        self.dual_stack = True
 
         if kwargs:
+            self.tls = kwargs.get('tls')
+            # connections the kernel queues up waiting to be accepted
+            self.backlog = kwargs.get('backlog', 128)
+            self.pool = kwargs.get('pool')
+            self.worker_options = kwargs.get('worker_options') or {}
+            self.connection_limit = self.worker_options.get('connection_limit')
+            # let several processes bind the port with the kernel balancing connections between them
+            self.reuse_port = kwargs.get('reuse_port', False)
+            self.unix_socket = kwargs.get('unix_socket')
+            # e.g from systemd socket activation, whoever opened it keeps its queue between restarts
+            self.fd = kwargs.get('fd')
+            # an IPv6 socket accepting IPv4 connections too, with a hostname like '::'
+            self.dual_stack = kwargs.get('dual_stack', True)
+
             if 'keyfile' in kwargs:
                 self.key_file = kwargs['keyfile']
             else:
@@ -282,46 +3170,122 @@ class ListenerThread(threading.Thread):
         self.setup_listening()
 
     def setup_listening(self):
-        logging.info("Starting ListenerThread on {0}:{1}".format(self.hostname, self.port))
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((self.hostname, self.port))
-        server_socket.listen(5)
+        if self.fd is not None:
+            logging.info("Starting ListenerThread on inherited socket {0}".format(self.fd))
+            server_socket = socket.socket(fileno=os.dup(self.fd))  # closing ours leaves theirs open
+        elif self.unix_socket is not None:
+            logging.info("Starting ListenerThread on {0}".format(self.unix_socket))
+            server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.remove_unix_socket()  # left behind by a server that didn't exit cleanly
+            server_socket.bind(self.unix_socket)
+            server_socket.listen(self.backlog)
+        else:
+            logging.info("Starting ListenerThread on {0}:{1}".format(self.hostname, self.port))
+            family = socket.AF_INET6 if ':' in self.hostname else socket.AF_INET
+            server_socket = socket.socket(family, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6 and hasattr(socket, 'IPV6_V6ONLY'):
+                server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 if self.dual_stack else 1)
+            server_socket.bind((self.hostname, self.port))
+            server_socket.listen(self.backlog)
         self.socket = server_socket
 
-        if self.secure:
-            self.wrap_ssl()
+        if self.secure and self.tls is None:
+            self.load_tls()
+
+    def remove_unix_socket(self):
+        """Remove the unix_socket file, leaving anything that isn't a socket alone.
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(self.unix_socket).st_mode):
+                os.unlink(self.unix_socket)
+        except OSError:
+            pass
 
     def run(self):
         logging.debug("Entering http server loop")
-        while True:
+        while self.running:
             try:
                 (client_socket, address) = self.socket.accept()
-                logging.debug("Accepted connection from %s", address)
-                # create a HttpWorker thread, passing in the client socket
-                http_thread = HttpWorker(args=(client_socket, address))
-                http_thread.start()
-            except ssl.SSLEOFError:
-                # find this happening when browser issues warning and ends tcp stream
-                logging.debug("Reached EOF when SSL connection was being accepted")
-                continue
+                self.dispatch(client_socket, address)
             except ssl.SSLError as err:
-                logging.warning("Got a {} error: {}".format(err['library'], err['reason']))
+                logging.warning("SSL error accepting connection: %s", err)
                 continue
+            except socket.error:
+                if not self.running:
+                    break  # listening socket closed by stop()
+                raise
+
+    def dispatch(self, client_socket, address):
+        """Hand an accepted connection to the worker pool or a new HttpWorker thread.
+        """
+        accepted = time.time()
+        logging.debug("Accepted connection from %s", address)
+        if self.connection_limit is not None and not self.connection_limit.acquire():
+            # shed the load rather than let every client's latency grow
+            logging.warning("Over max_connections, rejecting connection from %s", address)
+            self.connection_limit.reject(client_socket, self.tls is not None)
+            return
+        if self.tls is not None:
+            # the worker does the handshake so a slow client can't hold up accepting
+            client_socket = self.tls.wrap(client_socket)
+        if self.pool is not None:
+            # hand the connection to a warm worker in the pool
+            self.pool.submit(client_socket, address, accepted)
+            return
+        # create a HttpWorker thread, passing in the client socket
+        http_thread = HttpWorker(args=(client_socket, address, accepted), kwargs=self.worker_options)
+        http_thread.start()
+
+    def stop(self, shutdown=True):
+        """Stop accepting connections and close the listening socket.
+
+        shutdown False when the socket is shared with other processes which should keep accepting on it.
+        Otherwise connections the kernel already queued on it are accepted and served rather than
+        reset, so a worker process being replaced doesn't drop them.
+        """
+        self.running = False
+        if self.fd is not None:
+            shutdown = False  # the inherited socket outlives this process
+        if shutdown:
+            self.accept_backlog()
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)  # wakes up the blocked accept()
+            except (socket.error, ValueError):
+                pass
+        self.close(remove=shutdown)
+
+    def accept_backlog(self):
+        """Accept and dispatch the connections waiting in the listen queue without blocking.
+        """
+        try:
+            self.socket.setblocking(False)
+            while True:
+                (client_socket, address) = self.socket.accept()
+                client_socket.setblocking(True)
+                self.dispatch(client_socket, address)
+        except (socket.error, ValueError):
+            pass  # queue empty or the socket already closed
+
+    def close(self, remove=True):
+        """Close the listening socket, remove True to also remove the unix_socket file.
+        """
+        self.socket.close()
+        if remove and self.unix_socket is not None:
+            self.remove_unix_socket()
 
-    def wrap_ssl(self):
-        # Wrap socket in SSL. TODO look into using ssl.SSLContexts for better support of browsers
+    def load_tls(self):
         try:
             logging.debug("Attempting to load private key at %s", self.key_file)
             logging.debug("Attempting to load certificates at %s", self.certificate_file)
-            self.socket = ssl.wrap_socket(self.socket,
-                                          server_side=True,
-                                          certfile=self.certificate_file,
-                                          keyfile=self.key_file)
+            self.tls = TlsContext(self.certificate_file, self.key_file)
             logging.debug("Certificates and server key loaded")
-        except IOError as err:
+        except (IOError, ssl.SSLError) as err:
             logging.warning("Could not find SSL certificate or private key file. Not starting ssl")
             logging.warning(err)
+            self.running = False
             self.socket.close()
             return
 
@@ -329,40 +3293,179 @@ class ListenerThread(threading.Thread):
 class Server:
     """Server listens for secure and non-secure sockets.
 
-    Spawns HttpWorker threads to handle the HTTP/1.1 protocol.
-    handlers Dictionary mapping url patten regular expressions to event handler functions
+    Spawns HttpWorker threads to handle the HTTP/1.1 protocol, or when a pool_size
+    is given hands connections to a WorkerPool of that many threads.
+    With workers=N the process becomes a supervisor pre-forking N worker processes
+    which all accept connections on the same port and get restarted if they die.
+    routes RouteTable snapshot of the url pattern regular expressions mapped to event handler functions
+    handlers the per method handlers of the current routes, read only
     """
 
-    # Event Handling Structure for requests
-    handlers = {}
+    # Event Handling Structure for requests, replaced rather than changed
+    routes = RouteTable()
+    # routes.handlers, kept in step with every swap
+    handlers = routes.handlers
+    # taken to make a new RouteTable, never to read one
+    routes_lock = threading.RLock()
+    # RouteTable that registrations go into while reload_handlers() rebuilds the routes off to the side
+    staged_routes = None
+    default_route_options = {'pattern': None, 'stream_body': False, 'max_body_size': None, 'cache_ttl': None,
+                             'coalesce': False, 'coalesce_timeout': None, 'rate_limit': None}
+    # responses of routes registered with a cache_ttl
+    response_cache = ResponseCache()
+    # handler calls in progress for routes registered with coalesce=True
+    coalescer = Coalescer()
+    # request metrics of this process, served at /yahs/metrics
+    metrics = Metrics()
+    # cProfile sampling of handlers, switched on by /yahs/profile
+    profiler = Profiler()
+    # access log of servers not given their own
+    access_log = AccessLog()
+    # limits of the /yahs/batch route
+    batch = Batch()
 
     @staticmethod
-    def handle(method, uri):
+    def handle(method, uri, stream_body=False, max_body_size=None, cache_ttl=None, coalesce=False,
+               coalesce_timeout=30.0, rate_limit=None):
         """Decorator for registering Request handlers
 
         Takes a HTTP method as string such as 'GET'
         Takes a regex string to compile and register for events
+        stream_body True to get Request.body as a RequestBody stream rather than a bytearray
+        max_body_size largest request body accepted on this route, overrides the Server wide limit
+        cache_ttl seconds to keep serving the handler's response from Server.response_cache for the
+            same uri and query string. Only for handlers that are pure functions of those!
+        coalesce True for concurrent requests with the same uri and query string to share one
+            handler call, again only for handlers that are pure functions of those.
+        coalesce_timeout seconds a coalesced request waits for the shared call before getting a 504.
+        rate_limit a RateLimiter for this route on top of any the Server was given.
 
         """
 
         def request_handler_decorator(func):
             # build regular expression
             uri_expression = re.compile(uri)
-
-            # update global handler dict dynamically as http methods are registered
-            if method not in Server.handlers:
-                logging.debug("Creating new handler structure for %s method type.", method)
-                Server.handlers[method] = collections.OrderedDict()  # order of regex key insertion matters
-
-            Server.handlers[method][uri_expression] = func  # add new function mapped to url regex
+            options = {
+                'pattern': uri,
+                'stream_body': stream_body,
+                'max_body_size': max_body_size,
+                'cache_ttl': cache_ttl,
+                'coalesce': coalesce,
+                'coalesce_timeout': coalesce_timeout,
+                'rate_limit': rate_limit
+            }
+
+            # copy on write, requests in progress keep using the routes they found their handler in
+            with Server.routes_lock:
+                if Server.staged_routes is not None:
+                    Server.staged_routes = Server.staged_routes.with_route(method, uri_expression, func, options)
+                else:
+                    Server.routes = Server.routes.with_route(method, uri_expression, func, options)
+                    Server.handlers = Server.routes.handlers
             return func
 
         return request_handler_decorator
 
-    def __init__(self, hostname='localhost', port=4321, secure=False, keyfile=None, certfile=None):
+    @staticmethod
+    def invalidate_cache(pattern=None, uri=None, method='GET'):
+        """Drop cached responses, e.g after a POST changes what a cached GET route returns.
+
+        pattern the url pattern a cache_ttl route was registered with, drops all its responses
+        uri drops the cached responses for that uri whatever the query string
+        with neither the whole response cache is cleared
+        """
+        return Server.response_cache.invalidate(pattern=pattern, uri=uri, method=method)
+
+    @staticmethod
+    def static(url_prefix, directory, max_age=None, stat_cache_ttl=1.0):
+        """Register a GET route serving the files in a directory under a url prefix.
+
+        e.g Server.static('/assets', 'public') serves public/css/site.css at /assets/css/site.css
+        max_age seconds for a Cache-Control max-age header, None to leave it off
+        stat_cache_ttl seconds file metadata and ETags are cached
+        returns the StaticFiles handler
+        """
+        static_files = StaticFiles(directory, max_age=max_age, stat_cache_ttl=stat_cache_ttl)
+        uri = r'^' + re.escape(url_prefix.rstrip('/')) + r'/(?P<path>.+)$'
+        Server.handle('GET', uri)(static_files.serve)
+        return static_files
+
+    @staticmethod
+    def reload_handlers(modules=None):
+        """Reload the modules that registered handlers and swap in the routes they register in one go.
+
+        The new routes are built up off to the side so requests only ever see the old or
+        the new ones, never a mix. If a module fails to reload the old routes stay.
+        modules to reload, by default every module a registered handler comes from
+        returns the names of the reloaded modules
+        """
+        with Server.routes_lock:
+            routes = Server.routes
+            if modules is None:
+                modules = []
+                for method in routes.handlers:
+                    for func in routes.handlers[method].values():
+                        module = inspect.getmodule(func)
+                        if (module is not None and module.__name__ not in ("yahs", "__main__")
+                                and module not in modules):
+                            modules.append(module)
+
+            Server.staged_routes = routes
+            try:
+                for module in modules:
+                    logging.info("Reloading {} module.".format(module.__name__))
+                    reload_module(module)
+                Server.routes = Server.staged_routes
+                Server.handlers = Server.routes.handlers
+            finally:
+                Server.staged_routes = None
+        logging.info("Swapped in version %d of the routes", Server.routes.version)
+        return [module.__name__ for module in modules]
+
+    def __init__(self, hostname='localhost', port=4321, secure=False, keyfile=None, certfile=None,
+                 pool_size=None, pool_queue_size=128, keep_alive_timeout=5.0, max_keep_alive_requests=100,
+                 engine='threads', max_header_size=65536, max_body_size=None, spool_threshold=1048576,
+                 compression=False, workers=None, reuse_port=True, graceful_timeout=10.0,
+                 handshake_timeout=10.0, cert_reload_interval=5.0, backlog=128, header_timeout=10.0,
+                 body_timeout=30.0, write_timeout=30.0, max_connections=None, retry_after=1,
+                 server_timing=False, access_log=None, unix_socket=None, listen_fd=None, systemd=False,
+                 dual_stack=True, pipeline_depth=0, rate_limit=None):
         """Create a live running http server instance to go
 
         It will start listening on the specified port but won't run yet until start() is called.
+        pool_size number of pooled worker threads. None starts a new thread per connection.
+        pool_queue_size maximum accepted connections waiting for a pooled worker.
+        keep_alive_timeout seconds a persistent connection may sit idle between requests.
+        max_keep_alive_requests requests served over one connection before closing it.
+        engine 'threads' for ListenerThread/HttpWorker threads or 'asyncio' to serve
+        connections as coroutines with yahs_asyncio.AsyncServer (Python 3.7+).
+        max_header_size largest request line and headers accepted, larger gets 431.
+        max_body_size largest request body accepted, larger gets 413. None for no limit.
+        spool_threshold bytes of a streamed body RequestBody.spool() keeps in memory before using disk.
+        compression True to gzip/deflate responses for clients accepting it, or a configured Compressor.
+        workers number of pre-forked worker processes, None serves from this process.
+        reuse_port True for each worker process to bind its own SO_REUSEPORT socket, False (or no
+        SO_REUSEPORT on the platform) for the workers to share sockets bound before forking.
+        graceful_timeout seconds in flight requests get to finish when shutting down or restarting.
+        handshake_timeout seconds a secure connection gets to complete the TLS handshake.
+        cert_reload_interval seconds between checks for a changed certificate or key file, None to never reload.
+        backlog connections the kernel queues up waiting to be accepted.
+        header_timeout seconds a client gets to send the request line and headers, slower gets 408.
+        body_timeout seconds a client gets to send a whole request body.
+        write_timeout seconds sending a response may block for.
+        max_connections most connections open at once, more get a 503 straight away. None for no limit.
+        retry_after seconds in the Retry-After header of those 503 responses.
+        server_timing True to add a Server-Timing header breaking down where the time went on each request.
+        access_log an AccessLog setting the format, sampling and destination of the access log.
+        unix_socket path of a unix domain socket to serve http on instead of the hostname and port.
+        listen_fd file descriptor of an already listening socket to serve http on, e.g one kept open
+        across restarts by a process manager so connections queue up rather than get refused.
+        systemd True to serve on the sockets passed in by systemd socket activation (LISTEN_FDS),
+        the first for http and a second one, if passed, for https.
+        dual_stack False for an IPv6 hostname such as '::' to not accept IPv4 connections as well.
+        pipeline_depth pipelined GET, HEAD and OPTIONS requests to handle in parallel ahead of their turn,
+        0 to handle pipelined requests one after another. Responses go out in order either way.
+        rate_limit a RateLimiter applying per client request rate limits and concurrency caps to every route.
         """
         self.base_port = port
         self.hostname = hostname
@@ -370,39 +3473,366 @@ class Server:
         self.key_file = keyfile
         self.certificate_file = certfile
 
+        # connection settings handed to every HttpWorker
+        self.worker_options = {
+            'keep_alive_timeout': keep_alive_timeout,
+            'max_keep_alive_requests': max_keep_alive_requests,
+            'max_header_size': max_header_size,
+            'max_body_size': max_body_size,
+            'spool_threshold': spool_threshold,
+            'compressor': Compressor() if compression is True else (compression or None),
+            'handshake_timeout': handshake_timeout,
+            'header_timeout': header_timeout,
+            'body_timeout': body_timeout,
+            'write_timeout': write_timeout,
+            'connection_limit': ConnectionLimit(max_connections, retry_after) if max_connections else None,
+            'server_timing': server_timing,
+            'access_log': access_log or Server.access_log,
+            'pipeline_depth': pipeline_depth,
+            'rate_limiter': rate_limit
+        }
+        self.backlog = backlog
+        self.unix_socket = unix_socket
+        self.dual_stack = dual_stack
+        self.listen_fds = [listen_fd, None]  # http and https
+        if systemd:
+            fds = self.systemd_fds()
+            if not fds:
+                logging.warning("No sockets passed in by systemd, binding them instead")
+            self.listen_fds = (fds + [None, None])[:2]
+
+        # one SSLContext shared by every secure connection
+        self.tls = None
+        if secure:
+            try:
+                self.tls = TlsContext(certfile, keyfile, reload_interval=cert_reload_interval)
+            except (IOError, ssl.SSLError) as err:
+                logging.warning("Could not find SSL certificate or private key file. Not starting ssl")
+                logging.warning(err)
+
+        self.pool = None
+        if pool_size:
+            self.pool = WorkerPool(size=pool_size, queue_size=pool_queue_size, worker_options=self.worker_options)
+
+        self.workers = workers
+        # only sockets this process binds can be SO_REUSEPORT ones, the rest get shared by the workers
+        self.reuse_port = (reuse_port and hasattr(socket, 'SO_REUSEPORT') and unix_socket is None
+                           and self.listen_fds == [None, None])
+        self.graceful_timeout = graceful_timeout
+        self.children = {}  # worker process id to the time it started
+        self.retiring = set()  # worker processes being replaced by a rolling restart
+        self.worker_process = False  # True in a pre-forked worker
+        self.stopping = threading.Event()
+        self.restarting = threading.Event()
+        self.supervisor = None
+        self.listener = None
+        self.secure_listener = None
+
         # Bind the signal handler: SIGINT is send to the process when CTRL-C is pressed
         signal.signal(signal.SIGINT, self.handle_shutdown)
+        signal.signal(signal.SIGTERM, self.handle_shutdown)
+
+        self.engine = None
+        if engine == 'asyncio':
+            if workers:
+                raise ValueError("Pre-forked workers are only supported by the threads engine")
+            import yahs_asyncio
+            self.engine = yahs_asyncio.AsyncServer(hostname=hostname, port=port, secure=secure,
+                                                   keyfile=keyfile, certfile=certfile,
+                                                   worker_options=self.worker_options, tls=self.tls,
+                                                   backlog=backlog, unix_socket=unix_socket,
+                                                   listen_fds=self.listen_fds)
+            return
+        elif engine != 'threads':
+            raise ValueError("Unknown server engine {}".format(engine))
+
+        if not (workers and self.reuse_port):
+            # workers binding their own SO_REUSEPORT sockets mustn't leave one here nobody accepts on
+            self.listener = self.create_listener(secure=False)
 
-        self.listener = ListenerThread(args=(self.hostname, self.base_port, False))
-        self.listener.daemon = True
+    def create_listener(self, secure):
+        """Bind a ListenerThread for the http port, or the https one (port + 1) when secure.
+        """
+        kwargs = {'pool': self.pool, 'worker_options': self.worker_options,
+                  'reuse_port': bool(self.workers and self.reuse_port), 'backlog': self.backlog,
+                  'fd': self.listen_fds[1 if secure else 0], 'dual_stack': self.dual_stack}
+        port = self.base_port
+        if secure:
+            kwargs['tls'] = self.tls
+            port += 1
+        else:
+            kwargs['unix_socket'] = self.unix_socket
+        listener = ListenerThread(args=(self.hostname, port, secure), kwargs=kwargs)
+        listener.daemon = True
+        return listener
+
+    @staticmethod
+    def systemd_fds():
+        """File descriptors of the listening sockets systemd passed to this process, in order.
 
-    def handle_shutdown(self, signal_unused, frame_unused):
-        """If the server receives a signal (e.g. Ctrl-C/Ctrl-Break), terminate gracefully
+        They start at 3, LISTEN_FDS says how many and LISTEN_PID which process they're for.
+        The variables are removed so processes this one starts don't take them too.
         """
-        logging.info("SIGINT Signal received; exiting gracefully...")
+        if os.environ.get('LISTEN_PID') != str(os.getpid()):
+            return []
+        count = int(os.environ.get('LISTEN_FDS') or 0)
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+        return list(range(3, 3 + count))
+
+    def handle_shutdown(self, signal_number, frame_unused):
+        """If the server receives a signal (e.g. Ctrl-C/Ctrl-Break or SIGTERM), terminate gracefully
+
+        A supervisor passes it on to its worker processes and waits for them to finish,
+        other processes stop accepting and give in flight requests graceful_timeout to finish.
+        """
+        logging.info("Signal {} received; exiting gracefully...".format(signal_number))
+        if self.worker_process:
+            self.stopping.set()  # run_worker() takes care of the rest
+            return
+        self.stop()
         sys.exit(0)
 
+    def handle_restart(self, signal_unused, frame_unused):
+        """SIGHUP to a supervisor does a rolling restart of the worker processes.
+        """
+        self.restart_workers()
+
     def start(self):
         """Start the server mainloop.
 
         By now the server should have been inited and ready to enter the run loop.
         """
+        if self.engine is not None:
+            self.engine.start()
+            return self
+
+        if self.workers:
+            return self.start_workers()
+
+        return self.start_listening()
+
+    def start_listening(self):
+        """Start the worker pool and listener threads serving connections in this process.
+        """
+        if self.pool is not None:
+            self.pool.start()
 
+        if self.listener is None:
+            self.listener = self.create_listener(secure=False)
         self.listener.start()
 
-        if self.secure:
-            key_dict = {'keyfile': self.key_file, 'certfile': self.certificate_file}
-            secure_listener = ListenerThread(args=(self.hostname, self.base_port + 1, True), kwargs=key_dict)
-            secure_listener.daemon = True
-            secure_listener.start()
+        if self.secure and self.tls is not None:
+            if self.secure_listener is None:
+                self.secure_listener = self.create_listener(secure=True)
+            self.secure_listener.start()
 
         return self
 
+    def start_workers(self):
+        """Pre-fork the worker processes and supervise them from a background thread.
+        """
+        if not self.reuse_port and self.secure and self.tls is not None:
+            # bound before forking so every worker inherits it
+            self.secure_listener = self.create_listener(secure=True)
+
+        for _ in range(self.workers):
+            self.spawn_worker()
+
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        self.supervisor = threading.Thread(target=self.supervise, name="yahs-supervisor")
+        self.supervisor.daemon = True
+        self.supervisor.start()
+        return self
+
+    def spawn_worker(self, wait_ready=False):
+        """Fork a worker process, returns its process id.
+
+        wait_ready True to wait up to graceful_timeout for the worker to be listening
+        """
+        ready_read = ready_write = None
+        if wait_ready:
+            ready_read, ready_write = os.pipe()  # the worker writes a byte once it's listening
+        pid = os.fork()
+        if pid == 0:
+            if ready_read is not None:
+                os.close(ready_read)
+            try:
+                self.run_worker(ready_write)
+            except Exception:
+                logging.exception("Worker process %d failed", os.getpid())
+            finally:
+                os._exit(0)  # never return into the supervisor's code
+
+        self.children[pid] = time.time()
+        logging.info("Started worker process %d", pid)
+        if wait_ready:
+            os.close(ready_write)
+            try:
+                if not self.worker_ready(ready_read):
+                    logging.warning("Worker process %d isn't listening after %s seconds", pid,
+                                    self.graceful_timeout)
+            finally:
+                os.close(ready_read)
+        return pid
+
+    def worker_ready(self, ready_read):
+        """Wait for a new worker process to say it's listening, False if it exited or took too long.
+        """
+        readable, writable, failed = select.select([ready_read], [], [], self.graceful_timeout)
+        return bool(readable) and os.read(ready_read, 1) == b'1'
+
+    def run_worker(self, ready_write=None):
+        """Main loop of a pre-forked worker process.
+
+        Serves connections until told to stop by a signal or the supervisor going away,
+        then stops accepting and lets in flight requests finish.
+        ready_write pipe file descriptor to tell the supervisor the worker is listening on
+        """
+        self.worker_process = True
+        self.children = {}
+        signal.signal(signal.SIGINT, self.handle_shutdown)
+        signal.signal(signal.SIGTERM, self.handle_shutdown)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        self.start_listening()
+        if ready_write is not None:
+            os.write(ready_write, b'1')
+            os.close(ready_write)
+        supervisor = os.getppid()
+        while not self.stopping.wait(1):
+            if os.getppid() != supervisor:
+                logging.warning("Supervisor went away, worker process %d exiting", os.getpid())
+                break
+        self.stop_listening()
+        self.drain()
+        self.worker_options['access_log'].flush()
+
+    def supervise(self):
+        """Reap worker processes that exit, restarting them unless they were retired.
+        """
+        while not self.stopping.is_set():
+            if self.restarting.is_set():
+                self.restarting.clear()
+                self.rolling_restart()
+
+            for pid in list(self.children):
+                try:
+                    exited, status = os.waitpid(pid, os.WNOHANG)
+                except OSError:
+                    exited, status = pid, 0
+                if not exited:
+                    continue
+
+                started = self.children.pop(pid)
+                if pid in self.retiring or self.stopping.is_set():
+                    continue
+                logging.warning("Worker process %d exited with status %d, restarting it", pid, status)
+                if time.time() - started < 1:
+                    time.sleep(1)  # don't spin on a worker that dies straight away
+                self.spawn_worker()
+            self.stopping.wait(0.2)
+
+    def restart_workers(self):
+        """Ask the supervisor for a rolling restart, e.g after deploying new handler code.
+
+        Each worker process is replaced by a fresh one, the old one is only asked to finish
+        its in flight requests and exit once the new one says it's listening.
+        """
+        self.restarting.set()
+
+    def rolling_restart(self):
+        """Replace the worker processes one at a time.
+        """
+        logging.info("Rolling restart of %d worker processes", len(self.children))
+        for pid in list(self.children):
+            self.spawn_worker(wait_ready=True)
+            self.retiring.add(pid)
+            self.terminate_worker(pid)
+            self.children.pop(pid, None)
+            self.retiring.discard(pid)
+
+    def terminate_worker(self, pid):
+        """SIGTERM a worker process and wait for it to exit, SIGKILL it after graceful_timeout.
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            return
+        deadline = time.time() + self.graceful_timeout
+        while time.time() < deadline:
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                return
+            if exited:
+                return
+            time.sleep(0.05)
+        logging.warning("Worker process %d didn't finish in time, killing it", pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def stop(self):
+        """Stop serving. A supervisor stops its worker processes, otherwise in flight requests are drained.
+        """
+        self.stopping.set()
+        if self.engine is not None:
+            self.engine.stop()
+            return
+
+        if self.supervisor is not None:
+            for pid in list(self.children):
+                self.retiring.add(pid)
+                self.terminate_worker(pid)
+                self.children.pop(pid, None)
+            self.supervisor.join(self.graceful_timeout)
+            for listener in (self.listener, self.secure_listener):
+                if listener is not None:
+                    listener.close()
+            return
+
+        self.stop_listening()
+        self.drain()
+        self.worker_options['access_log'].flush()
+
+    def stop_listening(self):
+        """Stop accepting new connections.
+        """
+        # sockets inherited from a supervisor are shared, shutting them down would stop the other workers
+        shared = self.worker_process and not self.reuse_port
+        for listener in (self.listener, self.secure_listener):
+            if listener is not None:
+                listener.stop(shutdown=not shared)
+
+    def drain(self):
+        """Wait up to graceful_timeout for in flight connections to finish.
+        """
+        deadline = time.time() + self.graceful_timeout
+        while self.in_flight() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def in_flight(self):
+        """Number of connections queued or being processed.
+        """
+        if self.pool is not None:
+            return self.pool.busy_workers + self.pool.queue_depth
+        return len([thread for thread in threading.enumerate() if isinstance(thread, HttpWorker)])
+
     def wait(self):
         """Helper to block main thread to keep process running.
         """
         logging.info('Waiting for connections...')
-        while self.listener.is_alive:
+        if self.engine is not None:
+            self.engine.wait()
+            return
+        if self.supervisor is not None:
+            while self.supervisor.is_alive():
+                self.supervisor.join(1)
+            return
+        while self.listener.is_alive():
             self.listener.join(1)
 
 
@@ -416,11 +3846,12 @@ def api_index(request):
     response = Response()
     body = "<h1>Welcome to YaHS! API Index</h1>"
 
-    for method in Server.handlers:
+    routes = Server.routes
+    for method in routes.handlers:
         body += "<h2 style='color: #555;'>{}</h2>".format(method)
-        for regex in Server.handlers[method]:
+        for regex in routes.handlers[method]:
             body += "<ul>"
-            func = Server.handlers[method][regex]
+            func = routes.handlers[method][regex]
             module = inspect.getmodule(func)
             var_names = func.func_code.co_varnames[:func.func_code.co_argcount]
             body += "<li><strong>{}</strong> <pre>{}: <span style='color: #00a;'>def</span> {}{}</pre><em>{}</em></li>".format(
@@ -455,9 +3886,10 @@ def api_docs(request):
     <body>
     <h2>YaHS Live API Docs</h2>
     """
-    for method in Server.handlers:
-        for urlpattern in Server.handlers[method]:
-            func = Server.handlers[method][urlpattern]
+    routes = Server.routes
+    for method in routes.handlers:
+        for urlpattern in routes.handlers[method]:
+            func = routes.handlers[method][urlpattern]
             module = inspect.getmodule(func)
             # var_names = func.func_code.co_varnames[:func.func_code.co_argcount]  # python 2.7.x
             var_names = func.__code__.co_varnames[:func.__code__.co_argcount]  # 3.4.x
@@ -473,22 +3905,68 @@ def api_docs(request):
     return body
 
 
+@Server.handle('GET', r'^/yahs/metrics$')
+def server_metrics(request):
+    """Request counters, in flight gauges, byte counts and latency histograms in Prometheus text format
+    """
+    response = Response()
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.body = Server.metrics.render()
+    return response
+
+
+@Server.handle('POST', r'^/yahs/batch/?$')
+def batch_requests(request):
+    """Handle a JSON array of {"method", "uri", "headers", "body"} sub-requests in one go.
+
+    Responds with a JSON array of {"status", "headers", "body"} results in the same order
+    """
+    return Server.batch.handle(request)
+
+
+@Server.handle('GET', r'^/yahs/profile/?$')
+def profile_server(request):
+    """Profile handlers with cProfile for ?seconds=10 then show the aggregated stats.
+
+    seconds has to be more than 0 and at most Profiler.max_seconds.
+    ?percent=5 samples that share of requests, ?route= only profiles the route with that url pattern
+    and ?sort= orders the pstats output (cumulative by default)
+    """
+    try:
+        seconds = float(request.get_query.get('seconds', ['10'])[0])
+        percent = float(request.get_query.get('percent', ['100'])[0])
+    except ValueError:
+        return HttpError(400, 'Bad Request').response()
+    if not 0 < seconds <= Server.profiler.max_seconds:
+        return HttpError(400, 'Bad Request').response()
+    pattern = request.get_query.get('route', [None])[0]
+    sort = request.get_query.get('sort', ['cumulative'])[0]
+
+    if not Server.profiler.start(seconds, percent, pattern):
+        return HttpError(409, 'Conflict').response()
+    logging.warning("Profiling %s%% of requests to %s for %s seconds", percent, pattern or 'all routes', seconds)
+    time.sleep(seconds)
+    Server.profiler.stop()
+
+    response = Response()
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    try:
+        response.body = Server.profiler.report(sort)
+    except KeyError:
+        return HttpError(400, 'Bad Request').response()  # unknown sort key
+    return response
+
+
 @Server.handle("GET", r'^/yahs/reload/?$')
 def reload_server(request):
     """Re-Load the server event handling module
     """
     logging.warning("Reloading event handler modules")
-    reloaded_modules = []
-    for method in Server.handlers:
-        for regex in Server.handlers[method]:
-            func = Server.handlers[method][regex]
-            module = inspect.getmodule(func)
-
-            if module.__name__ != "yahs":
-                if module not in reloaded_modules:
-                    logging.info("Reloading {} module.".format(module.__name__))
-                    reload(module)
-                    reloaded_modules.append(module)
+    try:
+        Server.reload_handlers()
+    except Exception:
+        logging.exception("Reloading failed, keeping the routes as they were")
+        return HttpError(500, 'Internal Server Error').response()
 
     res = Response()
     res.body = "Server reloaded"
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""asyncio engine for Yet another HTTP Server (YaHS)
+
+Serves the same Server.handle registered handlers using asyncio streams so each
+connection costs a coroutine rather than an OS thread. Handlers can be plain
+functions, which get run in a thread pool executor, or 'async def' coroutines
+which run straight on the event loop. Requires Python 3.7+.
+"""
+__author__ = 'Tim Sullivan'
+__license__ = 'MIT'
+
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from yahs import HttpError, HttpWorker, RateLimiter, RequestBody, Response, ResponseCache, Server, TlsContext
+
+
+class StreamSocket:
+    """Socket lookalike letting Response.send write into an asyncio StreamWriter.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+        return len(data)
+
+    sendall = send
+
+
+class AsyncServer:
+    """Server listening for secure and non-secure connections on an asyncio event loop.
+
+    Has the same start()/wait() life cycle as Server, running the event loop in a
+    background thread. Use Server(engine='asyncio') to get one of these.
+    """
+
+    def __init__(self, hostname='localhost', port=4321, secure=False, keyfile=None, certfile=None,
+                 worker_options=None, executor_workers=None, tls=None, backlog=128, unix_socket=None,
+                 listen_fds=None):
+        """Create an asyncio server, nothing is listening until start() or run() is called.
+
+        worker_options the same connection settings a HttpWorker takes, see Server
+        executor_workers threads available for running blocking (non async) handlers.
+        tls a shared TlsContext, by default one is loaded from the keyfile and certfile.
+        backlog connections the kernel queues up waiting to be accepted.
+        unix_socket path of a unix domain socket to serve http on instead of the hostname and port.
+        listen_fds file descriptors of already listening sockets for http and https, None to bind them.
+        """
+        self.hostname = hostname
+        self.base_port = port
+        self.secure = secure
+        self.key_file = keyfile
+        self.certificate_file = certfile
+
+        if worker_options is None:
+            worker_options = {}
+        self.keep_alive_timeout = worker_options.get('keep_alive_timeout', 5.0)
+        self.max_keep_alive_requests = worker_options.get('max_keep_alive_requests', 100)
+        self.max_header_size = worker_options.get('max_header_size', 65536)
+        self.max_body_size = worker_options.get('max_body_size')
+        self.spool_threshold = worker_options.get('spool_threshold', 1048576)
+        self.compressor = worker_options.get('compressor')
+        self.handshake_timeout = worker_options.get('handshake_timeout', 10.0)
+        self.header_timeout = worker_options.get('header_timeout', 10.0)
+        self.body_timeout = worker_options.get('body_timeout', 30.0)
+        self.write_timeout = worker_options.get('write_timeout', 30.0)
+        self.connection_limit = worker_options.get('connection_limit')
+        self.server_timing = worker_options.get('server_timing', False)
+        self.access_log = worker_options.get('access_log') or Server.access_log
+        self.rate_limiter = worker_options.get('rate_limiter')
+        self.tls = tls
+        self.backlog = backlog
+        self.unix_socket = unix_socket
+        self.listen_fds = listen_fds or [None, None]
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+
+        self.loop = None
+        self.servers = []
+        self.thread = None
+        self.ready = threading.Event()
+
+    def ssl_context(self):
+        if self.tls is None:
+            self.tls = TlsContext(self.certificate_file, self.key_file)
+        return self.tls.context()
+
+    async def serve(self):
+        """Start listening and serve connections until cancelled.
+        """
+        self.loop = asyncio.get_event_loop()
+        logging.info("Starting AsyncServer on {0}:{1}".format(self.hostname, self.base_port))
+        if self.unix_socket is not None and self.listen_fds[0] is None:
+            self.servers.append(await asyncio.start_unix_server(self.handle_connection, self.unix_socket,
+                                                                limit=self.max_header_size, backlog=self.backlog))
+        else:
+            self.servers.append(await asyncio.start_server(self.handle_connection, **self.listen_arguments(0)))
+        if self.secure:
+            try:
+                context = self.ssl_context()
+            except (IOError, ssl.SSLError) as err:
+                logging.warning("Could not find SSL certificate or private key file. Not starting ssl")
+                logging.warning(err)
+            else:
+                self.servers.append(await asyncio.start_server(self.handle_connection, ssl=context,
+                                                               ssl_handshake_timeout=self.handshake_timeout,
+                                                               **self.listen_arguments(1)))
+        self.ready.set()
+        await asyncio.gather(*[server.wait_closed() for server in self.servers])
+
+    def listen_arguments(self, offset):
+        """start_server arguments for the http (offset 0) or https (offset 1) socket.
+        """
+        arguments = {'limit': self.max_header_size, 'backlog': self.backlog}
+        fd = self.listen_fds[offset]
+        if fd is not None:
+            arguments['sock'] = socket.socket(fileno=os.dup(fd))
+        else:
+            arguments['host'] = self.hostname
+            arguments['port'] = self.base_port + offset
+        return arguments
+
+    def run(self):
+        """Run the event loop in the calling thread until the server is stopped.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+
+    def start(self):
+        """Run the event loop in a background daemon thread.
+        """
+        self.thread = threading.Thread(target=self.run, name="yahs-asyncio")
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def wait(self):
+        """Helper to block main thread to keep process running.
+        """
+        logging.info('Waiting for connections...')
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+    def stop(self):
+        """Stop listening, the event loop exits once the servers have closed.
+        """
+        for server in self.servers:
+            self.loop.call_soon_threadsafe(server.close)
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests over one client connection, persisting it while the client wants.
+        """
+        address = writer.get_extra_info('peername')
+        if self.connection_limit is not None and not self.connection_limit.acquire():
+            logging.warning("Over max_connections, rejecting connection from %s", address)
+            Server.metrics.connection_rejected()
+            writer.write(self.connection_limit.rejection)
+            writer.close()
+            return
+
+        Server.metrics.connection_opened()
+        handled = 0
+        try:
+            while True:
+                try:
+                    # new connections get header_timeout and idle persistent ones keep_alive_timeout
+                    head = await asyncio.wait_for(self.read_head(reader),
+                                                  self.keep_alive_timeout if handled else self.header_timeout)
+                    if head is None:
+                        break  # client closed the connection
+                    started = time.time()
+                    request, found, received = await self.read_request(reader, head, address)
+                except HttpError as err:
+                    logging.info("Rejecting request from %s: %s %s", address, err.status_code, err.status_message)
+                    response = err.response()
+                    response.headers['Connection'] = 'close'
+                    response.send(StreamSocket(writer))
+                    await asyncio.wait_for(writer.drain(), self.write_timeout)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as err:
+                    logging.debug("Closing connection from %s: %r", address, err)
+                    break
+
+                method = request.method
+                route = '' if isinstance(found, Response) else found[2]['pattern']
+                parsed = time.time()
+                Server.metrics.begin(method, route)
+                response = None
+                sent = 0
+                timings = [('parse', parsed - started)]
+                try:
+                    response = await self.dispatch(request, found)
+                    handled += 1
+                    handler_done = time.time()
+                    timings.append(('handler', handler_done - parsed))
+                    if self.compressor is not None:
+                        self.compressor.compress(request, response)
+
+                    chunked = request.version == 'HTTP/1.1'
+                    keep_alive = request.wants_keep_alive() and handled < self.max_keep_alive_requests
+                    if response.streaming() and not chunked and 'Content-Length' not in response.headers:
+                        keep_alive = False  # closing the connection marks the end of the body
+                    response.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                    if self.server_timing:
+                        HttpWorker.add_server_timing(response, timings, chunked)
+
+                    # drain as we go so a streamed body doesn't pile up in the transport buffer
+                    pieces = response.output(chunked)
+                    pull = None
+                    if response.streaming():
+                        # generators and files may block, so they're read in the executor not the event loop
+                        pull = functools.partial(self.loop.run_in_executor, self.executor, next, pieces, None)
+                    try:
+                        while True:
+                            data = next(pieces, None) if pull is None else await pull()
+                            if data is None:
+                                break
+                            writer.write(data)
+                            sent += len(data)
+                            await asyncio.wait_for(writer.drain(), self.write_timeout)
+                    finally:
+                        pieces.close()
+                        timings.append(('send', time.time() - handler_done))
+                finally:
+                    Server.metrics.end(method, route, 500 if response is None else response.status_code,
+                                       received, sent, timings)
+                    if response is not None:
+                        response.bytes_sent = sent
+                        self.access_log.log(request, response, time.time() - started)
+
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError) as err:
+            logging.debug("Lost connection from %s: %r", address, err)
+        finally:
+            writer.close()
+            Server.metrics.connection_closed()
+            if self.connection_limit is not None:
+                self.connection_limit.release()
+
+    async def read_head(self, reader):
+        """Read the request line and headers, None on a clean EOF.
+        """
+        try:
+            return await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as err:
+            if not err.partial:
+                return None
+            raise
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, 'Request Header Fields Too Large')
+
+    async def read_request(self, reader, head, address):
+        """Make the Request from its head and read its body according to the route it matched.
+
+        returns the Request, the find_handler result for it and the bytes received
+        """
+        request = HttpWorker.build_request(head, address)
+        found = HttpWorker.find_handler(request)
+
+        options = Server.default_route_options if isinstance(found, Response) else found[2]
+        max_body_size = options['max_body_size']
+        if max_body_size is None:
+            max_body_size = self.max_body_size
+
+        content_length = HttpWorker.content_length(request, max_body_size)
+        deadline = None if self.body_timeout is None else self.loop.time() + self.body_timeout
+        if options['stream_body']:
+            request.body = await self.spool_body(reader, content_length, deadline)
+        elif content_length:
+            body = bytearray()
+            while len(body) < content_length:
+                body += await self.read_chunk(reader, content_length - len(body), deadline)
+            request.body = body
+        return request, found, len(head) + content_length
+
+    async def spool_body(self, reader, content_length, deadline=None):
+        """Read a stream_body route's body off the stream into a spooled temporary file.
+
+        The handler may be blocking in another thread so rather than reading the stream
+        it gets a RequestBody over the spooled copy.
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        remaining = content_length
+        while remaining:
+            chunk = await self.read_chunk(reader, remaining, deadline)
+            spooled.write(chunk)
+            remaining -= len(chunk)
+        spooled.seek(0)
+
+        def readinto(view):
+            data = spooled.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+
+        return RequestBody(readinto, content_length, self.spool_threshold)
+
+    async def read_chunk(self, reader, remaining, deadline=None):
+        """Read the next piece of a body, which all has to have arrived by the loop time deadline.
+        """
+        timeout = None if deadline is None else max(0, deadline - self.loop.time())
+        chunk = await asyncio.wait_for(reader.read(min(remaining, RequestBody.chunk_size)), timeout)
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', remaining)
+        return chunk
+
+    async def dispatch(self, request, found):
+        """Call the registered handler found for the Request.
+
+        Coroutine handlers are awaited on the loop, blocking handlers are offloaded to the executor
+        where Server.profiler can sample them and coalesce routes share calls. The rate limits
+        are checked first.
+        """
+        if isinstance(found, Response):
+            return found
+
+        func, args, options = found
+        try:
+            admitted = HttpWorker.admit(request, func, options, self.rate_limiter)
+        except HttpError as err:
+            return err.response()
+        try:
+            return await self.respond(request, func, args, options)
+        finally:
+            RateLimiter.release_all(admitted)
+
+    async def respond(self, request, func, args, options):
+        """Get the handler's Response, from Server.response_cache on cache_ttl routes.
+        """
+        cache_ttl = options['cache_ttl']
+        if cache_ttl:
+            response = Server.response_cache.fetch(request)
+            if response is not None:
+                return ResponseCache.not_modified(request, response)
+
+        if asyncio.iscoroutinefunction(func):
+            try:
+                res = await func(request, **args)
+            except HttpError as err:
+                res = err.response()
+        else:
+            res = await self.loop.run_in_executor(self.executor, functools.partial(HttpWorker.run_handler, func,
+                                                                                   request, args, options))
+            if inspect.isawaitable(res):
+                res = await res
+        response = HttpWorker.make_response(res)
+
+        if cache_ttl:
+            Server.response_cache.store(request, response, cache_ttl, options['pattern'])
+            response = ResponseCache.not_modified(request, response)
+        return response
@@ -4,15 +4,44 @@ import unittest
 import logging
 import json
 import random
+import hashlib
+import tempfile
+import zlib
+import time
+import tracemalloc
 import requests
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
 
 import os
-from yahs import Server, Response
+import sys
+import signal
+import io
+import threading
+import shutil
+import ssl
+import re
+import socket
+import collections
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+from yahs import Server, Response, RouteIndex, Compressor, Request, ResponseCache, TlsContext, HttpWorker, AccessLog, \
+    FormParser, HttpError, RateLimiter, WsgiApp, TestClient, Profiler, RequestBody
 
 products = ['apple', 'cake', 'tree', 'fish']
 media = {}
+uploads = {}
+slow_calls = []
+report_calls = []
+
+catalogue = [{'id': number, 'name': 'product {}'.format(number)} for number in range(200)]
+
+static_directory = tempfile.mkdtemp()
+static_content = os.urandom(200000)
+with open(os.path.join(static_directory, 'blob.bin'), 'wb') as static_file:
+    static_file.write(static_content)
 
 class TestYAHS(unittest.TestCase):
     @classmethod
@@ -58,6 +87,1340 @@ class TestYAHS(unittest.TestCase):
         res = requests.get("https://localhost:4322/products/", verify=False)
         self.assertEqual(200, res.status_code, "Expects status code 200")
 
+    def test_keep_alive(self):
+        conn = httplib.HTTPConnection("localhost", 4321)
+        conn.request("GET", "/products/")
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual('keep-alive', res.getheader('Connection'))
+        first_socket = conn.sock
+
+        conn.request("POST", "/media/keepalive", body="still here")
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual(204, res.status)
+        self.assertIs(first_socket, conn.sock, "connection should be reused")
+        conn.close()
+
+    def test_connection_close(self):
+        conn = httplib.HTTPConnection("localhost", 4321)
+        conn.request("GET", "/products/", headers={'Connection': 'close'})
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual('close', res.getheader('Connection'))
+        conn.close()
+
+    def test_http10_closes(self):
+        client = socket.create_connection(("localhost", 4321))
+        client.sendall(b"GET /products/ HTTP/1.0\r\n\r\n")
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break  # server closed the connection after the response
+            data += chunk
+        client.close()
+        self.assertTrue(data.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'Connection: close', data)
+
+    def raw_request(self, *parts):
+        client = socket.create_connection(("localhost", 4321))
+        for part in parts:
+            client.sendall(part)
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        return data
+
+    def test_bad_request_line(self):
+        data = self.raw_request(b"NONSENSE\r\n\r\n")
+        self.assertTrue(data.startswith(b'HTTP/1.1 400'))
+
+    def test_headers_too_large(self):
+        data = self.raw_request(b"GET /products/ HTTP/1.1\r\nX-Junk: " + b"j" * 70000 + b"\r\n\r\n")
+        self.assertTrue(data.startswith(b'HTTP/1.1 431'))
+
+    def test_split_request(self):
+        body = b"split body"
+        data = self.raw_request(b"POST /media/split HTTP/1.1\r", b"\nContent-Length: 10\r\nConnection: close\r\n\r",
+                                b"\nsplit", b" body")
+        self.assertTrue(data.startswith(b'HTTP/1.1 204'))
+        self.assertEqual(body, media['split'])
+
+    def test_streamed_upload(self):
+        data = os.urandom(1024 * 1024 + 7)
+        res = requests.put('http://localhost:4321/uploads/big', data)
+        self.assertEqual(201, res.status_code)
+        self.assertEqual(hashlib.sha1(data).hexdigest(), uploads['big'])
+
+    def test_streamed_upload_route_limit(self):
+        res = requests.put('http://localhost:4321/uploads/huge', b"x" * (2 * 1024 * 1024 + 1))
+        self.assertEqual(413, res.status_code)
+        self.assertNotIn('huge', uploads)
+
+    def test_unread_streamed_body(self):
+        conn = httplib.HTTPConnection("localhost", 4321)
+        conn.request("POST", "/uploads/ignored", body=b"x" * 1000)
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual(202, res.status)
+        first_socket = conn.sock
+        conn.request("GET", "/products/")
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual(200, res.status)
+        self.assertIs(first_socket, conn.sock, "small unread body should be discarded keeping the connection")
+        conn.close()
+
+    def test_chunked_generator_response(self):
+        res = requests.get('http://localhost:4321/stream/lines/5')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('chunked', res.headers['Transfer-Encoding'])
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual("".join("line {}\n".format(number) for number in range(5)), res.text)
+
+    def test_file_response_with_length(self):
+        res = requests.get('http://localhost:4321/stream/file')
+        self.assertEqual(200, res.status_code)
+        self.assertNotIn('Transfer-Encoding', res.headers)
+        with open(__file__, 'rb') as source:
+            self.assertEqual(source.read(), res.content)
+
+    def test_http10_streamed_response(self):
+        data = self.raw_request(b"GET /stream/lines/3 HTTP/1.0\r\n\r\n")
+        self.assertIn(b'Connection: close', data)
+        self.assertNotIn(b'Transfer-Encoding', data)
+        self.assertTrue(data.endswith(b"line 0\nline 1\nline 2\n"))
+
+    def test_back_to_back_requests(self):
+        data = self.raw_request(b"POST /media/first HTTP/1.1\r\nContent-Length: 3\r\n\r\nonePOST /media/second"
+                                b" HTTP/1.1\r\nContent-Length: 3\r\nConnection: close\r\n\r\ntwo")
+        self.assertEqual(2, data.count(b'HTTP/1.1 204'))
+        self.assertEqual(b"one", media['first'])
+        self.assertEqual(b"two", media['second'])
+
+class TestTls(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        keyfile = os.path.join(os.path.dirname(__file__), "test-key.pem")
+        certfile = os.path.join(os.path.dirname(__file__), "test-cert.crt")
+        cls.server = Server(port=4361, secure=True, keyfile=keyfile, certfile=certfile, handshake_timeout=1.0)
+        cls.server.start()
+
+    def setUp(self):
+        self.client_context = ssl.create_default_context()
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+
+    def https_request(self, session=None):
+        raw = socket.create_connection(('localhost', 4362), timeout=5)
+        client = self.client_context.wrap_socket(raw, server_hostname='localhost', session=session)
+        client.sendall(b'GET /products/ HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        response = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+        session, reused = client.session, client.session_reused
+        client.close()
+        return response, session, reused
+
+    def test_slow_handshake_doesnt_block_accept(self):
+        stalled = socket.create_connection(('localhost', 4362))
+        try:
+            res = requests.get("https://localhost:4362/products/", verify=False, timeout=5)
+            self.assertEqual(200, res.status_code)
+        finally:
+            stalled.close()
+
+    def test_session_resumption(self):
+        response, session, reused = self.https_request()
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertFalse(reused)
+
+        response, session, reused = self.https_request(session=session)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertTrue(reused)
+
+    def test_certificate_reload(self):
+        directory = tempfile.mkdtemp()
+        keyfile = os.path.join(directory, 'key.pem')
+        certfile = os.path.join(directory, 'cert.crt')
+        shutil.copy(os.path.join(os.path.dirname(__file__), "test-key.pem"), keyfile)
+        shutil.copy(os.path.join(os.path.dirname(__file__), "test-cert.crt"), certfile)
+
+        tls = TlsContext(certfile, keyfile, reload_interval=0)
+        first = tls.context()
+        self.assertIs(first, tls.context())
+
+        os.utime(certfile, (time.time() + 10, time.time() + 10))
+        second = tls.context()
+        self.assertIsNot(first, second)
+
+        # a broken certificate keeps the previous context
+        with open(certfile, 'w') as broken:
+            broken.write('not a certificate')
+        os.utime(certfile, (time.time() + 20, time.time() + 20))
+        self.assertIs(second, tls.context())
+        shutil.rmtree(directory)
+
+
+class TestAdmission(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(port=4371, max_connections=1, retry_after=2, header_timeout=0.5, body_timeout=1.0,
+                            backlog=16)
+        cls.server.start()
+
+    def setUp(self):
+        # connections from the previous test have to be closed first
+        limit = self.server.worker_options['connection_limit']
+        deadline = time.time() + 5
+        while limit.active and time.time() < deadline:
+            time.sleep(0.05)
+
+    def receive_all(self, client):
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        return data
+
+    def test_closed_without_request(self):
+        client = socket.create_connection(("localhost", 4371), timeout=5)
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(b'', self.receive_all(client), "nobody asked for a 400")
+
+    def test_slow_headers_timeout(self):
+        client = socket.create_connection(("localhost", 4371), timeout=5)
+        started = time.time()
+        client.sendall(b"GET /products/ HTTP/1.1\r\nHost: local")
+        data = self.receive_all(client)
+        self.assertTrue(data.startswith(b'HTTP/1.1 408'))
+        self.assertLess(time.time() - started, 2)
+
+    def test_slow_body_timeout(self):
+        client = socket.create_connection(("localhost", 4371), timeout=0.3)
+        started = time.time()
+        client.sendall(b"POST /media/drip HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100\r\n\r\n")
+        closed = False
+        while not closed and time.time() - started < 4:
+            try:
+                client.sendall(b"x")
+                closed = client.recv(4096) == b''
+            except socket.timeout:
+                pass
+            except socket.error:
+                closed = True
+        client.close()
+        self.assertTrue(closed, "a body drip fed a byte at a time kept the connection open")
+        self.assertLess(time.time() - started, 2)
+
+    def test_overloaded_503(self):
+        held = socket.create_connection(("localhost", 4371), timeout=5)
+        try:
+            time.sleep(0.1)
+            client = socket.create_connection(("localhost", 4371), timeout=5)
+            data = self.receive_all(client)
+            self.assertTrue(data.startswith(b'HTTP/1.1 503'))
+            self.assertIn(b'Retry-After: 2\r\n', data)
+        finally:
+            held.close()
+
+    def test_declared_body_not_preallocated(self):
+        server_side, client = socket.socketpair()
+        worker = HttpWorker(args=(server_side, ('127.0.0.1', 0)))
+        client.sendall(b'abc')
+        client.close()
+        tracemalloc.start()
+        try:
+            self.assertRaises(socket.error, worker.receive_body, 200 * 1024 * 1024)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            server_side.close()
+        self.assertLess(peak, 1024 * 1024)
+
+    def test_body_grows_as_it_arrives(self):
+        server_side, client = socket.socketpair()
+        worker = HttpWorker(args=(server_side, ('127.0.0.1', 0)))
+        data = os.urandom(300000)
+        threading.Thread(target=client.sendall, args=(data,)).start()
+        try:
+            self.assertEqual(data, bytes(worker.receive_body(len(data))))
+        finally:
+            client.close()
+            server_side.close()
+
+    def test_secure_rejected_without_plain_text(self):
+        server_side, client = socket.socketpair()
+        rejected = Server.metrics.rejected
+        self.server.worker_options['connection_limit'].reject(server_side, secure=True)
+        self.assertEqual(b'', self.receive_all(client))
+        self.assertEqual(rejected + 1, Server.metrics.rejected)
+
+    def test_metrics(self):
+        self.assertEqual(200, requests.get("http://localhost:4371/products/").status_code)
+        self.setUp()
+        res = requests.get("http://localhost:4371/yahs/metrics")
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.headers['Content-Type'].startswith('text/plain'))
+        self.assertRegex(res.text, r'yahs_requests_total\{method="GET",route="\^/products/\$",status="200"\} \d+')
+        self.assertRegex(res.text, r'yahs_requests_in_flight\{method="GET",route="\^/yahs/metrics\$"\} 1\n')
+        for phase in ('accept', 'parse', 'dispatch', 'handler', 'send'):
+            self.assertRegex(res.text, r'yahs_phase_seconds_bucket\{le="\+Inf",method="GET",phase="' + phase +
+                             r'",route="\^/products/\$"\} \d+')
+        self.assertRegex(res.text, r'yahs_response_bytes_total\{method="GET",route="\^/products/\$"\} [1-9]')
+
+
+class TestListeners(unittest.TestCase):
+    def get(self, client):
+        client.sendall(b"GET /products/ HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        return data
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'yahs.sock')
+        server = Server(unix_socket=path, graceful_timeout=0.5).start()
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(5)
+            client.connect(path)
+            self.assertTrue(self.get(client).startswith(b'HTTP/1.1 200'))
+        finally:
+            server.stop()
+        self.assertFalse(os.path.exists(path))
+
+    def test_inherited_socket(self):
+        inherited = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        inherited.bind(('127.0.0.1', 0))
+        inherited.listen(16)
+        port = inherited.getsockname()[1]
+        server = Server(listen_fd=inherited.fileno(), graceful_timeout=0.5).start()
+        try:
+            self.assertEqual(200, requests.get("http://127.0.0.1:{}/products/".format(port)).status_code)
+        finally:
+            server.stop()
+        # still open and listening for whoever takes over next
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        client.close()
+        inherited.close()
+
+    def test_dual_stack(self):
+        if not socket.has_ipv6:
+            self.skipTest("no IPv6")
+        try:
+            server = Server(hostname='::', port=4381, graceful_timeout=0.5).start()
+        except socket.error:
+            self.skipTest("can't bind IPv6")
+        try:
+            for host in ('127.0.0.1', '::1'):
+                client = socket.create_connection((host, 4381), timeout=5)
+                self.assertTrue(self.get(client).startswith(b'HTTP/1.1 200'))
+        finally:
+            server.stop()
+
+    def test_systemd_fds(self):
+        os.environ['LISTEN_FDS'] = '2'
+        os.environ['LISTEN_PID'] = str(os.getpid() + 1)
+        self.assertEqual([], Server.systemd_fds())
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        self.assertEqual([3, 4], Server.systemd_fds())
+        self.assertNotIn('LISTEN_FDS', os.environ)
+        self.assertEqual([], Server.systemd_fds())
+
+
+class TestPipelining(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(port=4401, pipeline_depth=4)
+        cls.server.start()
+
+    def pipeline(self, requests_data, count):
+        client = socket.create_connection(("localhost", 4401), timeout=5)
+        client.sendall(requests_data)
+        reader = client.makefile('rb')
+        responses = []
+        for _ in range(count):
+            status = reader.readline()
+            length = 0
+            while True:
+                line = reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            responses.append((status.split()[1], reader.read(length)))
+        reader.close()
+        client.close()
+        return responses
+
+    def test_responses_in_order(self):
+        get = "GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        data = ''.join(get.format(uri) for uri in ('/process', '/nothing', '/products/', '/process')).encode()
+        responses = self.pipeline(data, 4)
+        self.assertEqual([b'200', b'404', b'200', b'200'], [status for status, body in responses])
+        self.assertEqual(products, json.loads(responses[2][1].decode()))
+
+    def test_safe_requests_in_parallel(self):
+        del slow_calls[:]
+        get = "GET /slow/{} HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        started = time.time()
+        responses = self.pipeline(''.join(get.format(name) for name in ('one', 'two', 'three')).encode(), 3)
+        self.assertLess(time.time() - started, 0.8)
+        self.assertEqual(['one', 'two', 'three'], [json.loads(body.decode())['name'] for status, body in responses])
+
+    def test_post_waits_its_turn(self):
+        data = (b"POST /products/ HTTP/1.1\r\nHost: localhost\r\nContent-Length: 8\r\n\r\npipeline"
+                b"GET /products/ HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        responses = self.pipeline(data, 2)
+        self.assertIn('pipeline', json.loads(responses[1][1].decode()))
+
+
+    def test_streamed_body_not_prefetched(self):
+        smuggled = b"GET /products/ HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        data = (b"GET /search HTTP/1.1\r\nHost: localhost\r\nContent-Length: " + str(len(smuggled)).encode() +
+                b"\r\n\r\n" + smuggled + b"GET /nothing HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        responses = self.pipeline(data, 2)
+        self.assertEqual([(b'200', smuggled), (b'404', responses[1][1])], responses)
+
+class TestProfiling(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(port=4391, server_timing=True)
+        cls.server.start()
+
+    def test_server_timing_header(self):
+        res = requests.get("http://localhost:4391/products/")
+        self.assertEqual(200, res.status_code)
+        self.assertRegex(res.headers['Server-Timing'], r'parse;dur=[0-9.]+, dispatch;dur=[0-9.]+, handler;dur=[0-9.]+')
+
+    def test_server_timing_trailer(self):
+        client = socket.create_connection(("localhost", 4391))
+        client.sendall(b"GET /stream/lines/3 HTTP/1.1\r\nConnection: close\r\n\r\n")
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        self.assertIn(b'Trailer: Server-Timing\r\n', data)
+        self.assertRegex(data, rb'\r\n0\r\nServer-Timing: send;dur=[0-9.]+\r\n\r\n$')
+
+    def test_profile(self):
+        results = []
+        profiling = threading.Thread(target=lambda: results.append(
+            requests.get("http://localhost:4391/yahs/profile", params={'seconds': 1, 'route': '^/catalogue$'})))
+        profiling.start()
+        while not Server.profiler.active():
+            time.sleep(0.01)
+        for _ in range(3):
+            requests.get("http://localhost:4391/catalogue")
+        requests.get("http://localhost:4391/products/")
+
+        res = requests.get("http://localhost:4391/yahs/profile", params={'seconds': 1})
+        self.assertEqual(409, res.status_code)
+
+        profiling.join()
+        self.assertEqual(200, results[0].status_code)
+        self.assertIn('3 requests profiled', results[0].text)
+        self.assertIn('get_catalogue', results[0].text)
+        self.assertNotIn('get_products', results[0].text)
+
+    def test_overlapping_samples(self):
+        profiler = Profiler()
+        results = []
+        calls = [threading.Thread(target=lambda number=number: results.append(profiler.runcall(
+            lambda: time.sleep(0.2) or number))) for number in range(3)]
+        for call in calls:
+            call.start()
+        for call in calls:
+            call.join()
+        self.assertEqual([0, 1, 2], sorted(results))
+        self.assertEqual(1, profiler.profiled, "one call is profiled at a time")
+        self.assertIn('1 requests profiled', profiler.report())
+
+    def test_profile_bad_duration(self):
+        for seconds in ('0', '-5', 'nan', '3600'):
+            res = requests.get("http://localhost:4391/yahs/profile", params={'seconds': seconds})
+            self.assertEqual(400, res.status_code)
+        self.assertFalse(Server.profiler.active())
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        del slow_calls[:]
+
+    def concurrent_get(self, url, count=5):
+        results = [None] * count
+
+        def get(number):
+            try:
+                results[number] = requests.get(url, timeout=5)
+            except requests.ConnectionError as err:
+                results[number] = err
+
+        threads = [threading.Thread(target=get, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_share_call(self):
+        results = self.concurrent_get("http://localhost:4321/slow/widgets?colour=red")
+        self.assertEqual(['widgets'], slow_calls)
+        for res in results:
+            self.assertEqual(200, res.status_code)
+            self.assertEqual({'name': 'widgets', 'query': {'colour': ['red']}}, res.json())
+
+    def test_different_queries_not_shared(self):
+        self.concurrent_get("http://localhost:4321/slow/widgets?colour=red", 2)
+        self.concurrent_get("http://localhost:4321/slow/widgets?colour=blue", 2)
+        self.assertEqual(['widgets', 'widgets'], slow_calls)
+
+    def test_error_propagated(self):
+        results = self.concurrent_get("http://localhost:4321/slow/broken", 3)
+        self.assertEqual(['broken'], slow_calls)
+        self.assertEqual([500, 500, 500], [res.status_code for res in results])
+
+    def test_waiters_time_out(self):
+        results = self.concurrent_get("http://localhost:4321/slower", 3)
+        self.assertEqual(['slower'], slow_calls)
+        self.assertEqual([200, 504, 504], [res.status_code for res in results])
+
+
+class TestBatch(unittest.TestCase):
+    def batch(self, items):
+        res = requests.post("http://localhost:4321/yahs/batch", data=json.dumps(items))
+        self.assertEqual(200, res.status_code)
+        return res.json()
+
+    def test_results_in_order(self):
+        results = self.batch([
+            {'method': 'POST', 'uri': '/products/', 'body': 'batched'},
+            {'uri': '/products/'},
+            {'uri': '/reports/daily?b=2&a=1'},
+            {'uri': '/nothing/here'},
+            {'method': 'POST', 'uri': '/yahs/batch', 'body': []},
+            {'uri': 42}
+        ])
+        self.assertEqual([200, 200, 200, 404, 400, 400], [result['status'] for result in results])
+        self.assertIn('batched', json.loads(results[1]['body']))
+        self.assertEqual('application/json', results[1]['headers']['Content-Type'])
+        self.assertEqual("report daily (('a', ('1',)), ('b', ('2',)))", results[2]['body'])
+
+    def test_safe_requests_in_parallel(self):
+        del slow_calls[:]
+        started = time.time()
+        results = self.batch([{'uri': '/slow/{}'.format(name)} for name in ('one', 'two', 'three')])
+        self.assertLess(time.time() - started, 0.8)
+        self.assertEqual(['one', 'two', 'three'], [json.loads(result['body'])['name'] for result in results])
+
+    def test_sub_requests_rate_limited(self):
+        client = TestClient(rate_limit=RateLimiter(rate=0.5, burst=3, max_concurrent=2))
+        response = client.request('POST', '/yahs/batch', json.dumps([{'uri': '/products/'}] * 4))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([200, 200, 200, 429], [result['status'] for result in json.loads(response.body)])
+        self.assertEqual(429, client.get('/products/').status_code, "the batch used up the client's tokens")
+
+    def test_sub_requests_rate_limited_on_both_engines(self):
+        for port, engine in ((4421, 'threads'), (4423, 'asyncio')):
+            server = Server(port=port, engine=engine, graceful_timeout=0.5,
+                            rate_limit=RateLimiter(rate=0.01, burst=2)).start()
+            try:
+                res = requests.post("http://localhost:{}/yahs/batch".format(port),
+                                    data=json.dumps([{'uri': '/products/'}] * 10))
+                self.assertEqual(200, res.status_code, engine)
+                self.assertEqual([200, 200] + [429] * 8, [result['status'] for result in res.json()], engine)
+            finally:
+                server.stop()
+
+    def test_bad_batch(self):
+        self.assertEqual(400, requests.post("http://localhost:4321/yahs/batch", data="[{").status_code)
+        self.assertEqual(413, requests.post("http://localhost:4321/yahs/batch",
+                                            data=json.dumps([{'uri': '/'}] * 100)).status_code)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def request(self, address='10.0.0.1', **headers):
+        return Request('GET', '/', headers=headers, address=(address, 1234))
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        for _ in range(3):
+            limiter.release(limiter.acquire(self.request()))
+        with self.assertRaises(HttpError) as raised:
+            limiter.acquire(self.request())
+        self.assertEqual(429, raised.exception.status_code)
+        self.assertEqual({'Retry-After': '1'}, raised.exception.headers)
+        limiter.release(limiter.acquire(self.request('10.0.0.2')))  # other clients have their own bucket
+        time.sleep(0.6)
+        limiter.release(limiter.acquire(self.request()))
+
+    def test_concurrency_cap(self):
+        limiter = RateLimiter(max_concurrent=2, key='X-Api-Key')
+        first = limiter.acquire(self.request(**{'X-Api-Key': 'abc'}))
+        limiter.acquire(self.request('10.0.0.2', **{'X-Api-Key': 'abc'}))
+        self.assertRaises(HttpError, limiter.acquire, self.request('10.0.0.3', **{'X-Api-Key': 'abc'}))
+        limiter.acquire(self.request())  # no key falls back to the address
+        limiter.release(first)
+        limiter.acquire(self.request(**{'X-Api-Key': 'abc'}))
+
+    def test_per_route(self):
+        limiter = RateLimiter(rate=1, burst=1, per_route=True)
+        limiter.acquire(self.request(), '^/a$')
+        limiter.acquire(self.request(), '^/b$')
+        self.assertRaises(HttpError, limiter.acquire, self.request(), '^/a$')
+
+    def test_max_clients(self):
+        limiter = RateLimiter(rate=1, burst=1, shards=1, max_clients=2)
+        for address in ('10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3'):
+            try:
+                limiter.acquire(self.request(address))
+            except HttpError:
+                pass
+        self.assertEqual(['10.0.0.1', '10.0.0.3'], list(limiter.shards[0][1]))
+        self.assertRaises(HttpError, limiter.acquire, self.request('10.0.0.1'))
+        limiter.acquire(self.request('10.0.0.2'))  # least recently seen, its bucket was dropped
+
+    def test_route_rate_limit(self):
+        headers = {'X-Client': 'limited'}
+        statuses = [requests.get("http://localhost:4321/limited", headers=headers) for _ in range(3)]
+        self.assertEqual([200, 200, 429], [res.status_code for res in statuses])
+        self.assertEqual('2', statuses[2].headers['Retry-After'])  # a token every 2 seconds
+        self.assertEqual(200, requests.get("http://localhost:4321/limited", headers={'X-Client': 'other'}).status_code)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        Server.invalidate_cache()
+        del report_calls[:]
+
+    def test_cached_route(self):
+        first = requests.get("http://localhost:4321/reports/sales?year=2015&region=north")
+        second = requests.get("http://localhost:4321/reports/sales?region=north&year=2015")
+        self.assertEqual(200, second.status_code)
+        self.assertEqual(first.text, second.text)
+        self.assertEqual(1, len(report_calls), "second request should come from the cache")
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+
+        requests.get("http://localhost:4321/reports/sales?year=2016")
+        self.assertEqual(2, len(report_calls), "different query is a different cache entry")
+
+    def test_conditional_get(self):
+        etag = requests.get("http://localhost:4321/reports/stock").headers['ETag']
+        res = requests.get("http://localhost:4321/reports/stock", headers={'If-None-Match': etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.content)
+        self.assertEqual(1, len(report_calls))
+
+    def test_conditional_get_compressed_variant(self):
+        response = Response()
+        response.body = "report"
+        response.headers['ETag'] = '"abc"'
+        request = Request('GET', '/reports/stock', {'If-None-Match': '"abc-gzip"'}, {})
+        not_modified = ResponseCache.not_modified(request, response)
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual('"abc-gzip"', not_modified.headers['ETag'])
+
+    def test_invalidate(self):
+        requests.get("http://localhost:4321/reports/stock")
+        requests.get("http://localhost:4321/reports/sales")
+        self.assertEqual(1, Server.invalidate_cache(uri='/reports/stock'))
+        requests.get("http://localhost:4321/reports/stock")
+        requests.get("http://localhost:4321/reports/sales")
+        self.assertEqual(3, len(report_calls))
+
+        self.assertEqual(2, Server.invalidate_cache(pattern=r'^/reports/(?P<name>[a-z]+)$'))
+        requests.get("http://localhost:4321/reports/sales")
+        self.assertEqual(4, len(report_calls))
+
+    def test_expiry(self):
+        requests.get("http://localhost:4321/reports/fresh")
+        time.sleep(0.6)
+        requests.get("http://localhost:4321/reports/fresh")
+        self.assertEqual(2, len(report_calls))
+
+    def test_lru_bounds(self):
+        cache = ResponseCache(max_entries=2, max_bytes=1000)
+        for uri in ('/a', '/b', '/c'):
+            response = Response()
+            response.body = "x" * 100
+            cache.store(Request('GET', uri, {}, {}), response, 60, 'test')
+        self.assertIsNone(cache.fetch(Request('GET', '/a', {}, {})))
+        self.assertIsNotNone(cache.fetch(Request('GET', '/c', {}, {})))
+
+        response = Response()
+        response.body = "x" * 950
+        cache.store(Request('GET', '/big', {}, {}), response, 60, 'test')
+        self.assertEqual(1, len(cache.entries), "byte bound should evict older entries")
+
+
+class TestStaticFiles(unittest.TestCase):
+    url = "http://localhost:4321/static/blob.bin"
+
+    def test_get_file(self):
+        res = requests.get(self.url)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(static_content, res.content)
+        self.assertEqual('bytes', res.headers['Accept-Ranges'])
+        self.assertTrue(res.headers['ETag'])
+
+    def test_https_get_file(self):
+        res = requests.get("https://localhost:4322/static/blob.bin", verify=False)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(static_content, res.content)
+
+    def test_if_none_match(self):
+        etag = requests.get(self.url).headers['ETag']
+        res = requests.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.content)
+
+    def test_if_modified_since(self):
+        last_modified = requests.get(self.url).headers['Last-Modified']
+        res = requests.get(self.url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, res.status_code)
+
+    def test_range(self):
+        res = requests.get(self.url, headers={'Range': 'bytes=100-199'})
+        self.assertEqual(206, res.status_code)
+        self.assertEqual('bytes 100-199/200000', res.headers['Content-Range'])
+        self.assertEqual(static_content[100:200], res.content)
+
+        res = requests.get(self.url, headers={'Range': 'bytes=-50'})
+        self.assertEqual(206, res.status_code)
+        self.assertEqual(static_content[-50:], res.content)
+
+        res = requests.get("https://localhost:4322/static/blob.bin", headers={'Range': 'bytes=199990-'},
+                           verify=False)
+        self.assertEqual(static_content[199990:], res.content)
+
+    def test_unsatisfiable_range(self):
+        res = requests.get(self.url, headers={'Range': 'bytes=300000-'})
+        self.assertEqual(416, res.status_code)
+        self.assertEqual('bytes */200000', res.headers['Content-Range'])
+
+    def test_missing_and_traversal(self):
+        self.assertEqual(404, requests.get("http://localhost:4321/static/missing.bin").status_code)
+        self.assertEqual(404, requests.get("http://localhost:4321/static/%2e%2e/%2e%2e/etc/passwd").status_code)
+        self.assertEqual(404, requests.get("http://localhost:4321/static/blob.bin%00").status_code)
+
+
+class TestWorkerPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(port=4331, pool_size=2, pool_queue_size=8, max_body_size=1024, compression=True)
+        cls.server.start()
+
+    def test_pooled_get_products(self):
+        for _ in range(5):
+            res = requests.get("http://localhost:4331/products/")
+            self.assertEqual(200, res.status_code, "Expects status code 200")
+
+    def test_body_too_large(self):
+        res = requests.post('http://localhost:4331/media/toolarge', "x" * 1025)
+        self.assertEqual(413, res.status_code)
+        self.assertNotIn('toolarge', media)
+
+    def test_compressed_response(self):
+        res = requests.get("http://localhost:4331/catalogue", headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(catalogue, res.json())
+        self.assertLess(int(res.headers['Content-Length']), len(json.dumps(catalogue)))
+
+        res = requests.get("http://localhost:4331/catalogue", headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(catalogue, res.json())
+
+    def test_small_response_not_compressed(self):
+        res = requests.get("http://localhost:4331/products/", headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_pool_stats(self):
+        stats = self.server.pool.stats()
+        self.assertEqual(2, stats['workers'])
+        self.assertEqual(8, stats['queue_size'])
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertEqual(2, len(self.server.pool.threads))
+
+class TestPreforkWorkers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(port=4351, workers=2, graceful_timeout=2.0)
+        cls.server.start()
+        cls.wait_for_workers(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    @classmethod
+    def wait_for_workers(cls, count):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                pids = set(requests.get("http://localhost:4351/process", headers={'Connection': 'close'}).json()
+                           for _ in range(4 * count))
+                if len(pids) and pids <= set(cls.server.children) and len(cls.server.children) == count:
+                    return pids
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        raise AssertionError("Worker processes didn't start")
+
+    def test_served_by_worker_process(self):
+        pid = requests.get("http://localhost:4351/process").json()
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertIn(pid, self.server.children)
+
+    def test_crashed_worker_restarted(self):
+        crashed = list(self.server.children)[0]
+        os.kill(crashed, signal.SIGKILL)
+        deadline = time.time() + 5
+        while crashed in self.server.children or len(self.server.children) < 2:
+            self.assertLess(time.time(), deadline, "Crashed worker wasn't restarted")
+            time.sleep(0.1)
+        self.assertNotIn(crashed, self.wait_for_workers(2))
+
+    def test_rolling_restart(self):
+        before = set(self.server.children)
+        self.server.restart_workers()
+        deadline = time.time() + 10
+        while set(self.server.children) & before or len(self.server.children) < 2:
+            self.assertLess(time.time(), deadline, "Workers weren't replaced")
+            time.sleep(0.1)
+        self.assertFalse(self.wait_for_workers(2) & before)
+
+
+    def test_spawn_waits_until_listening(self):
+        server = Server(port=4361, workers=1, graceful_timeout=0.5)
+        pid = server.spawn_worker(wait_ready=True)
+        try:
+            socket.create_connection(("localhost", 4361), timeout=1).close()  # no waiting about
+        finally:
+            server.terminate_worker(pid)
+
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        keyfile = os.path.join(os.path.dirname(__file__), "test-key.pem")
+        certfile = os.path.join(os.path.dirname(__file__), "test-cert.crt")
+        cls.server = Server(port=4341, secure=True, keyfile=keyfile, certfile=certfile, engine='asyncio')
+        cls.server.start()
+
+    def test_sync_handler(self):
+        res = requests.get("http://localhost:4341/products/")
+        self.assertEqual(200, res.status_code, "Expects status code 200")
+        self.assertEqual('application/json', res.headers['Content-Type'])
+
+    def test_async_handler(self):
+        res = requests.get("http://localhost:4341/async/greeting")
+        self.assertEqual(200, res.status_code, "Expects status code 200")
+        self.assertEqual("hello from a coroutine", res.text)
+
+    def test_post_media(self):
+        res = requests.post('http://localhost:4341/media/asyncjunk', "x" * 100000)
+        self.assertEqual(204, res.status_code, "result after post media file should be 204 no content")
+
+    def test_chunked_generator_response(self):
+        res = requests.get('http://localhost:4341/stream/lines/3')
+        self.assertEqual('chunked', res.headers['Transfer-Encoding'])
+        self.assertEqual("line 0\nline 1\nline 2\n", res.text)
+
+    def test_slow_generator_leaves_loop_free(self):
+        streaming = threading.Thread(target=requests.get, args=('http://localhost:4341/stream/slow',))
+        streaming.start()
+        time.sleep(0.1)
+        started = time.time()
+        res = requests.get("http://localhost:4341/async/greeting")
+        self.assertLess(time.time() - started, 0.2, "the event loop was blocked by the generator")
+        self.assertEqual(200, res.status_code)
+        streaming.join()
+
+    def test_streamed_upload(self):
+        data = os.urandom(300000)
+        res = requests.put('http://localhost:4341/uploads/asyncbig', data)
+        self.assertEqual(201, res.status_code)
+        self.assertEqual(hashlib.sha1(data).hexdigest(), uploads['asyncbig'])
+
+    def test_keep_alive(self):
+        session = requests.Session()
+        for _ in range(3):
+            res = session.get("http://localhost:4341/products/")
+            self.assertEqual(200, res.status_code)
+            self.assertEqual('keep-alive', res.headers['Connection'])
+
+    def test_https_get(self):
+        res = requests.get("https://localhost:4342/products/", verify=False)
+        self.assertEqual(200, res.status_code, "Expects status code 200")
+
+    def test_not_found(self):
+        res = requests.get("http://localhost:4341/nothing/here")
+        self.assertEqual(404, res.status_code)
+
+class RecordingSocket:
+    """Stands in for a client socket, recording what gets written."""
+
+    def __init__(self, max_send=None):
+        self.calls = []
+        self.data = b''
+        self.max_send = max_send
+
+    def sendall(self, data):
+        self.calls.append('sendall')
+        self.data += bytes(data)
+
+
+class ScatterSocket(RecordingSocket):
+    def sendmsg(self, buffers):
+        self.calls.append('sendmsg')
+        sent = b''.join(bytes(buffer) for buffer in buffers)
+        if self.max_send is not None:
+            sent = sent[:self.max_send]  # pretend the kernel only took part of it
+        self.data += sent
+        return len(sent)
+
+
+class TestResponseSend(unittest.TestCase):
+    def test_single_sendmsg(self):
+        client = ScatterSocket()
+        response = Response()
+        response.body = "hello"
+        response.send(client)
+        self.assertEqual(['sendmsg'], client.calls)
+        self.assertTrue(client.data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Content-Length: 5\r\n', client.data)
+        self.assertTrue(client.data.endswith(b'\r\n\r\nhello'))
+
+    def test_partial_sendmsg(self):
+        client = ScatterSocket(max_send=7)
+        response = Response()
+        response.body = b"x" * 100
+        response.send(client)
+        self.assertGreater(len(client.calls), 1)
+        self.assertTrue(client.data.endswith(b'\r\n\r\n' + b"x" * 100))
+
+    def test_coalesced_sendall(self):
+        client = RecordingSocket()
+        response = Response()
+        response.body = "hello"
+        response.send(client)
+        self.assertEqual(['sendall'], client.calls)
+        self.assertTrue(client.data.endswith(b'\r\n\r\nhello'))
+
+    def test_cached_header_lines(self):
+        Response().send(RecordingSocket())
+        self.assertIn(('Server', Response().headers['Server']), Response.encoded_header_lines)
+        self.assertFalse([key for key in Response.encoded_header_lines if key[0] == 'Content-Length'])
+
+
+class TestCompressor(unittest.TestCase):
+    def request(self, accept_encoding):
+        return Request('GET', '/', {'Accept-Encoding': accept_encoding}, {})
+
+    def response(self):
+        response = Response()
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response.body = json.dumps(catalogue)
+        return response
+
+    def test_negotiate(self):
+        compressor = Compressor()
+        self.assertEqual('gzip', compressor.negotiate('gzip, deflate'))
+        self.assertEqual('deflate', compressor.negotiate('gzip;q=0.5, deflate'))
+        self.assertEqual('gzip', compressor.negotiate('*'))
+        self.assertIsNone(compressor.negotiate('br, gzip;q=0'))
+        self.assertIsNone(compressor.negotiate(None))
+
+    def test_cached_variant(self):
+        compressor = Compressor(cache_entries=1)
+        first = self.response()
+        compressor.compress(self.request('deflate'), first)
+        self.assertEqual('deflate', first.headers['Content-Encoding'])
+        self.assertEqual(json.dumps(catalogue).encode(), zlib.decompress(first.body))
+        self.assertEqual(1, len(compressor.cache))
+
+        second = self.response()
+        compressor.compress(self.request('deflate'), second)
+        self.assertIs(first.body, second.body, "identical body should come from the cache")
+
+        compressor.compress(self.request('gzip'), self.response())
+        self.assertEqual(1, len(compressor.cache), "cache should stay bounded")
+
+    def test_etag_variant(self):
+        response = self.response()
+        response.headers['ETag'] = '"abc"'
+        Compressor().compress(self.request('gzip'), response)
+        self.assertEqual('"abc-gzip"', response.headers['ETag'])
+
+    def test_same_etag_different_bodies(self):
+        compressor = Compressor(min_size=1)
+        for body in ('{"route": "a"}', '{"route": "b"}'):
+            response = self.response()
+            response.body = body
+            response.headers['ETag'] = '"v1"'
+            compressor.compress(self.request('deflate'), response)
+            self.assertEqual(body.encode(), zlib.decompress(response.body))
+
+
+class TestRequest(unittest.TestCase):
+    head = (b"GET /search?q=cake&sort=new HTTP/1.1\r\nHost: localhost\r\ncontent-length: 0\r\n"
+            b"User-Agent: tests\r\n\r\n")
+
+    def test_headers_parsed_lazily(self):
+        request = HttpWorker.build_request(self.head, ('127.0.0.1', 1234))
+        self.assertEqual('0', request.header('Content-Length'))
+        self.assertEqual('tests', request.header('user-agent'))
+        self.assertIsNone(request.header('Accept'))
+        self.assertIsNone(request.parsed_headers)
+
+        self.assertEqual('localhost', request.headers['HOST'])
+        self.assertIn('Content-Length', request.headers)
+        self.assertEqual({'Host', 'content-length', 'User-Agent'}, set(request.headers))
+
+    def test_query_parsed_lazily(self):
+        request = HttpWorker.build_request(self.head, ('127.0.0.1', 1234))
+        self.assertEqual('/search', request.uri)
+        self.assertIsNone(request.parsed_query)
+        self.assertEqual({'q': ['cake'], 'sort': ['new']}, request.get_query)
+
+    def test_response_headers_case_insensitive(self):
+        response = Response()
+        response.headers['content-type'] = 'application/json'
+        self.assertEqual('application/json', response.headers['Content-Type'])
+        self.assertEqual(['content-type'], [name for name in response.headers if name.lower() == 'content-type'])
+        self.assertEqual('text/html', Response().headers['Content-Type'])
+
+    def test_body_read_returns_bytes(self):
+        data = os.urandom(RequestBody.chunk_size * 2 + 7)
+        body = RequestBody(io.BytesIO(data).readinto, len(data))
+        head = body.read(10)
+        rest = body.read()
+        self.assertIs(bytes, type(head))
+        self.assertIs(bytes, type(rest))
+        self.assertEqual(data, head + rest)
+        self.assertEqual(b'', body.read())
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            Response().colour = 'blue'
+        with self.assertRaises(AttributeError):
+            Request('GET', '/').colour = 'blue'
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('yahs.access')
+        self.level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.request = HttpWorker.build_request(b'GET /items?page=2 HTTP/1.1\r\nReferer: http://example.com/\r\n'
+                                                b'User-Agent: tests "quoted"\r\n\r\n', ('10.0.0.1', 5000))
+
+    def tearDown(self):
+        self.logger.setLevel(self.level)
+
+    def response(self, status_code=200):
+        response = Response()
+        response.status_code = status_code
+        response.bytes_sent = 321
+        return response
+
+    def written(self, access_log):
+        access_log.flush()
+        return access_log.stream.getvalue().splitlines()
+
+    def test_common_log_format(self):
+        access_log = AccessLog(stream=io.StringIO())
+        access_log.log(self.request, self.response(), 0.0125)
+        self.assertRegex(self.written(access_log)[0],
+                         r'^10\.0\.0\.1 - - \[[^]]+\] "GET /items\?page=2 HTTP/1\.1" 200 321 12\.500$')
+
+    def test_combined_log_format(self):
+        access_log = AccessLog(log_format='combined', stream=io.StringIO())
+        access_log.log(self.request, self.response(), 0.001)
+        self.assertTrue(self.written(access_log)[0].endswith(
+            '200 321 "http://example.com/" "tests \\"quoted\\"" 1.000'))
+
+    def test_json_lines(self):
+        access_log = AccessLog(log_format='json', stream=io.StringIO())
+        access_log.log(self.request, self.response(404), 0.002)
+        entry = json.loads(self.written(access_log)[0])
+        self.assertEqual('/items?page=2', entry['uri'])
+        self.assertEqual(404, entry['status'])
+        self.assertEqual(321, entry['bytes_sent'])
+        self.assertEqual(2.0, entry['duration_ms'])
+
+    def test_sampling_keeps_errors(self):
+        access_log = AccessLog(stream=io.StringIO(), sample_rate=0)
+        for _ in range(10):
+            access_log.log(self.request, self.response(), 0.001)
+        access_log.log(self.request, self.response(500), 0.001)
+        lines = self.written(access_log)
+        self.assertEqual(1, len(lines))
+        self.assertIn('" 500 ', lines[0])
+
+    def test_disabled_level_skips_everything(self):
+        self.logger.setLevel(logging.WARNING)
+        access_log = AccessLog()
+        access_log.log(self.request, self.response(), 0.001)
+        self.assertIsNone(access_log.thread)
+        self.assertEqual(0, access_log.queue.qsize())
+
+    def test_stream_ignores_logger_level(self):
+        self.logger.setLevel(logging.WARNING)
+        access_log = AccessLog(stream=io.StringIO())
+        access_log.log(self.request, self.response(), 0.001)
+        self.assertEqual(1, len(self.written(access_log)))
+
+
+class TestForms(unittest.TestCase):
+    boundary = '----yahsboundary'
+    body = (b'preamble\r\n------yahsboundary\r\n'
+            b'Content-Disposition: form-data; name="title"\r\n\r\n'
+            b'caf\xc3\xa9\r\n'
+            b'------yahsboundary\r\n'
+            b'Content-Disposition: form-data; name="upload"; filename="a \\"b\\".bin"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\n'
+            + b'\r\n--data' * 5000 + b'\r\n'
+            b'------yahsboundary--\r\nepilogue')
+
+    def parser(self, body, content_type, chunk_size=7, **limits):
+        parser = FormParser(io.BytesIO(body).read, content_type, **limits)
+        parser.chunk_size = chunk_size  # small reads split delimiters across chunks
+        return parser
+
+    def test_multipart(self):
+        form = self.parser(self.body, 'multipart/form-data; boundary=' + self.boundary).form()
+        self.assertEqual(u'caf\xe9', form.get('title'))
+        upload = form.file('upload')
+        self.assertEqual('a "b".bin', upload.filename)
+        self.assertEqual(b'\r\n--data' * 5000, upload.file.read())
+        form.close()
+
+    def test_streamed_parts(self):
+        parser = self.parser(self.body, 'multipart/form-data; boundary="{}"'.format(self.boundary), 4096)
+        names = []
+        for part in parser.parts():
+            names.append(part.name)  # content left unread gets skipped
+        self.assertEqual(['title', 'upload'], names)
+
+    def test_part_size_limit(self):
+        parser = self.parser(self.body, 'multipart/form-data; boundary=' + self.boundary, 4096, max_part_size=1000)
+        with self.assertRaises(HttpError) as raised:
+            parser.form()
+        self.assertEqual(413, raised.exception.status_code)
+
+    def test_urlencoded(self):
+        form = self.parser(b'name=tim+s&tags=a&tags=b%26c&empty=', 'application/x-www-form-urlencoded').form()
+        self.assertEqual({'name': ['tim s'], 'tags': ['a', 'b&c'], 'empty': ['']}, form.fields)
+        with self.assertRaises(HttpError) as raised:
+            self.parser(b'big=' + b'x' * 100, 'application/x-www-form-urlencoded', max_field_size=50).form()
+        self.assertEqual(413, raised.exception.status_code)
+
+    def test_streamed_upload(self):
+        content = os.urandom(300000)
+        res = requests.post("http://localhost:4321/forms", data={'title': 'holiday'},
+                            files={'photo': ('beach.jpg', content, 'image/jpeg')})
+        self.assertEqual({'title': 'holiday', 'photo': ['beach.jpg', hashlib.sha1(content).hexdigest()]}, res.json())
+
+    def test_unsupported_form(self):
+        res = requests.post("http://localhost:4321/forms", data=b'{}', headers={'Content-Type': 'application/json'})
+        self.assertEqual(415, res.status_code)
+
+
+class TestRouteTable(unittest.TestCase):
+    module_source = """from yahs import Server
+
+@Server.handle('GET', r'^/reloadable/(?P<name>[a-z]+)$')
+def get_reloadable(request, name):
+    return {!r} + name
+"""
+
+    def write_module(self, directory, body):
+        with open(os.path.join(directory, 'reloadable_handlers.py'), 'w') as module_file:
+            module_file.write(body)
+
+    def find(self, uri):
+        return HttpWorker.find_handler(Request('GET', uri))
+
+    def test_snapshots(self):
+        before = Server.routes
+        Server.handle('GET', r'^/snapshot/new$')(lambda request: "new")
+        self.assertEqual(before.version + 1, Server.routes.version)
+        self.assertIsNone(before.find('GET', '/snapshot/new'))
+        self.assertEqual("new", Server.routes.find('GET', '/snapshot/new')[0](None))
+        self.assertIs(Server.routes.handlers, Server.handlers)
+
+    def test_reload_swaps_routes(self):
+        directory = tempfile.mkdtemp()
+        sys.path.insert(0, directory)
+        try:
+            self.write_module(directory, self.module_source.format('version one '))
+            import reloadable_handlers
+            self.assertEqual('version one x', self.find('/reloadable/x')[0](None, 'x'))
+
+            # keep looking up the route while it gets reloaded
+            errors = []
+            running = threading.Event()
+            running.set()
+
+            def lookups():
+                while running.is_set():
+                    try:
+                        self.assertIn(self.find('/reloadable/y')[0](None, 'y'), ('version one y', 'version two y'))
+                    except Exception as err:
+                        errors.append(err)
+            thread = threading.Thread(target=lookups)
+            thread.start()
+            self.write_module(directory, self.module_source.format('version two '))
+            for _ in range(20):
+                self.assertEqual(['reloadable_handlers'], Server.reload_handlers([reloadable_handlers]))
+            running.clear()
+            thread.join()
+            self.assertEqual([], errors)
+            self.assertEqual('version two x', self.find('/reloadable/x')[0](None, 'x'))
+            self.assertIs(Server.routes.handlers, Server.handlers)
+
+            # a broken module leaves the routes alone
+            routes = Server.routes
+            self.write_module(directory, "this isn't python")
+            self.assertRaises(SyntaxError, Server.reload_handlers, [reloadable_handlers])
+            self.assertIs(routes, Server.routes)
+        finally:
+            sys.path.remove(directory)
+            shutil.rmtree(directory)
+
+
+class TestInProcess(unittest.TestCase):
+    def test_client(self):
+        client = TestClient()
+        response = client.get('/products/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(products, json.loads(response.body.decode()))
+        self.assertEqual(b''.join(b"line %d\n" % number for number in range(3)), client.get('/stream/lines/3').body)
+        self.assertEqual(404, client.get('/nothing/here').status_code)
+
+        response = client.put('/uploads/inprocess', b'x' * 1000)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(hashlib.sha1(b'x' * 1000).hexdigest(), uploads['inprocess'])
+
+        response = client.get('/reports/weekly?b=2&a=1')
+        self.assertEqual(b"report weekly (('a', ('1',)), ('b', ('2',)))", response.body)
+        etag = response.headers['ETag']
+        self.assertEqual(304, client.get('/reports/weekly?a=1&b=2', headers={'If-None-Match': etag}).status_code)
+
+    def test_wsgi(self):
+        from wsgiref.util import setup_testing_defaults
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/media/wsgi', 'CONTENT_LENGTH': '5',
+                   'wsgi.input': io.BytesIO(b'hello')}
+        setup_testing_defaults(environ)
+        started = []
+        WsgiApp()(environ, lambda status, headers: started.append((status, headers)))
+        self.assertEqual(b'hello', bytes(media['wsgi']))
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/stream/lines/2', 'HTTP_CONNECTION': 'keep-alive'}
+        setup_testing_defaults(environ)
+        body = b''.join(WsgiApp()(environ, lambda status, headers: started.append((status, headers))))
+        self.assertEqual(b'line 0\nline 1\n', body)
+        status, headers = started[-1]
+        self.assertEqual('200 OK', status)
+        self.assertIn(('Content-Type', 'text/plain'), headers)
+        self.assertNotIn('Transfer-Encoding', dict(headers))
+
+    def test_wsgi_path(self):
+        self.assertEqual('/files/caf%C3%A9', WsgiApp.path({'PATH_INFO': '/files/caf\xc3\xa9'}))
+        self.assertEqual('/files/a%2Fb', WsgiApp.path({'PATH_INFO': '/files/a/b', 'RAW_URI': '/files/a%2Fb?x=1'}))
+        self.assertEqual('/files/a%2Fb', WsgiApp.path({'SCRIPT_NAME': '/app', 'PATH_INFO': '/files/a/b',
+                                                       'REQUEST_URI': '/app/files/a%2Fb'}))
+        self.assertEqual('/', WsgiApp.path({'PATH_INFO': ''}))
+
+    def test_wsgi_server(self):
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        WSGIRequestHandler.log_message = lambda *args: None
+        httpd = make_server('localhost', 4411, WsgiApp())
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            res = requests.get("http://localhost:4411/products/")
+            self.assertEqual(products, res.json())
+            self.assertEqual(404, requests.get("http://localhost:4411/nothing/here").status_code)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+
+class TestRouteIndex(unittest.TestCase):
+    def build(self, *patterns):
+        handlers = collections.OrderedDict()
+        for pattern in patterns:
+            handlers[re.compile(pattern)] = pattern
+        return RouteIndex(handlers)
+
+    def matched(self, index, uri):
+        found = index.match(uri)
+        return None if found is None else found[0].pattern
+
+    def test_literal_prefix(self):
+        self.assertEqual(('/yahs/api', False), RouteIndex.literal_prefix(re.compile(r'^/yahs/api/?$')))
+        self.assertEqual(('/food', True), RouteIndex.literal_prefix(re.compile(r'^/food$')))
+        self.assertEqual(('/media/', False), RouteIndex.literal_prefix(re.compile(r'/media/(?P<name>[a-z]+)/?')))
+        self.assertEqual(('', False), RouteIndex.literal_prefix(re.compile(r'^/a|/b')))
+        self.assertEqual(('', False), RouteIndex.literal_prefix(re.compile(r'(?i)^/food$')))
+
+    def test_first_registered_wins(self):
+        index = self.build(r'^/products/(?P<id>[0-9]+)', r'^/products/42$', r'.')
+        self.assertEqual(r'^/products/(?P<id>[0-9]+)', self.matched(index, '/products/42'))
+
+        index = self.build(r'^/products/42$', r'^/products/(?P<id>[0-9]+)')
+        self.assertEqual(r'^/products/42$', self.matched(index, '/products/42'))
+        self.assertEqual(r'^/products/(?P<id>[0-9]+)', self.matched(index, '/products/7'))
+
+        index = self.build(r'.', r'^/food$')
+        self.assertEqual(r'.', self.matched(index, '/food'))
+
+    def test_no_match(self):
+        index = self.build(r'^/food$', r'^/events/(?P<id>[0-9]+)')
+        self.assertIsNone(self.matched(index, '/foo'))
+        self.assertIsNone(self.matched(index, '/events/abc'))
+        self.assertIsNone(self.matched(index, ''))
+
+    def test_many_routes(self):
+        index = self.build(*[r'^/route{}/(?P<id>[0-9]+)$'.format(number) for number in range(500)])
+        found = index.match('/route499/7')
+        self.assertEqual({'id': '7'}, found[1].groupdict())
+
+    def test_patterns_not_combined(self):
+        index = self.build(r'^/n/(?P<x>[a-z])$', r'^/n/(?P<x>[a-z])/(?P=x)$', r'^/n/(?P<any>.*)$', r'(?i)^/B/(?P<y>.)$')
+        segments = index.trie['/']['n']['/'][index.ROUTES]
+        self.assertEqual([False, True, False], [combined is None for combined, routes in segments])
+        self.assertEqual({'x': 'q'}, index.match('/n/q/q')[1].groupdict())
+        self.assertEqual({'any': 'q/r'}, index.match('/n/q/r')[1].groupdict())
+        self.assertEqual({'y': '5'}, index.match('/b/5')[1].groupdict())
+
+@Server.handle('GET', r'^/async/greeting$')
+async def get_async_greeting(request):
+    return "hello from a coroutine"
+
 @Server.handle('GET', r'^/products/$')
 def get_products(request):
     response = Response()
@@ -78,6 +1441,105 @@ def get_products(request):
 def add_media(request, name):
     media[name] = request.body
 
+@Server.handle('PUT', r'^/uploads/(?P<name>[a-z]+)$', stream_body=True, max_body_size=2 * 1024 * 1024)
+def put_upload(request, name):
+    spooled = request.body.spool()
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: spooled.read(65536), b''):
+        digest.update(chunk)
+    uploads[name] = digest.hexdigest()
+
+    response = Response()
+    response.status_code = 201
+    response.status_message = 'Created'
+    return response
+
+@Server.handle('POST', r'^/uploads/(?P<name>[a-z]+)$', stream_body=True)
+def ignore_upload(request, name):
+    response = Response()
+    response.status_code = 202
+    response.status_message = 'Accepted'
+    return response
+
+Server.static('/static', static_directory)
+
+@Server.handle('GET', r'^/reports/(?P<name>[a-z]+)$', cache_ttl=0.5)
+def get_report(request, name):
+    report_calls.append(name)
+    return "report {} {}".format(name, request.normalized_query())
+
+@Server.handle('GET', r'^/catalogue$')
+def get_catalogue(request):
+    response = Response()
+    response.headers['Content-Type'] = 'application/json'
+    response.body = json.dumps(catalogue)
+    return response
+
+@Server.handle('GET', r'^/stream/lines/(?P<count>[0-9]+)$')
+def stream_lines(request, count):
+    response = Response()
+    response.headers['Content-Type'] = 'text/plain'
+    response.body = ("line {}\n".format(number) for number in range(int(count)))
+    return response
+
+@Server.handle('GET', r'^/stream/slow$')
+def stream_slow(request):
+    def lines():
+        for number in range(3):
+            time.sleep(0.2)
+            yield "line {}\n".format(number)
+    response = Response()
+    response.body = lines()
+    return response
+
+@Server.handle('GET', r'^/slow/(?P<name>[a-z]+)$', coalesce=True)
+def get_slow(request, name):
+    slow_calls.append(name)
+    time.sleep(0.3)
+    if name == 'broken':
+        raise ValueError("backend fell over")
+    return json.dumps({'name': name, 'query': request.get_query})
+
+
+@Server.handle('GET', r'^/slower$', coalesce=True, coalesce_timeout=0.1)
+def get_slower(request):
+    slow_calls.append('slower')
+    time.sleep(0.5)
+    return "finally"
+
+
+@Server.handle('GET', r'^/search$', stream_body=True)
+def get_search(request):
+    return request.body.read().decode()
+
+
+@Server.handle('POST', r'^/forms$', stream_body=True)
+def post_form(request):
+    form = request.form(max_part_size=1024 * 1024, spool_threshold=65536)
+    photo = form.file('photo')
+    result = {'title': form.get('title'), 'photo': [photo.filename, hashlib.sha1(photo.file.read()).hexdigest()]}
+    form.close()
+    return json.dumps(result)
+
+
+@Server.handle('GET', r'^/limited$', rate_limit=RateLimiter(rate=0.5, burst=2, key='X-Client'))
+def get_limited(request):
+    return "within limits"
+
+
+@Server.handle('GET', r'^/process$')
+def get_process(request):
+    return json.dumps(os.getpid())
+
+
+@Server.handle('GET', r'^/stream/file$')
+def stream_file(request):
+    response = Response()
+    response.headers['Content-Type'] = 'text/plain'
+    response.headers['Content-Length'] = str(os.path.getsize(__file__))
+    response.body = open(__file__, 'rb')
+    return response
+
 @Server.handle('GET', r'/media/(?P<name>[a-z]+)/?')
 def add_media(request, name):
     response = Response()